@@ -0,0 +1,6 @@
+"""
+Shared helpers for the CDE detective pipeline (prestep, harmonizer, HEAL match).
+
+The notebooks in this folder import from here so the same logic can be reused
+by the scripts in `in/` and `out/`.
+"""
@@ -0,0 +1,510 @@
+"""
+Batch-job execution mode: serialize the prestep and HEAL-match requests of one
+or more dictionaries into OpenAI Batch JSONL, submit, poll, and map the results
+back by custom_id into the same DataFrame columns as the live run.
+
+Batch jobs trade latency (up to the 24h completion window) for lower cost and
+no rate-limit contention, which suits overnight runs over the whole in/ folder:
+
+    python -m cde_detective.batch in/
+    python -m cde_detective.batch in/Testfile.xlsx --local   # stand-in endpoint, no network
+"""
+import argparse
+import asyncio
+import configparser
+import glob
+import io
+import json
+import os
+import time
+import uuid
+from types import SimpleNamespace
+
+from .crf_catalog import NO_CRF_MATCH, canonical_heal_crf
+from .harmonize import batcher, harmonize_crf_names_step
+from .heal_match import HEAL_MATCH_MODEL, heal_match_messages, run_heal_match_by_form
+from .loader import file_digest, load_table
+from .offload import configure_offload
+from .prestep import PRESTEP_MODEL, prestep_descriptions, prestep_messages
+from .prompts import PROMPT_STATS, configure_budgets
+from .structured import (
+    HEAL_MATCH_ALIASES,
+    HEAL_MATCH_SCHEMA,
+    PARSE_STATS,
+    PRESTEP_ALIASES,
+    PRESTEP_SCHEMA,
+    HealMatchResponse,
+    PrestepResponse,
+    StructuredOutputError,
+    parse_structured,
+    response_format,
+)
+from .workbook import write_enhanced_workbook
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+MAX_REQUESTS_PER_FILE = 50000
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+# --- JSONL files and the Batch API -------------------------------------------
+
+def batch_line(custom_id, model, messages, schema_name, schema, temperature=0):
+    """One request line in the OpenAI Batch input format."""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": model,
+            "messages": messages,
+            "response_format": response_format(schema_name, schema),
+            "temperature": temperature,
+        },
+    }
+
+
+def write_jsonl(lines, path):
+    with open(path, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+
+async def submit_batch(client, path, completion_window="24h"):
+    with open(path, "rb") as f:
+        uploaded = await client.files.create(file=f, purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=uploaded.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=completion_window,
+        metadata={"source": os.path.basename(path)},
+    )
+    print(f"[Batch] Submitted {os.path.basename(path)} as {batch.id}")
+    return batch
+
+
+async def wait_for_batch(client, batch_id, poll_interval=60):
+    """Poll until the batch reaches a terminal status; returns the final batch object."""
+    started = time.perf_counter()
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        counts = getattr(batch, "request_counts", None)
+        progress = f" ({counts.completed}/{counts.total})" if counts else ""
+        print(f"[Batch] {batch_id}: {batch.status}{progress} after {time.perf_counter() - started:.0f}s")
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+        await asyncio.sleep(poll_interval)
+
+
+async def fetch_results(client, batch):
+    """{custom_id: message content} for every request in the batch (None when it errored)."""
+    results = {}
+    for file_id in (batch.output_file_id, getattr(batch, "error_file_id", None)):
+        if not file_id:
+            continue
+        content = await client.files.content(file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            try:
+                message = response["body"]["choices"][0]["message"]
+                results[item["custom_id"]] = message.get("content")
+            except (KeyError, IndexError, TypeError):
+                results.setdefault(item["custom_id"], None)
+    if batch.status != "completed":
+        print(f"[Batch] {batch.id} ended as '{batch.status}'; missing requests fall back to defaults.")
+    return results
+
+
+def _load_manifest(path):
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+async def run_batch(client, lines, work_dir, name, poll_interval=60, completion_window="24h"):
+    """
+    Write `lines` as one or more JSONL files (at most MAX_REQUESTS_PER_FILE each),
+    submit them, poll until done and return {custom_id: content}.
+    Submitted batch ids are kept in {work_dir}/{name}_manifest.json keyed by the
+    file's hash, so an interrupted run picks up the same jobs instead of resubmitting.
+    A stored batch that ended expired, failed or cancelled is submitted again.
+    """
+    if not lines:
+        return {}
+    os.makedirs(work_dir, exist_ok=True)
+    manifest_path = os.path.join(work_dir, f"{name}_manifest.json")
+    # the stand-in endpoint forgets its jobs when the process exits
+    persistent = getattr(client, "persistent", True)
+    manifest = _load_manifest(manifest_path) if persistent else {}
+
+    async def one(part_num, part):
+        path = os.path.join(work_dir, f"{name}_{part_num:02d}.jsonl")
+        write_jsonl(part, path)
+        digest = file_digest(path)
+        batch_id = manifest.get(digest)
+        if batch_id is not None:
+            status = (await client.batches.retrieve(batch_id)).status
+            if status in TERMINAL_STATUSES and status != "completed":
+                print(f"[Batch] {batch_id} ended as '{status}'; resubmitting {os.path.basename(path)}")
+                batch_id = None
+            else:
+                print(f"[Batch] Resuming {os.path.basename(path)} as {batch_id}")
+        if batch_id is None:
+            batch_id = (await submit_batch(client, path, completion_window)).id
+            manifest[digest] = batch_id
+            if persistent:
+                with open(manifest_path, "w", encoding="utf-8") as f:
+                    json.dump(manifest, f, indent=2)
+        return await fetch_results(client, await wait_for_batch(client, batch_id, poll_interval))
+
+    parts = list(batcher(lines, MAX_REQUESTS_PER_FILE))
+    results = {}
+    for part_results in await asyncio.gather(*[one(i, part) for i, part in enumerate(parts, start=1)]):
+        results.update(part_results)
+    print(f"[Batch] {name}: {len(results)}/{len(lines)} results returned")
+    return results
+
+
+def _parse(content, model, aliases, stats):
+    if content is None:
+        return None
+    try:
+        return parse_structured(content, model, aliases=aliases, stats=stats)
+    except StructuredOutputError as e:
+        print(f"[parse] batch result unrepairable: {e}")
+        return None
+
+
+def _heal_result(content, stats):
+    parsed = _parse(content, HealMatchResponse, HEAL_MATCH_ALIASES, stats)
+    if parsed is None:
+        return NO_CRF_MATCH, "Low", ""
+    return parsed.heal_core_crf, parsed.confidence, parsed.rationale.strip()
+
+
+# --- pipeline stages ---------------------------------------------------------
+
+async def run_prestep_batch(client, frames, instruction, crf_column="Form Name",
+                            variable_column="Variable / Field Name", description_column="Field Label",
+                            work_dir="out/batch", poll_interval=60, stats=None):
+    """
+    Batch version of run_prestep over several dictionaries at once.
+    `frames` is {name: DataFrame}; each frame gets Refined CRF Name, Rationale, Full Response.
+    """
+    stats = stats or PARSE_STATS
+    keys = {name: f"prestep-{k}" for k, name in enumerate(frames)}
+    lines = [
+        batch_line(f"{keys[name]}-{idx}", PRESTEP_MODEL,
+                   prestep_messages(row[variable_column], row[crf_column], description, instruction),
+                   "prestep_crf_name", PRESTEP_SCHEMA, temperature=0.5)
+        for name, df in frames.items()
+        for (idx, row), description in zip(df.iterrows(),
+                                           prestep_descriptions(df, variable_column, description_column))
+    ]
+    print(f"[Batch] Prestep: {len(lines)} requests from {len(frames)} dictionaries")
+    results = await run_batch(client, lines, work_dir, "prestep", poll_interval)
+
+    for name, df in frames.items():
+        names, rats, fulls = [], [], []
+        for idx, crf in zip(df.index, df[crf_column]):
+            content = results.get(f"{keys[name]}-{idx}")
+            parsed = _parse(content, PrestepResponse, PRESTEP_ALIASES, stats)
+            if parsed is None:
+                names.append(crf)
+                rats.append("")
+                fulls.append(content or "")
+            else:
+                names.append(parsed.crf_name.strip() or crf)
+                rats.append(parsed.rationale.strip())
+                fulls.append(parsed.model_dump_json())
+        df["Refined CRF Name"], df["Rationale"], df["Full Response"] = names, rats, fulls
+    return frames
+
+
+async def run_heal_match_batch(client, frames, instruction, work_dir="out/batch", poll_interval=60,
+                               stats=None):
+    """Batch version of run_heal_match (row level) over several dictionaries at once."""
+    stats = stats or PARSE_STATS
+    keys = {name: f"heal-{k}" for k, name in enumerate(frames)}
+    lines = [
+        batch_line(f"{keys[name]}-{idx}", HEAL_MATCH_MODEL, heal_match_messages(full, instruction),
+                   "heal_core_crf_match", HEAL_MATCH_SCHEMA, temperature=0.3)
+        for name, df in frames.items()
+        for idx, full in zip(df.index, df["Full Response"])
+    ]
+    print(f"[Batch] HEAL-Match: {len(lines)} requests from {len(frames)} dictionaries")
+    results = await run_batch(client, lines, work_dir, "heal_match", poll_interval)
+
+    for name, df in frames.items():
+        decided = [_heal_result(results.get(f"{keys[name]}-{idx}"), stats) for idx in df.index]
+        df["HEAL Core CRF Match"], df["Confidence Level"], df["Match Rationale"] = (
+            [d[0] for d in decided], [d[1] for d in decided], [d[2] for d in decided]
+        )
+    return frames
+
+
+class FormBatch:
+    """
+    Collects the form payloads that run_heal_match_by_form produces for each
+    dictionary and sends them as one batch job once every dictionary has
+    reported in. Pass `decider(k)` as `decide_forms` for the k-th dictionary.
+    """
+
+    def __init__(self, client, instruction, expected, work_dir="out/batch", poll_interval=60, stats=None):
+        self.client = client
+        self.instruction = instruction
+        self.expected = expected
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.stats = stats or PARSE_STATS
+        self.lines = []
+        self.arrived = 0
+        self.results = {}
+        self.ready = asyncio.Event()
+
+    def decider(self, k):
+        async def decide_forms(payloads):
+            ids = {name: f"heal-{k}-form-{i}" for i, name in enumerate(payloads)}
+            self.lines.extend(
+                batch_line(ids[name], HEAL_MATCH_MODEL, heal_match_messages(payload, self.instruction),
+                           "heal_core_crf_match", HEAL_MATCH_SCHEMA, temperature=0.3)
+                for name, payload in payloads.items()
+            )
+            self.arrived += 1
+            if self.arrived == self.expected:
+                print(f"[Batch] HEAL-Match: {len(self.lines)} form requests from {self.expected} dictionaries")
+                try:
+                    self.results = await run_batch(self.client, self.lines, self.work_dir,
+                                                   "heal_match_forms", self.poll_interval)
+                finally:
+                    self.ready.set()
+            else:
+                await self.ready.wait()
+            return {name: _heal_result(self.results.get(cid), self.stats) for name, cid in ids.items()}
+        return decide_forms
+
+
+# --- local stand-in endpoint ---------------------------------------------------
+
+def stand_in_reply(body):
+    """
+    Deterministic, schema-valid reply for a chat request body: the prestep
+    keeps the original form name, the harmonizer maps names to themselves and
+    the matcher accepts only names that already are HEAL Core CRF labels.
+    """
+    schema_name = body.get("response_format", {}).get("json_schema", {}).get("name")
+    user = next((m["content"] for m in reversed(body["messages"]) if m["role"] == "user"), "")
+    if schema_name == "prestep_crf_name":
+        form = next((line.split(":", 1)[1].strip() for line in user.splitlines()
+                     if line.startswith("Original form name:")), "")
+        return {"crf_name": form, "rationale": "Stand-in reply: original form name kept."}
+    if schema_name == "harmonize_crf_names":
+        entries = json.loads(user)
+        return {"mappings": [{"original": e["original"], "label": e["original"]} for e in entries]}
+    if schema_name == "heal_core_crf_match":
+        try:
+            crf = json.loads(user[user.index("{"):user.rindex("}") + 1]).get("crf_name")
+        except (ValueError, AttributeError):
+            crf = None
+        match = canonical_heal_crf(crf) or NO_CRF_MATCH
+        return {"heal_core_crf": match, "confidence": "Low", "rationale": "Stand-in reply."}
+    return {}
+
+
+def _completion(body, content):
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stand-in"),
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": content, "refusal": None},
+        }],
+    }
+
+
+class LocalBatchClient:
+    """
+    Stand-in for the parts of AsyncOpenAI the batch runner uses (files, batches,
+    and chat.completions for the harmonizer). Requests are answered by
+    `chat_client` when given (e.g. AsyncOpenAI(base_url=...) pointing at a
+    local OpenAI-compatible server) and by stand_in_reply otherwise.
+    """
+
+    persistent = False
+
+    def __init__(self, chat_client=None, max_concurrency=8):
+        self.chat_client = chat_client
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self._files = {}
+        self._batches = {}
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_completion))
+
+    async def _create_file(self, file, purpose="batch"):
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        data = file.read()
+        self._files[file_id] = data.decode("utf-8") if isinstance(data, bytes) else data
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    async def _file_content(self, file_id):
+        return SimpleNamespace(text=self._files[file_id])
+
+    async def _complete(self, body):
+        if self.chat_client is not None:
+            async with self.semaphore:
+                response = await self.chat_client.chat.completions.create(**body)
+            return response.model_dump()
+        return _completion(body, json.dumps(stand_in_reply(body)))
+
+    async def _create_completion(self, **body):
+        from openai.types.chat import ChatCompletion
+
+        return ChatCompletion.model_validate(await self._complete(body))
+
+    async def _create_batch(self, input_file_id, endpoint, completion_window, metadata=None):
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        requests = [json.loads(line) for line in self._files[input_file_id].splitlines() if line.strip()]
+
+        async def answer(request):
+            try:
+                body = await self._complete(request["body"])
+                return {"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": request["custom_id"],
+                        "response": {"status_code": 200, "body": body}, "error": None}
+            except Exception as e:
+                return {"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": request["custom_id"],
+                        "response": None, "error": {"message": str(e)}}
+
+        lines = await asyncio.gather(*[answer(r) for r in requests])
+        output = io.StringIO()
+        for line in lines:
+            output.write(json.dumps(line) + "\n")
+        output_file_id = f"file-{uuid.uuid4().hex[:12]}"
+        self._files[output_file_id] = output.getvalue()
+        failed = sum(1 for line in lines if line["error"])
+        self._batches[batch_id] = SimpleNamespace(
+            id=batch_id, status="completed", output_file_id=output_file_id, error_file_id=None,
+            request_counts=SimpleNamespace(total=len(lines), completed=len(lines) - failed, failed=failed),
+        )
+        return self._batches[batch_id]
+
+    async def _retrieve_batch(self, batch_id):
+        return self._batches[batch_id]
+
+
+# --- overnight run over a folder ------------------------------------------------
+
+def _input_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*.xlsx")) + glob.glob(os.path.join(path, "*.csv")))
+        else:
+            files.append(path)
+    return [f for f in files if not os.path.basename(f).startswith("~$")]
+
+
+async def run_folder(client, files, config, sheet_name=0, output_dir="out", work_dir="out/batch",
+                     poll_interval=60):
+    crf_column = config["Columns"]["crf_column"]
+    variable_column = config["Columns"]["variable_column"]
+    description_column = config["Columns"]["description_column"]
+    columns = [crf_column, variable_column, description_column]
+    heal_match_mode = config.get("Matching", "heal_match_mode", fallback="row")
+    form_sample_size = config.getint("Matching", "form_sample_size", fallback=8)
+
+    frames = {}
+    for path in files:
+        try:
+            frames[path] = load_table(path, sheet_name=sheet_name, usecols=columns, categorical=[])
+        except ValueError as e:
+            print(f"⚠️ Skipping {path!r}: {e}")
+    if not frames:
+        print("No dictionaries with the configured columns found.")
+        return
+
+    await run_prestep_batch(client, frames, config["Instructions"]["crf_id_prestep"],
+                            crf_column, variable_column, description_column,
+                            work_dir=work_dir, poll_interval=poll_interval)
+
+    # The harmonizer makes a handful of calls per dictionary, so it stays live
+    enhanced = {}
+    for path, refined_df in frames.items():
+        refined_df = await harmonize_crf_names_step(client, refined_df, config["Instructions"]["form_harmonizer"])
+        full_df = load_table(path, sheet_name=sheet_name)
+        enhanced[path] = full_df.join(refined_df[["Canonical CRF Name", "Rationale", "Full Response"]])
+
+    matching_instruction = config["Instructions"]["matching_instruction"]
+    reports = {}
+    if heal_match_mode == "form":
+        collector = FormBatch(client, matching_instruction, len(enhanced), work_dir, poll_interval)
+        results = await asyncio.gather(*[
+            run_heal_match_by_form(client, df, matching_instruction,
+                                   variable_column=variable_column, description_column=description_column,
+                                   crf_column=crf_column, sample_size=form_sample_size,
+                                   decide_forms=collector.decider(k))
+            for k, df in enumerate(enhanced.values())
+        ])
+        for path, (df, report_df) in zip(enhanced, results):
+            enhanced[path], reports[path] = df, report_df
+    else:
+        await run_heal_match_batch(client, enhanced, matching_instruction, work_dir, poll_interval)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for path, final_df in enhanced.items():
+        stem = os.path.basename(path).rsplit(".", 1)[0]
+        write_enhanced_workbook(os.path.join(output_dir, f"{stem}_batch.xlsx"), final_df,
+                                crf_column, reports.get(path),
+                                layout=config.get("Files", "output_layout", fallback="enhanced"))
+    print(PARSE_STATS.summary())
+    print(PROMPT_STATS.summary())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run prestep + HEAL match over dictionaries as batch jobs.")
+    parser.add_argument("inputs", nargs="+", help="Dictionary files or folders (e.g. in/)")
+    parser.add_argument("--config", default="config_prestep.ini")
+    parser.add_argument("--sheet", default=0, help="Worksheet to read from each workbook (default: first)")
+    parser.add_argument("--columns", nargs=3, metavar=("CRF", "VARIABLE", "DESCRIPTION"),
+                        help="Override [Columns] (e.g. section name description for VLMD files)")
+    parser.add_argument("--output-dir", default="out")
+    parser.add_argument("--local", action="store_true", help="Use the local stand-in endpoint")
+    parser.add_argument("--local-base-url", default=None,
+                        help="With --local, answer requests from this OpenAI-compatible server")
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    if args.columns:
+        for key, value in zip(("crf_column", "variable_column", "description_column"), args.columns):
+            config.set("Columns", key, value)
+    configure_budgets(config)
+    configure_offload(config)
+    work_dir = config.get("Batch", "work_dir", fallback="out/batch")
+    poll_interval = config.getint("Batch", "poll_interval", fallback=60)
+
+    from openai import AsyncOpenAI
+
+    if args.local:
+        chat_client = AsyncOpenAI(base_url=args.local_base_url, api_key="local") if args.local_base_url else None
+        client = LocalBatchClient(chat_client)
+        poll_interval = 0
+    else:
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+    sheet = int(args.sheet) if str(args.sheet).isdigit() else args.sheet
+    asyncio.run(run_folder(client, _input_files(args.inputs), config, sheet_name=sheet,
+                           output_dir=args.output_dir, work_dir=work_dir, poll_interval=poll_interval))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""
+Micro-benchmarks for the scoring kernels behind the CDE search.
+
+Every scorer the package uses (or could use) is timed against the real master
+CDE sheet, with each batching strategy it supports:
+
+    pair     one Python call per (row, CDE) pair, ranked like rank_candidates
+    extract  rapidfuzz.process.extract per row (top 3)
+    cdist    rapidfuzz.process.cdist over chunks of rows, `workers` threads
+    embed    vectors for the KB once, then one matrix product per chunk
+
+The study dictionaries are synthetic: KB search texts with words dropped,
+shuffled or misspelled, mixed with decoy rows built from KB vocabulary, at
+each of `sizes` rows. A case stops after `max_seconds`; the rows it reached
+give the throughput, and the full size is projected from it (Extrapolated).
+Top-1 recall is the share of KB-derived rows whose best match is the text
+they were made from, so speed can be weighed against quality.
+
+Each run is appended to a JSON history file together with the git commit,
+so changes between commits show up next to the previous numbers:
+
+    cde-detective bench --sizes 100 1000 10000 100000 --max-seconds 20
+"""
+import importlib.util
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+from datetime import datetime
+
+import numpy as np
+
+from .encodings import DEFAULT_CDE_FILE
+
+HAS_SENTENCE_TRANSFORMERS = importlib.util.find_spec("sentence_transformers") is not None
+
+DEFAULT_HISTORY = "bench_history.json"
+DEFAULT_SIZES = (100, 1_000, 10_000, 100_000)
+STRATEGIES = ("pair", "extract", "cdist", "embed")
+SENTENCE_MODEL = "all-MiniLM-L6-v2"
+CHUNK_ROWS = 256
+DECOY_SHARE = 0.3  # share of synthetic rows that are not derived from a KB text
+MIN_RECALL_ROWS = 100  # derived rows a case must reach before recommend() trusts its recall
+
+
+def _rapidfuzz(name):
+    def load():
+        from rapidfuzz import fuzz
+        return getattr(fuzz, name)
+    return load
+
+
+def _fuzzywuzzy_token_set():
+    from fuzzywuzzy import fuzz
+    return fuzz.token_set_ratio
+
+
+# scorer -> (loader, strategies it supports); pairwise scorers load a function,
+# embedding scorers an object with fit(choices) / encode(texts)
+SCORERS = {
+    "fuzzywuzzy.token_set_ratio": (_fuzzywuzzy_token_set, ("pair",)),
+    "rapidfuzz.token_set_ratio": (_rapidfuzz("token_set_ratio"), ("pair", "extract", "cdist")),
+    "rapidfuzz.token_sort_ratio": (_rapidfuzz("token_sort_ratio"), ("pair", "extract", "cdist")),
+    "rapidfuzz.ratio": (_rapidfuzz("ratio"), ("pair", "extract", "cdist")),
+    "tfidf.char_ngrams": (lambda: TfidfEmbedder(), ("embed",)),
+    "sentence_transformers": (lambda: SentenceEmbedder(), ("embed",)),
+}
+
+
+class TfidfEmbedder:
+    """Character 3-5 gram TF-IDF vectors (scikit-learn), L2-normalized."""
+
+    def fit(self, choices):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        self.vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(3, 5), sublinear_tf=True)
+        return self.vectorizer.fit_transform(choices).T.tocsr()
+
+    def encode(self, texts):
+        return self.vectorizer.transform(texts)
+
+
+class SentenceEmbedder:
+    """sentence-transformers vectors (optional dependency), L2-normalized."""
+
+    def fit(self, choices):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(SENTENCE_MODEL)
+        return self.encode(choices).T
+
+    def encode(self, texts):
+        return self.model.encode(list(texts), normalize_embeddings=True, batch_size=CHUNK_ROWS)
+
+
+def available_scorers():
+    return [name for name in SCORERS if name != "sentence_transformers" or HAS_SENTENCE_TRANSFORMERS]
+
+
+# --- synthetic study dictionaries ---------------------------------------------------------
+
+def _typo(word, rng):
+    if len(word) < 4:
+        return word
+    i = rng.randrange(len(word) - 1)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def synthetic_study(choices, size, seed=0):
+    """
+    `size` study texts and, for each, the index of the KB text it was made from
+    (None for decoys). Derived rows drop up to a third of the words, swap a pair
+    and misspell one; decoys are random KB vocabulary of a similar length.
+    """
+    rng = random.Random(seed)
+    vocabulary = sorted({word for text in choices for word in text.split()})
+    texts, sources = [], []
+    for _ in range(size):
+        if rng.random() < DECOY_SHARE:
+            length = len(rng.choice(choices).split())
+            texts.append(" ".join(rng.choice(vocabulary) for _ in range(max(length, 3))))
+            sources.append(None)
+            continue
+        source = rng.randrange(len(choices))
+        words = choices[source].split()
+        keep = [w for w in words if rng.random() > 0.33] or words[:1]
+        if len(keep) > 1:
+            i = rng.randrange(len(keep) - 1)
+            keep[i], keep[i + 1] = keep[i + 1], keep[i]
+        i = rng.randrange(len(keep))
+        keep[i] = _typo(keep[i], rng)
+        texts.append(" ".join(keep))
+        sources.append(source)
+    return texts, sources
+
+
+# --- strategies -----------------------------------------------------------------------------
+# Each yields the index of the best KB text for every row, a chunk at a time,
+# so a case can stop at the time limit between chunks.
+
+def _pair(scorer, texts, choices, workers):
+    for text in texts:
+        scored = sorted(((scorer(text, choice), i) for i, choice in enumerate(choices)),
+                        key=lambda x: x[0], reverse=True)
+        yield [scored[0][1]]
+
+
+def _extract(scorer, texts, choices, workers):
+    from rapidfuzz import process
+
+    for text in texts:
+        yield [process.extract(text, choices, scorer=scorer, limit=3)[0][2]]
+
+
+def _cdist(scorer, texts, choices, workers):
+    from rapidfuzz import process
+
+    for start in range(0, len(texts), CHUNK_ROWS):
+        scores = process.cdist(texts[start:start + CHUNK_ROWS], choices, scorer=scorer, workers=workers)
+        yield scores.argmax(axis=1).tolist()
+
+
+def _embed(embedder, texts, choices, workers, kb_vectors=None):
+    for start in range(0, len(texts), CHUNK_ROWS):
+        scores = embedder.encode(texts[start:start + CHUNK_ROWS]) @ kb_vectors
+        scores = scores.toarray() if hasattr(scores, "toarray") else np.asarray(scores)
+        yield scores.argmax(axis=1).tolist()
+
+
+_STRATEGY_FUNCS = {"pair": _pair, "extract": _extract, "cdist": _cdist, "embed": _embed}
+
+
+def run_case(scorer_name, strategy, texts, sources, choices, max_seconds=20.0, workers=-1):
+    """Time one scorer + strategy on `texts`; returns the result row for the history."""
+    loader, _ = SCORERS[scorer_name]
+    started = time.perf_counter()
+    scorer = loader()
+    extra = {}
+    if strategy == "embed":
+        extra["kb_vectors"] = scorer.fit(choices)
+    setup = time.perf_counter() - started
+
+    best = []
+    started = time.perf_counter()
+    for chunk in _STRATEGY_FUNCS[strategy](scorer, texts, choices, workers, **extra):
+        best.extend(chunk)
+        if time.perf_counter() - started > max_seconds:
+            break
+    seconds = time.perf_counter() - started
+
+    done = len(best)
+    derived = [(b, s) for b, s in zip(best, sources) if s is not None]
+    rate = done / seconds if seconds else float("inf")
+    return {
+        "scorer": scorer_name,
+        "strategy": strategy,
+        "rows": len(texts),
+        "rows_timed": done,
+        "seconds": round(seconds, 4),
+        "setup_seconds": round(setup, 4),
+        "rows_per_second": round(rate, 1),
+        "projected_seconds": round(setup + len(texts) / rate, 2),
+        "extrapolated": done < len(texts),
+        # a hit is the source text itself or an identical KB text under another variable
+        "top1_recall": round(sum(choices[b] == choices[s] for b, s in derived) / len(derived), 4)
+        if derived else None,
+        "recall_rows": len(derived),
+    }
+
+
+# --- history ------------------------------------------------------------------------------
+
+def _git(*args):
+    try:
+        out = subprocess.run(["git", *args], capture_output=True, text=True, timeout=10,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() if out.returncode == 0 else None
+
+
+def _versions():
+    versions = {}
+    for package in ("rapidfuzz", "fuzzywuzzy", "sklearn", "numpy", "sentence_transformers", "Levenshtein"):
+        if importlib.util.find_spec(package) is not None:
+            module = __import__(package)
+            versions[package] = getattr(module, "__version__", "installed")
+    return versions
+
+
+def load_history(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def append_history(path, run):
+    history = load_history(path)
+    history.append(run)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp, path)
+    return history
+
+
+def _previous_rates(history):
+    """(scorer, strategy, rows) -> rows/s of the most recent earlier run that timed it."""
+    rates = {}
+    for run in history:
+        for result in run.get("results", []):
+            rates[(result["scorer"], result["strategy"], result["rows"])] = (run.get("commit"),
+                                                                             result["rows_per_second"])
+    return rates
+
+
+def print_results(results, previous=None):
+    previous = previous or {}
+    print(f"{'scorer':<28} {'strategy':<8} {'rows':>7} {'rows/s':>10} {'full run':>10} {'top-1':>6}  vs last")
+    for r in results:
+        full = f"{r['projected_seconds']:.1f}s" + ("*" if r["extrapolated"] else "")
+        recall = f"{r['top1_recall']:.1%}" if r["top1_recall"] is not None else "-"
+        last = previous.get((r["scorer"], r["strategy"], r["rows"]))
+        change = f"{r['rows_per_second'] / last[1]:.2f}x ({last[0] or '?'})" if last and last[1] else ""
+        print(f"{r['scorer']:<28} {r['strategy']:<8} {r['rows']:>7,} {r['rows_per_second']:>10,.0f} "
+              f"{full:>10} {recall:>6}  {change}")
+    print("* projected from the rows reached within the time limit")
+
+
+def recommend(results, tolerance=0.01):
+    """
+    Per size, the fastest case whose top-1 recall is within `tolerance` of the best.
+    Cases stopped before MIN_RECALL_ROWS derived rows are left out: their recall
+    comes from too few rows to compare.
+    """
+    picks = {}
+    for rows in sorted({r["rows"] for r in results}):
+        cases = [r for r in results if r["rows"] == rows and r["top1_recall"] is not None]
+        enough = min(MIN_RECALL_ROWS, max((r["recall_rows"] for r in cases), default=0))
+        cases = [r for r in cases if r["recall_rows"] >= enough]
+        if not cases:
+            continue
+        best_recall = max(r["top1_recall"] for r in cases)
+        good = [r for r in cases if r["top1_recall"] >= best_recall - tolerance]
+        picks[rows] = min(good, key=lambda r: r["projected_seconds"])
+    return picks
+
+
+def run_benchmarks(cde_file=DEFAULT_CDE_FILE, sizes=DEFAULT_SIZES, scorers=None, strategies=STRATEGIES,
+                   max_seconds=20.0, workers=-1, seed=0, history_file=DEFAULT_HISTORY):
+    """
+    Time every available scorer x strategy on synthetic studies of each size
+    against the KB in `cde_file`; append the run to `history_file` (None = don't)
+    and return it.
+    """
+    from .encodings import load_cde_kb
+    from .kb_versions import kb_version
+
+    choices = load_cde_kb(cde_file)["Normalized Combined"].astype(str).tolist()
+    scorers = [s for s in (scorers or available_scorers()) if s in available_scorers()]
+    cases = [(s, strategy) for s in scorers for strategy in SCORERS[s][1] if strategy in strategies]
+    print(f"[Bench] {len(cases)} scorer/strategy cases x {len(sizes)} sizes against {len(choices)} KB texts "
+          f"({max_seconds:g}s limit per case)")
+
+    results = []
+    for size in sizes:
+        texts, sources = synthetic_study(choices, size, seed)
+        for scorer_name, strategy in cases:
+            result = run_case(scorer_name, strategy, texts, sources, choices, max_seconds, workers)
+            print(f"[Bench] {size:>7,} rows  {scorer_name} / {strategy}: {result['rows_per_second']:,.0f} rows/s")
+            results.append(result)
+
+    run = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--", ".")),
+        "kb_version": kb_version(cde_file),
+        "kb_texts": len(choices),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "workers": workers,
+        "max_seconds": max_seconds,
+        "seed": seed,
+        "versions": _versions(),
+        "results": results,
+    }
+    previous = _previous_rates(load_history(history_file)) if history_file else {}
+    print_results(results, previous)
+    for rows, pick in recommend(results).items():
+        print(f"[Bench] {rows:,} rows: fastest within 1 point of the best recall is "
+              f"{pick['scorer']} / {pick['strategy']} "
+              f"({pick['projected_seconds']:.1f}s, top-1 {pick['top1_recall']:.1%})")
+    if history_file:
+        history = append_history(history_file, run)
+        print(f"[Bench] run {len(history)} saved to {history_file}")
+    return run
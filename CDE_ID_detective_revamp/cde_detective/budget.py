@@ -0,0 +1,291 @@
+"""
+Per-run and per-day API budget ([Budget] in config_prestep.ini).
+
+run_pipeline wraps its client in a BudgetClient when a budget is set. Before
+each chat completion the client reserves the request's estimated tokens and
+cost against every limit (requests, tokens, cost; for this run and for the
+day) and checks the wall-clock deadline. A call that would cross a limit
+raises BudgetExhausted instead of going out, and calls still in flight at the
+deadline are cut off. The stages catch it and finish the affected rows locally:
+
+    prestep    the original form name is kept as the refined name
+    harmonize  the batch keeps its names; the local fuzzy reduce still clusters them
+    match      the local classifier when its model file exists, else the HEAL CRF
+               named by the form's abbreviation (PHQ-9 -> PHQ9), else No CRF match
+
+Those rows list the stages that fell back in the Degraded column, so the
+workbook is complete and on time whatever the budget. Day totals are kept in
+a small JSON ledger ([Budget] ledger) shared by every run. In the service,
+every job's Budget also reserves against one service-wide Budget (`shared`),
+so concurrent jobs draw on the same daily limits.
+
+    cde-detective prestep in/Study.xlsx --max-cost 2 --deadline 30
+"""
+import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import date
+from types import SimpleNamespace
+
+import pandas as pd
+
+from .offload import output
+from .prompts import count_tokens
+
+LIMITS = ("requests", "tokens", "cost")
+DEGRADED_COLUMN = "Degraded"
+DEFAULT_LEDGER = "out/.budget_ledger.json"
+
+# USD per 1M input / output tokens; unknown models are charged at the highest rate
+PRICES = {
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+}
+
+
+class BudgetExhausted(RuntimeError):
+    """A call was refused (or cut off) because a limit or the deadline was reached."""
+
+    def __init__(self, reason):
+        super().__init__(f"budget exhausted: {reason}")
+        self.reason = reason
+
+
+@dataclass
+class Usage:
+    requests: int = 0
+    tokens: int = 0
+    cost: float = 0.0
+
+    def add(self, requests, tokens, cost):
+        self.requests += requests
+        self.tokens += tokens
+        self.cost += cost
+
+    def get(self, limit):
+        return getattr(self, limit)
+
+
+@dataclass
+class Budget:
+    run_limits: dict                      # limit -> cap for this run (None = no cap)
+    day_limits: dict                      # limit -> cap for the calendar day, across runs
+    deadline: float = None                # time.monotonic() by which the workbook must be written
+    reserve_seconds: float = 30.0         # kept back before the deadline for the local fallback and writing
+    output_tokens: int = 200              # completion tokens assumed per call until usage comes back
+    prices: dict = field(default_factory=lambda: dict(PRICES))
+    ledger: str = None
+    run: Usage = field(default_factory=Usage)
+    earlier_today: Usage = field(default_factory=Usage)  # previous runs, from the ledger
+    stopped_by: str = None
+    shared: "Budget" = None               # service-wide budget that holds the daily limits instead
+
+    @property
+    def daily(self):
+        """The Budget whose day_limits and usage the daily check uses."""
+        return self.shared or self
+
+    def cost(self, model, prompt_tokens, completion_tokens):
+        input_price, output_price = self.prices.get(model, max(self.prices.values()))
+        return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+    def seconds_left(self):
+        """Seconds until calls must stop (None without a deadline)."""
+        if self.deadline is None:
+            return None
+        return self.deadline - self.reserve_seconds - time.monotonic()
+
+    def stop(self, reason):
+        """BudgetExhausted for `reason`; the first reason is kept and announced once."""
+        if self.stopped_by is None:
+            self.stopped_by = reason
+            output.info(f"[Budget] {reason} reached: the remaining rows fall back to local matching")
+        return BudgetExhausted(reason)
+
+    def reserve(self, model, prompt_tokens):
+        """Charge one request's estimate up front; raises BudgetExhausted if it does not fit."""
+        left = self.seconds_left()
+        if left is not None and left <= 0:
+            raise self.stop("deadline")
+        tokens = prompt_tokens + self.output_tokens
+        estimate = {"requests": 1, "tokens": tokens, "cost": self.cost(model, prompt_tokens, self.output_tokens)}
+        daily = self.daily
+        for scope, limits, used, earlier in (("run", self.run_limits, self.run, Usage()),
+                                             ("daily", daily.day_limits, daily.run, daily.earlier_today)):
+            for limit in LIMITS:
+                cap = limits.get(limit)
+                if cap is not None and used.get(limit) + earlier.get(limit) + estimate[limit] > cap:
+                    raise self.stop(f"{scope} {limit} limit ({_format(limit, cap)})")
+        self._charge(1, tokens, estimate["cost"])
+        return model, tokens, estimate["cost"]
+
+    def settle(self, reservation, prompt_tokens, completion_tokens):
+        """Replace a reservation's estimate with the tokens the API reported."""
+        model, tokens, cost = reservation
+        self._charge(0, prompt_tokens + completion_tokens - tokens,
+                     self.cost(model, prompt_tokens, completion_tokens) - cost)
+
+    def _charge(self, requests, tokens, cost):
+        self.run.add(requests, tokens, cost)
+        if self.shared is not None:
+            self.shared.run.add(requests, tokens, cost)
+
+    # --- ledger -----------------------------------------------------------------
+
+    def _read_ledger(self):
+        try:
+            with open(self.ledger, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load_ledger(self):
+        if self.ledger:
+            self.earlier_today = Usage(**self._read_ledger().get(date.today().isoformat(), {}))
+
+    def save_ledger(self):
+        """
+        Add this run's usage to today's entry (re-read first, so other runs' totals
+        are kept). Each service job saves its own usage; the shared Budget never does.
+        """
+        if not self.ledger or not self.run.requests:
+            return
+        ledger = self._read_ledger()
+        today = Usage(**ledger.get(date.today().isoformat(), {}))
+        today.add(self.run.requests, self.run.tokens, self.run.cost)
+        ledger[date.today().isoformat()] = vars(today)
+        os.makedirs(os.path.dirname(self.ledger) or ".", exist_ok=True)
+        tmp = f"{self.ledger}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(ledger, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.ledger)
+
+    # --- reporting ----------------------------------------------------------------
+
+    def describe(self):
+        parts = [f"{scope} {limit} {_format(limit, cap)}"
+                 for scope, limits in (("run", self.run_limits), ("daily", self.day_limits))
+                 for limit, cap in limits.items() if cap is not None]
+        if self.deadline is not None:
+            parts.append(f"deadline in {(self.deadline - time.monotonic()) / 60:.0f} min")
+        return "[Budget] limits: " + (", ".join(parts) or "none")
+
+    def summary(self, df=None):
+        today = self.daily.run.cost + self.daily.earlier_today.cost
+        used = (f"{self.run.requests:,} requests, {self.run.tokens:,} tokens, "
+                f"~${self.run.cost:.2f} this run (~${today:.2f} today)")
+        stopped = f"; stopped by {self.stopped_by}" if self.stopped_by else ""
+        degraded = ""
+        if df is not None and DEGRADED_COLUMN in df.columns:
+            stages = df[DEGRADED_COLUMN].astype(object).dropna().astype(str).str.split(", ").explode()
+            counts = stages[stages != ""].value_counts()
+            degraded = "; degraded rows: " + (", ".join(f"{s}={n}" for s, n in counts.items()) or "none")
+        return f"[Budget] {used}{stopped}{degraded}"
+
+
+def _format(limit, value):
+    return f"${value:,.2f}" if limit == "cost" else f"{value:,.0f}"
+
+
+def load_budget(config, overrides=None, shared=None):
+    """
+    Budget from the [Budget] section, with `overrides` ({"max_cost": 2, "deadline_minutes": 30, ...},
+    e.g. from the command line) on top. None when the section is disabled and no override is given.
+    With a `shared` Budget (the service's) the daily limits are checked against that one instead.
+    """
+    overrides = {k: v for k, v in (overrides or {}).items() if v is not None}
+    section = config["Budget"] if config is not None and config.has_section("Budget") else {}
+    if shared is None and not overrides and not (section and config.getboolean("Budget", "enabled", fallback=False)):
+        return None
+
+    def number(key, kind=float):
+        value = overrides.get(key, section.get(key, "") if section else "")
+        return kind(value) if str(value).strip() else None
+
+    prices = dict(PRICES)
+    for entry in (section.get("prices", "") if section else "").split(","):
+        if entry.strip():
+            model, rates = entry.split(":")
+            prices[model.strip()] = tuple(float(r) for r in rates.split("/"))
+
+    deadline = number("deadline_minutes")
+    budget = Budget(
+        run_limits={"requests": number("max_requests", int), "tokens": number("max_tokens", int),
+                    "cost": number("max_cost")},
+        day_limits={"requests": number("max_daily_requests", int), "tokens": number("max_daily_tokens", int),
+                    "cost": number("max_daily_cost")},
+        deadline=time.monotonic() + deadline * 60 if deadline is not None else None,
+        reserve_seconds=number("deadline_reserve") or 30.0,
+        output_tokens=number("expected_output_tokens", int) or 200,
+        prices=prices,
+        ledger=(section.get("ledger") if section else None) or DEFAULT_LEDGER,
+        shared=shared,
+    )
+    if shared is None:
+        budget.load_ledger()
+    return budget
+
+
+class BudgetClient:
+    """
+    Chat-completions client that charges every request to `budget` and refuses
+    the ones that do not fit (BudgetExhausted). Requests the wrapped client
+    answers from its reply cache (`is_cached`, see service.SharedBudgetClient)
+    cost nothing and are not charged. Everything else is passed through to the
+    wrapped client.
+    """
+
+    def __init__(self, client, budget):
+        self.client = client
+        self.budget = budget
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_completion))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def _create_completion(self, **body):
+        is_cached = getattr(self.client, "is_cached", None)
+        if is_cached is not None and is_cached(body):
+            return await self.client.chat.completions.create(**body)
+        prompt_tokens = sum(count_tokens(str(m.get("content", ""))) for m in body.get("messages", []))
+        reservation = self.budget.reserve(body.get("model", ""), prompt_tokens)
+        try:
+            response = await asyncio.wait_for(self.client.chat.completions.create(**body),
+                                              timeout=self.budget.seconds_left())
+        except asyncio.TimeoutError:
+            self.budget.settle(reservation, 0, 0)
+            raise self.budget.stop("deadline") from None
+        except BaseException:
+            self.budget.settle(reservation, 0, 0)
+            raise
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.budget.settle(reservation, usage.prompt_tokens, usage.completion_tokens)
+        return response
+
+
+def budget_of(client):
+    """The Budget a client charges to, or None."""
+    return getattr(client, "budget", None) if isinstance(client, BudgetClient) else None
+
+
+async def or_degrade(call, fallback):
+    """(await call, False), or (fallback(), True) when the budget refuses the call."""
+    try:
+        return await call, False
+    except BudgetExhausted:
+        return fallback(), True
+
+
+def mark_degraded(df, mask, stage):
+    """Add `stage` to the Degraded column of the rows selected by boolean `mask`."""
+    mask = pd.Series(mask, index=df.index).astype(bool)
+    if not mask.any():
+        return df
+    current = df[DEGRADED_COLUMN].astype(object).fillna("") if DEGRADED_COLUMN in df.columns \
+        else pd.Series("", index=df.index, dtype=object)
+    df[DEGRADED_COLUMN] = current.where(~mask, current.map(lambda v: f"{v}, {stage}" if v else stage))
+    return df
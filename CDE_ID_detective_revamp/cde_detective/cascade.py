@@ -0,0 +1,97 @@
+"""
+Confidence-gated model cascade ([Cascade] in config_prestep.ini).
+
+Every item is answered by the fast tier first; only items whose answer is not
+confident enough, or on which two tiers disagree, are re-asked with the strong
+model. CASCADE_STATS keeps per-stage, per-tier item counts and wall time.
+"""
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from .crf_catalog import CONFIDENCE_LEVELS
+
+
+@dataclass
+class Cascade:
+    fast_model: str
+    strong_model: str
+    escalate_below: str = "High"        # confidence level the fast answer must reach
+    escalate_on_disagreement: bool = True
+
+    def confident(self, confidence):
+        """True when `confidence` (a CONFIDENCE_LEVELS word) is at least escalate_below."""
+        rank = {level: i for i, level in enumerate(CONFIDENCE_LEVELS)}
+        return rank.get(str(confidence).split(" ")[0], len(rank)) <= rank[self.escalate_below]
+
+
+def load_cascade(config):
+    """Cascade from the [Cascade] section, or None when it is absent or disabled."""
+    if config is None or not config.getboolean("Cascade", "enabled", fallback=False):
+        return None
+    escalate_below = config.get("Cascade", "escalate_below", fallback="High").strip().capitalize()
+    if escalate_below not in CONFIDENCE_LEVELS:
+        raise ValueError(f"[Cascade] escalate_below must be one of {CONFIDENCE_LEVELS}, got {escalate_below!r}")
+    return Cascade(
+        fast_model=config.get("Cascade", "fast_model"),
+        strong_model=config.get("Cascade", "strong_model"),
+        escalate_below=escalate_below,
+        escalate_on_disagreement=config.getboolean("Cascade", "escalate_on_disagreement", fallback=True),
+    )
+
+
+def prestep_outliers(original_forms, refined_names, rationales):
+    """
+    Positions whose fast-tier prestep answer should go to the strong model: the
+    call fell back to the original name (no rationale), or the refined name is
+    the only one of its kind inside an original form that the other rows agree on.
+    """
+    by_form = {}
+    for i, form in enumerate(original_forms):
+        by_form.setdefault(form, []).append(i)
+
+    escalate = []
+    for positions in by_form.values():
+        counts = Counter(refined_names[i] for i in positions)
+        settled = len(positions) > 2 and counts.most_common(1)[0][1] > len(positions) / 2
+        for i in positions:
+            if not rationales[i] or (settled and counts[refined_names[i]] == 1):
+                escalate.append(i)
+    return sorted(escalate)
+
+
+# --- statistics --------------------------------------------------------------
+
+@dataclass
+class CascadeStats:
+    items: dict = field(default_factory=dict)     # (stage, tier) -> items answered
+    seconds: dict = field(default_factory=dict)   # (stage, tier) -> wall time spent in the tier
+    escalated: dict = field(default_factory=dict)  # stage -> items sent to the strong model
+
+    def add(self, stage, tier, n, seconds):
+        key = (stage, tier)
+        self.items[key] = self.items.get(key, 0) + n
+        self.seconds[key] = self.seconds.get(key, 0.0) + seconds
+
+    @contextmanager
+    def tier(self, stage, tier, n):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, tier, n, time.perf_counter() - started)
+
+    def escalate(self, stage, n):
+        self.escalated[stage] = self.escalated.get(stage, 0) + n
+
+    def summary(self):
+        parts = [
+            f"{stage}/{tier}: {n} items in {self.seconds[(stage, tier)]:.1f}s"
+            for (stage, tier), n in self.items.items()
+        ]
+        escalated = ", ".join(f"{stage}={n}" for stage, n in self.escalated.items())
+        return f"[Cascade] escalated {escalated or 'none'}; " + "; ".join(parts)
+
+
+CASCADE_STATS = CascadeStats()
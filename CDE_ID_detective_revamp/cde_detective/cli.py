@@ -0,0 +1,435 @@
+"""
+Command line entry point: `cde-detective <command>` (or `python -m cde_detective`).
+
+Only argparse is imported up front; each command imports pandas, openai,
+rapidfuzz, openpyxl, ... when it runs, so `--help` and argument errors come
+back immediately. Async stages run under a plain asyncio.run.
+"""
+import argparse
+import os
+import sys
+
+DEFAULT_CONFIG = "config_prestep.ini"
+
+
+def _require_files(parser, *paths):
+    for path in paths:
+        if not os.path.exists(path):
+            parser.error(f"file not found: {path}")
+
+
+def _config_path(value):
+    """Paths in the shared config are written Windows-style (in\\file.xlsx)."""
+    return value.replace("\\", os.sep)
+
+
+def _sheet(value):
+    return int(value) if str(value).isdigit() else value
+
+
+def _config(parser, args):
+    """Read --config (stdlib only) and apply --columns, [Prompts] budgets and [EventLoop]."""
+    import configparser
+
+    from .offload import configure_offload
+    from .prompts import configure_budgets
+
+    _require_files(parser, args.config)
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    for section in ("Columns", "Instructions"):
+        if not config.has_section(section):
+            parser.error(f"[{section}] missing from {args.config}")
+    if getattr(args, "columns", None):
+        for key, value in zip(("crf_column", "variable_column", "description_column"), args.columns):
+            config.set("Columns", key, value)
+    configure_budgets(config)
+    configure_offload(config)
+    return config
+
+
+def _budget_limits(args):
+    """--max-* / --deadline overrides for [Budget] (see cde_detective.budget)."""
+    return {
+        "max_requests": args.max_requests,
+        "max_tokens": args.max_tokens,
+        "max_cost": args.max_cost,
+        "deadline_minutes": args.deadline,
+    }
+
+
+# --- commands ------------------------------------------------------------------
+
+def cmd_prestep(parser, args):
+    import asyncio
+
+    config = _config(parser, args)
+    from_config = not args.inputs
+    if from_config:
+        if not config.has_option("Files", "input_file"):
+            parser.error("no input given and [Files] input_file is not set in the config")
+        args.inputs = [_config_path(config["Files"]["input_file"])]
+    _require_files(parser, *[p for p in args.inputs if not os.path.isdir(p)])
+    if args.output and len(args.inputs) > 1:
+        parser.error("-o/--output needs a single input; use --output-dir for several")
+
+    sheet = args.sheet
+    if sheet is None:
+        sheet = config.get("Files", "input_worksheet", fallback=0) if from_config else 0
+    sheet = _sheet(sheet)
+
+    if args.batch:
+        from .batch import LocalBatchClient, _input_files, run_folder
+
+        client = LocalBatchClient() if args.local else None
+        if client is None:
+            from .pipeline import make_client
+
+            client = make_client()
+        work_dir = config.get("Batch", "work_dir", fallback="out/batch")
+        poll_interval = 0 if args.local else config.getint("Batch", "poll_interval", fallback=60)
+        asyncio.run(run_folder(client, _input_files(args.inputs), config, sheet_name=sheet,
+                               output_dir=args.output_dir, work_dir=work_dir, poll_interval=poll_interval))
+        return
+
+    from .batch import _input_files
+    from .pipeline import default_output, make_client, run_pipeline
+
+    async def run_all(files):
+        # one loop for every file: the client's connection pool is bound to the loop it first ran on
+        client = make_client()
+        for input_file in files:
+            output_file = args.output
+            if output_file is None:
+                if from_config and config.has_option("Files", "output_file"):
+                    output_file = _config_path(config["Files"]["output_file"])
+                else:
+                    output_file = default_output(input_file, args.output_dir)
+            os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+            await run_pipeline(client, input_file, config, output_file, sheet_name=sheet,
+                               stop_after=args.stop_after, backend=args.backend, reduce=args.reduce,
+                               budget_limits=_budget_limits(args))
+
+    asyncio.run(run_all(_input_files(args.inputs)))
+
+
+def cmd_stage(parser, args):
+    import asyncio
+
+    _require_files(parser, args.workbook)
+    config = _config(parser, args)
+    from .pipeline import make_client, run_stage_on_workbook
+
+    asyncio.run(run_stage_on_workbook(make_client(), args.command, args.workbook, config,
+                                      output_file=args.output, backend=getattr(args, "backend", None),
+                                      reduce=getattr(args, "reduce", "local"),
+                                      budget_limits=_budget_limits(args)))
+
+
+def cmd_encodings(parser, args):
+    _require_files(parser, args.cde_file, *args.study_files)
+    from .batch import _input_files
+    from .encodings import color_code_results, compare_encodings
+
+    # folders: every dictionary in them, minus earlier search results
+    study_files = [f for f in _input_files(args.study_files) if not f.endswith("_vlmd_cdesearch.xlsx")]
+    if not study_files:
+        parser.error("no .xlsx/.csv study files found")
+    os.makedirs(args.output_dir, exist_ok=True)
+    options = dict(
+        encoding_column=args.encoding_column,
+        field_label_column=args.label_column,
+        cde_file=args.cde_file,
+        study_sheet=_sheet(args.sheet),
+        partitioned=not args.global_search,
+        fallback_threshold=args.fallback_threshold,
+        output_dir=args.output_dir,
+        exact_stems=not args.no_exact_stems,
+    )
+    if len(study_files) == 1 and args.processes == 1:
+        output_files = [compare_encodings(study_files[0], **options)]
+    else:
+        from .parallel_encodings import compare_encodings_parallel
+
+        output_files = compare_encodings_parallel(study_files, processes=args.processes,
+                                                  shard_rows=args.shard_rows, **options)
+    if not args.no_color:
+        for output_file in output_files:
+            color_code_results(output_file)
+
+
+def cmd_merge_quiz(parser, args):
+    _require_files(parser, args.workbook)
+    from .merge_quiz import merge_canonical_names
+
+    merge_canonical_names(args.workbook, args.output or args.workbook, sheet_name=args.sheet,
+                          crf_col=args.crf_column, description_col=args.description_column,
+                          threshold=args.threshold, merges_file=args.merges_file)
+
+
+def cmd_confirm_quiz(parser, args):
+    _require_files(parser, args.workbook)
+    from .confirm_quiz import confirm_matches
+
+    if args.import_review:
+        _require_files(parser, args.import_review)
+    output = args.output or args.workbook.rsplit(".", 1)[0] + "_matches_confirmed.xlsx"
+    confirm_matches(args.workbook, output, sheet_name=args.sheet, crf_col=args.crf_column, grouped=args.grouped,
+                    export_review=args.export_review, import_review=args.import_review)
+
+
+def cmd_combine(parser, args):
+    if not os.path.isdir(args.folder):
+        parser.error(f"folder not found: {args.folder}")
+    from .combine import combine_confirmed
+
+    combine_confirmed(args.folder, args.output, target_sheet=args.sheet)
+
+
+def cmd_convert(parser, args):
+    if not os.path.isdir(args.input_dir):
+        parser.error(f"folder not found: {args.input_dir}")
+    from .convert import convert_each_csv
+
+    convert_each_csv(args.input_dir, args.output_dir, processes=args.processes or None, fmt=args.format,
+                     force=args.force)
+
+
+def cmd_revalidate(parser, args):
+    _require_files(parser, args.old, args.new, *args.outputs)
+    from .kb_versions import revalidate
+
+    revalidate(args.outputs, args.old, args.new, output_dir=args.output_dir, report_file=args.report,
+               field_label_column=args.label_column, fallback_threshold=args.fallback_threshold,
+               dry_run=args.dry_run)
+
+
+def cmd_vlmd(parser, args):
+    from .batch import _input_files
+    from .vlmd import export_vlmd_file
+
+    _require_files(parser, *args.inputs)
+    if args.schema:
+        _require_files(parser, args.schema)
+    for path in _input_files(args.inputs):
+        export_vlmd_file(path, output_dir=args.output_dir, sheet_name=args.sheet, formats=args.format,
+                         min_cde_score=args.min_cde_score, columns=args.columns, schema_file=args.schema,
+                         strict=args.strict)
+
+
+def cmd_bench(parser, args):
+    _require_files(parser, args.cde_file)
+    from .bench import SCORERS, available_scorers, run_benchmarks
+
+    unavailable = sorted(set(args.scorers or []) - set(available_scorers()))
+    if unavailable:
+        parser.error(f"scorer(s) not installed: {', '.join(unavailable)} (known: {', '.join(SCORERS)})")
+    run_benchmarks(args.cde_file, sizes=args.sizes, scorers=args.scorers, strategies=args.strategies,
+                   max_seconds=args.max_seconds, workers=args.workers, seed=args.seed,
+                   history_file=None if args.no_history else args.history)
+
+
+def cmd_export(parser, args):
+    _require_files(parser, args.workbook)
+    from .results import is_normalized
+    from .workbook import export_enhanced_workbook
+
+    if not is_normalized(args.workbook):
+        parser.error(f"{args.workbook} has no 'Rows' sheet; it is already in the EnhancedDD layout")
+    output = args.output or args.workbook.rsplit(".", 1)[0] + "_enhanced.xlsx"
+    export_enhanced_workbook(args.workbook, output, crf_col=args.crf_column)
+
+
+def cmd_serve(parser, args):
+    config = _config(parser, args)
+    if args.local:
+        from .batch import LocalBatchClient
+
+        client = LocalBatchClient()
+    else:
+        from .pipeline import make_client
+
+        client = make_client()
+    from .service import serve
+
+    def option(name, value, get):
+        return value if value is not None else get("Service", name, fallback=None)
+
+    serve(config, client,
+          host=option("host", args.host, config.get) or "127.0.0.1",
+          port=option("port", args.port, config.getint) or 8765,
+          workers=option("workers", args.workers, config.getint) or 2,
+          max_api_concurrency=option("max_api_concurrency", args.max_api_concurrency, config.getint) or 8,
+          output_dir=option("output_dir", args.output_dir, config.get) or "out/service",
+          cde_file=args.cde_file)
+
+
+# --- parser --------------------------------------------------------------------
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="cde-detective",
+        description="Identify HEAL Core CRFs and CDEs in study data dictionaries.",
+    )
+    sub = parser.add_subparsers(dest="command", required=True, metavar="command")
+
+    def with_config(p):
+        p.add_argument("--config", default=DEFAULT_CONFIG, help=f"Pipeline config (default: {DEFAULT_CONFIG})")
+        p.add_argument("--columns", nargs=3, metavar=("CRF", "VARIABLE", "DESCRIPTION"),
+                       help="Override [Columns] (e.g. section name description for VLMD files)")
+        budget = p.add_argument_group("budget", "Per-run limits on top of [Budget]; rows past a limit "
+                                                "are matched locally and marked Degraded")
+        budget.add_argument("--max-requests", type=int)
+        budget.add_argument("--max-tokens", type=int)
+        budget.add_argument("--max-cost", type=float, help="Estimated USD")
+        budget.add_argument("--deadline", type=float, metavar="MINUTES",
+                            help="Wall-clock minutes until the workbook must be written")
+        return p
+
+    p = with_config(sub.add_parser("prestep", help="Prestep -> harmonize -> HEAL match on raw dictionaries"))
+    p.add_argument("inputs", nargs="*", help="Dictionaries or folders (default: [Files] input_file)")
+    p.add_argument("--sheet", default=None, help="Worksheet name or index (default: first sheet)")
+    p.add_argument("-o", "--output", help="Output workbook (single input only)")
+    p.add_argument("--output-dir", default="out", help="Folder for {input}_{date}.xlsx outputs")
+    p.add_argument("--stop-after", choices=["prestep", "harmonize", "match"], default="match")
+    p.add_argument("--backend", choices=["llm", "local", "hybrid"], help="Override [Matching] backend (local and hybrid run in form mode)")
+    p.add_argument("--reduce", choices=["local", "llm"], default="local", help="Harmonizer reduce phase")
+    p.add_argument("--batch", action="store_true", help="Submit prestep/HEAL match as OpenAI Batch jobs")
+    p.add_argument("--local", action="store_true", help="With --batch, use the local stand-in endpoint")
+    p.set_defaults(handler=cmd_prestep)
+
+    p = with_config(sub.add_parser("harmonize", help="Re-run the harmonizer on an EnhancedDD workbook"))
+    p.add_argument("workbook")
+    p.add_argument("-o", "--output", help="Output workbook (default: overwrite the input)")
+    p.add_argument("--reduce", choices=["local", "llm"], default="local")
+    p.set_defaults(handler=cmd_stage)
+
+    p = with_config(sub.add_parser("match", help="Re-run HEAL Core CRF matching on an EnhancedDD workbook"))
+    p.add_argument("workbook")
+    p.add_argument("-o", "--output", help="Output workbook (default: overwrite the input)")
+    p.add_argument("--backend", choices=["llm", "local", "hybrid"], help="Override [Matching] backend (local and hybrid run in form mode)")
+    p.set_defaults(handler=cmd_stage)
+
+    p = sub.add_parser("encodings", help="Variable-level CDE search on encodings + field labels")
+    p.add_argument("study_files", nargs="+", help="Study dictionaries or folders of them")
+    p.add_argument("--sheet", default="EnhancedDD")
+    p.add_argument("--encoding-column", default="enumLabels")
+    p.add_argument("--label-column", default="description")
+    p.add_argument("--cde-file", default="./KnowledgeBase/Compiled_CORE_CDEs list_English_one sheet_as of 2025-01-28.xlsx")
+    p.add_argument("--global-search", action="store_true", help="Search all CDEs, not the matched CRF's first")
+    p.add_argument("--fallback-threshold", type=int, default=70)
+    p.add_argument("--no-exact-stems", action="store_true",
+                   help="Fuzzy-score every row, even labels that are known CDE question stems")
+    p.add_argument("--output-dir", default="out")
+    p.add_argument("--no-color", action="store_true", help="Skip the color-coded confidence column")
+    p.add_argument("--processes", type=int, default=1,
+                   help="Worker processes; 0 = one per core (several files always use the pool)")
+    p.add_argument("--shard-rows", type=int, default=500, help="Rows per work unit with --processes")
+    p.set_defaults(handler=cmd_encodings)
+
+    p = sub.add_parser("vlmd", help="Stream outputs into VLMD JSON/CSV with standardsMappings filled in")
+    p.add_argument("inputs", nargs="+", help="Pipeline, confirmed or CDE search outputs (or folders of them)")
+    p.add_argument("--format", nargs="+", choices=["json", "csv"], default=["json"])
+    p.add_argument("--output-dir", help="Default: next to each input")
+    p.add_argument("--sheet", default=None, help="Worksheet (default: Rows/EnhancedDD/first sheet)")
+    p.add_argument("--min-cde-score", type=float, default=80,
+                   help="Best Match Score a CDE needs to be written as the mapped item")
+    p.add_argument("--columns", nargs=3, metavar=("CRF", "VARIABLE", "DESCRIPTION"),
+                   default=["Form Name", "Variable / Field Name", "Field Label"],
+                   help="section/name/description source columns for non-VLMD dictionaries")
+    p.add_argument("--schema", help="VLMD JSON schema to validate each field against (needs jsonschema)")
+    p.add_argument("--strict", action="store_true", help="Stop at the first invalid field")
+    p.set_defaults(handler=cmd_vlmd)
+
+    p = sub.add_parser("revalidate", help="Re-score CDE search outputs affected by a KB update")
+    p.add_argument("outputs", nargs="*", default=["out"], help="*_vlmd_cdesearch.xlsx files or folders (default: out)")
+    p.add_argument("--old", required=True, help="KB file the outputs were scored against")
+    p.add_argument("--new", default="./KnowledgeBase/Compiled_CORE_CDEs list_English_one sheet_as of 2025-01-28.xlsx",
+                   help="Updated KB file (default: the current one)")
+    p.add_argument("--output-dir", help="Write revalidated outputs here (default: update them in place)")
+    p.add_argument("--report", help="Report workbook (default: {output-dir or out}/kb_revalidation_{old}_to_{new}.xlsx)")
+    p.add_argument("--label-column", default="description")
+    p.add_argument("--fallback-threshold", type=int, default=70)
+    p.add_argument("--dry-run", action="store_true", help="Report what would move without writing outputs")
+    p.set_defaults(handler=cmd_revalidate)
+
+    p = sub.add_parser("bench", help="Time the fuzzy/embedding scorers against the KB and log the run")
+    p.add_argument("--cde-file", default="./KnowledgeBase/Compiled_CORE_CDEs list_English_one sheet_as of 2025-01-28.xlsx")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000],
+                   help="Synthetic study sizes in rows")
+    p.add_argument("--scorers", nargs="+", help="Default: every installed scorer")
+    p.add_argument("--strategies", nargs="+", choices=["pair", "extract", "cdist", "embed"],
+                   default=["pair", "extract", "cdist", "embed"])
+    p.add_argument("--max-seconds", type=float, default=20.0,
+                   help="Time limit per case; larger sizes are projected from the rows reached")
+    p.add_argument("--workers", type=int, default=-1, help="rapidfuzz cdist threads (-1 = all cores)")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--history", default="bench_history.json", help="JSON file the run is appended to")
+    p.add_argument("--no-history", action="store_true", help="Print the results without saving them")
+    p.set_defaults(handler=cmd_bench)
+
+    p = sub.add_parser("merge-quiz", help="Interactively merge near-duplicate Canonical CRF Names")
+    p.add_argument("workbook")
+    p.add_argument("-o", "--output", help="Output workbook (default: overwrite the input)")
+    p.add_argument("--sheet", default="EnhancedDD")
+    p.add_argument("--threshold", type=int, default=85, help="token_sort_ratio needed to propose a merge")
+    p.add_argument("--merges-file", default="confirmed_merges.csv", help="CSV of confirmed merges ('' to skip)")
+    p.add_argument("--crf-column", default="Form Name")
+    p.add_argument("--description-column", default="Field Label")
+    p.set_defaults(handler=cmd_merge_quiz)
+
+    p = sub.add_parser("confirm-quiz", help="Interactively confirm proposed HEAL Core CRF matches")
+    p.add_argument("workbook")
+    p.add_argument("-o", "--output", help="Output workbook (default: {workbook}_matches_confirmed.xlsx)")
+    p.add_argument("--sheet", default="EnhancedDD")
+    p.add_argument("--crf-column", default="Form Name")
+    p.add_argument("--grouped", action="store_true",
+                   help="Decide once per unique (Canonical CRF Name, match) proposal, largest first")
+    review = p.add_mutually_exclusive_group()
+    review.add_argument("--export-review", metavar="XLSX", help="Write the grouped proposals to a review sheet and stop")
+    review.add_argument("--import-review", metavar="XLSX", help="Apply a filled-in review sheet without prompting")
+    p.set_defaults(handler=cmd_confirm_quiz)
+
+    p = sub.add_parser("combine", help="Combine matched rows of every *_matches_confirmed.xlsx in a folder")
+    p.add_argument("folder", nargs="?", default="out")
+    p.add_argument("-o", "--output", default="combined_filtered_matches.xlsx")
+    p.add_argument("--sheet", default="EnhancedDD")
+    p.set_defaults(handler=cmd_combine)
+
+    p = sub.add_parser("convert", help="Convert a folder of CSV exports to XLSX and/or Parquet")
+    p.add_argument("input_dir")
+    p.add_argument("-o", "--output-dir", help="Where to save the .xlsx files (default: the input folder)")
+    p.add_argument("--processes", type=int, default=0, help="Worker processes (default: one per core)")
+    p.add_argument("--format", choices=["xlsx", "parquet", "both"], default="xlsx",
+                   help="parquet = the loader's sidecar next to the CSV, so no xlsx is needed")
+    p.add_argument("--force", action="store_true", help="Reconvert files the manifest says are unchanged")
+    p.set_defaults(handler=cmd_convert)
+
+    p = sub.add_parser("export", help="Write Metadata + EnhancedDD sheets from a normalized results workbook")
+    p.add_argument("workbook")
+    p.add_argument("-o", "--output", help="Output workbook (default: {workbook}_enhanced.xlsx)")
+    p.add_argument("--crf-column", default="Form Name")
+    p.set_defaults(handler=cmd_export)
+
+    p = with_config(sub.add_parser("serve", help="Local HTTP service: job queue + worker pool with a warm KB"))
+    p.add_argument("--host", help="Bind address (default: [Service] host or 127.0.0.1)")
+    p.add_argument("--port", type=int, help="Port (default: [Service] port or 8765)")
+    p.add_argument("--workers", type=int, help="Jobs run at the same time (default: [Service] workers or 2)")
+    p.add_argument("--max-api-concurrency", type=int,
+                   help="API calls in flight across all jobs (default: [Service] max_api_concurrency or 8)")
+    p.add_argument("--output-dir", help="Job folders (default: [Service] output_dir or out/service)")
+    p.add_argument("--cde-file", default="./KnowledgeBase/Compiled_CORE_CDEs list_English_one sheet_as of 2025-01-28.xlsx")
+    p.add_argument("--local", action="store_true", help="Answer LLM calls with the local stand-in endpoint")
+    p.set_defaults(handler=cmd_serve)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    args.handler(parser, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
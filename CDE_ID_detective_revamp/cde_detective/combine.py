@@ -0,0 +1,49 @@
+"""
+Combine the confirmed matches of every study into one filtered workbook.
+
+    cde-detective combine out/ -o combined_filtered_matches.xlsx
+"""
+import os
+
+import pandas as pd
+
+from .crf_catalog import NO_CRF_MATCH
+from .results import load_enhanced
+from .workbook import MATCH_COL
+
+CONFIRMED_SUFFIX = "_matches_confirmed.xlsx"
+
+
+def combine_confirmed(folder_path, output_file="combined_filtered_matches.xlsx", target_sheet="EnhancedDD",
+                      match_column=MATCH_COL):
+    """Rows with a HEAL Core CRF match from every *_matches_confirmed.xlsx in `folder_path`."""
+    filtered_rows = []
+
+    for filename in sorted(os.listdir(folder_path)):
+        if filename.endswith(CONFIRMED_SUFFIX):
+            file_path = os.path.join(folder_path, filename)
+
+            try:
+                df = load_enhanced(file_path, sheet_name=target_sheet)
+            except Exception as e:
+                print(f"Skipping {filename} due to error: {e}")
+                continue
+
+            # Filter rows where HEAL Core CRF Match is NOT "No CRF match"
+            df_filtered = df[df[match_column] != NO_CRF_MATCH].copy()
+
+            # Add file identifier column
+            df_filtered['Source_File'] = filename.replace(CONFIRMED_SUFFIX, '')
+
+            # Append to list
+            filtered_rows.append(df_filtered)
+
+    # Combine all filtered data
+    if filtered_rows:
+        combined_df = pd.concat(filtered_rows, ignore_index=True)
+        output_path = output_file if os.path.dirname(output_file) else os.path.join(folder_path, output_file)
+        combined_df.to_excel(output_path, index=False)
+        print(f"Filtered and combined file saved as: {output_path}")
+        return output_path
+    print("No matching data found in any files.")
+    return None
@@ -0,0 +1,238 @@
+"""
+Interactive confirmation of proposed HEAL Core CRF matches.
+
+    cde-detective confirm-quiz out/Study_2025-08-07.xlsx            # row by row
+    cde-detective confirm-quiz out/Study_2025-08-07.xlsx --grouped  # once per unique proposal
+    cde-detective confirm-quiz out/Study_2025-08-07.xlsx --export-review review.xlsx
+    cde-detective confirm-quiz out/Study_2025-08-07.xlsx --import-review review.xlsx
+"""
+import pandas as pd
+
+from .crf_catalog import HEAL_CORE_CRFS, NO_CRF_MATCH
+from .workbook import (
+    CANONICAL_COL,
+    MATCH_COL,
+    RATIONALE_COL,
+    build_metadata,
+    build_report,
+    text_width,
+    write_review_workbook,
+)
+
+# Your approved CRF choices:
+CRF_OPTIONS = HEAL_CORE_CRFS
+
+SKIP_ALL = object()
+
+# Review sheet columns (grouped mode)
+ROWS_COL = "Rows"
+FORMS_COL = "Forms"
+DECISION_COL = "Decision"
+KEEP_ANSWERS = {"y", "yes", "keep"}
+REJECT_ANSWERS = {"n", "no", "reject", NO_CRF_MATCH.lower()}
+
+
+def ask_choice(orig):
+    """Prompt once; returns the chosen CRF, None for 'no match', or SKIP_ALL."""
+    ans = input("Keep? [y]es / [n]o / [l]ist / [c]ustom / [s]kip all: ").strip().lower()
+    if ans == "s":
+        return SKIP_ALL
+    elif ans == "y":
+        return orig
+    elif ans == "c":
+        return input("Enter custom CRF name: ").strip()
+    elif ans == "l":
+        print("\nSelect from these CRF options:")
+        for i, opt in enumerate(CRF_OPTIONS, 1):
+            print(f"  {i}. {opt}")
+        sel = input("Enter number (or 0 to cancel): ").strip()
+        if sel.isdigit() and 1 <= int(sel) <= len(CRF_OPTIONS):
+            return CRF_OPTIONS[int(sel)-1]
+    return None
+
+
+def run_confirmation(df, crf_col="Form Name"):
+    # Row-by-row mode: repeats of a (canonical, match) pair are auto-applied
+    """Ask about every row with a proposed match; updates df[MATCH_COL] in place."""
+    to_check = df[df[MATCH_COL].astype(object).fillna(NO_CRF_MATCH) != NO_CRF_MATCH].index.tolist()
+    print(f"🔍 {len(to_check)} rows with proposed matches found.\n")
+    df[MATCH_COL] = df[MATCH_COL].astype(object)
+
+    decisions = {}
+
+    for idx in to_check:
+        canon = df.at[idx, CANONICAL_COL]
+        orig  = df.at[idx, MATCH_COL]
+        key   = (canon, orig)
+
+        # auto-apply
+        if key in decisions:
+            choice = decisions[key]
+            if choice is None:
+                df.at[idx, MATCH_COL] = NO_CRF_MATCH
+                print(f"↪ Auto-no for {canon} → {orig} (row {idx+2})\n")
+            else:
+                df.at[idx, MATCH_COL] = choice
+                print(f"↪ Auto-set {canon} → '{choice}' (row {idx+2})\n")
+            continue
+
+        # prompt
+        rationale = df.at[idx, RATIONALE_COL]
+        print(f"Row {idx+2}:")
+        print(f"  {crf_col.capitalize()}          → {df.at[idx, crf_col]}")
+        print(f"  Canonical CRF Name → {canon}")
+        print(f"  Proposed match     → {orig}")
+        print(f"  Rationale          → {rationale}\n")
+
+        choice = ask_choice(orig)
+        if choice is SKIP_ALL:
+            print("⏭ Skipping the rest.")
+            break
+
+        decisions[key] = choice
+        if choice is None:
+            df.at[idx, MATCH_COL] = NO_CRF_MATCH
+            print("✖ Marked as 'No CRF match'.\n")
+        else:
+            df.at[idx, MATCH_COL] = choice
+            print(f"✔ Set match to '{choice}'.\n")
+    return df
+
+
+# --- grouped mode: one decision per unique proposal ---------------------------------
+
+def _proposal_keys(df):
+    """(Canonical CRF Name, HEAL Core CRF Match) per row, as a MultiIndex aligned with df."""
+    canon = df[CANONICAL_COL].astype(object).fillna("") if CANONICAL_COL in df.columns else ""
+    return pd.MultiIndex.from_arrays(
+        [pd.Series(canon, index=df.index), df[MATCH_COL].astype(object).fillna(NO_CRF_MATCH)],
+        names=[CANONICAL_COL, MATCH_COL],
+    )
+
+
+def build_proposals(df, crf_col="Form Name", max_forms=5):
+    """
+    One row per unique (Canonical CRF Name, proposed HEAL Core CRF Match), with
+    the number of dictionary rows it covers, most rows first.
+    """
+    keys = _proposal_keys(df).to_frame(index=False)
+    keys[RATIONALE_COL] = df[RATIONALE_COL].astype(object).to_numpy() if RATIONALE_COL in df.columns else ""
+    keys[FORMS_COL] = df[crf_col].astype(str).to_numpy() if crf_col in df.columns else ""
+    keys = keys[keys[MATCH_COL] != NO_CRF_MATCH]
+    if keys.empty:
+        return pd.DataFrame(columns=[CANONICAL_COL, MATCH_COL, ROWS_COL, FORMS_COL, RATIONALE_COL, DECISION_COL])
+
+    grouped = keys.groupby([CANONICAL_COL, MATCH_COL], sort=False)
+    proposals = grouped.agg(**{
+        ROWS_COL: (MATCH_COL, "size"),
+        FORMS_COL: (FORMS_COL, lambda s: "; ".join(s.unique()[:max_forms])),
+        RATIONALE_COL: (RATIONALE_COL, "first"),
+    }).reset_index()
+    proposals[DECISION_COL] = ""
+    return proposals.sort_values(ROWS_COL, ascending=False, kind="stable").reset_index(drop=True)
+
+
+def run_grouped_confirmation(proposals):
+    """Ask once per proposal (largest first). Returns {(canonical, match): new match}."""
+    total = int(proposals[ROWS_COL].sum())
+    print(f"🔍 {len(proposals)} unique proposals covering {total} rows.\n")
+    decisions = {}
+    for n, p in enumerate(proposals.itertuples(index=False), 1):
+        canon, orig = p[0], p[1]
+        print(f"Proposal {n}/{len(proposals)} ({getattr(p, ROWS_COL)} rows):")
+        print(f"  Forms              → {getattr(p, FORMS_COL)}")
+        print(f"  Canonical CRF Name → {canon}")
+        print(f"  Proposed match     → {orig}")
+        print(f"  Rationale          → {getattr(p, RATIONALE_COL)}\n")
+
+        choice = ask_choice(orig)
+        if choice is SKIP_ALL:
+            print("⏭ Skipping the rest.")
+            break
+        decisions[(canon, orig)] = NO_CRF_MATCH if choice is None else choice
+        print(f"✔ {canon} → '{decisions[(canon, orig)]}'\n")
+    return decisions
+
+
+def export_review_sheet(proposals, path):
+    """
+    Write the proposals for offline/bulk review. Fill the Decision column with
+    y / n (or keep / reject) or a HEAL Core CRF name; blank leaves the proposal as is.
+    """
+    with pd.ExcelWriter(path, engine="xlsxwriter") as writer:
+        proposals.to_excel(writer, sheet_name="Review", index=False)
+        options = pd.DataFrame({"Answer": ["y", "n"] + CRF_OPTIONS})
+        options.to_excel(writer, sheet_name="Options", index=False)
+
+        ws = writer.sheets["Review"]
+        ws.freeze_panes(1, 0)
+        ws.autofilter(0, 0, len(proposals), proposals.shape[1] - 1)
+        for col_idx, col in enumerate(proposals.columns):
+            width = max(text_width(proposals[col]), len(col)) + 2
+            ws.set_column(col_idx, col_idx, min(width, 60))
+        decision_idx = proposals.columns.get_loc(DECISION_COL)
+        ws.data_validation(1, decision_idx, max(len(proposals), 1), decision_idx, {
+            "validate": "list",
+            "source": f"=Options!$A$2:$A${len(options) + 1}",
+            "error_type": "warning",  # custom names are still allowed
+        })
+    print(f"📝 Review sheet with {len(proposals)} proposals saved as {path}")
+
+
+def read_review_sheet(path):
+    """Decisions from a filled-in review sheet: {(canonical, match): new match}."""
+    from .crf_catalog import canonical_heal_crf
+
+    review = pd.read_excel(path, sheet_name="Review", dtype=str).fillna("")
+    decisions = {}
+    for canon, orig, answer in zip(review[CANONICAL_COL], review[MATCH_COL], review[DECISION_COL]):
+        answer = answer.strip()
+        if not answer:
+            continue
+        if answer.lower() in KEEP_ANSWERS:
+            decisions[(canon, orig)] = orig
+        elif answer.lower() in REJECT_ANSWERS:
+            decisions[(canon, orig)] = NO_CRF_MATCH
+        else:
+            decisions[(canon, orig)] = canonical_heal_crf(answer) or answer
+    print(f"📥 {len(decisions)} decisions read from {path} ({len(review) - len(decisions)} left blank)")
+    return decisions
+
+
+def apply_decisions(df, decisions):
+    """Apply {(canonical, match): new match} to every row in one vectorized map."""
+    new_match = _proposal_keys(df).map(decisions)
+    changed = new_match.notna()
+    df[MATCH_COL] = df[MATCH_COL].astype(object).where(~changed, new_match)
+    print(f"✔ Applied {len(decisions)} decisions to {int(changed.sum())} rows.")
+    return df
+
+
+def confirm_matches(input_file, output_file, sheet_name="EnhancedDD", crf_col="Form Name",
+                    grouped=False, export_review=None, import_review=None):
+    """
+    Confirm proposed matches and write the reviewed workbook.
+
+    grouped=True asks once per unique (Canonical CRF Name, match) proposal instead of
+    per row. export_review writes those proposals to a review sheet and stops;
+    import_review applies a filled-in review sheet without prompting.
+    """
+    from .results import load_enhanced
+
+    # 1) Load sheet
+    df = load_enhanced(input_file, sheet_name=sheet_name, categorical=[crf_col, CANONICAL_COL])
+
+    # 2) Interactive match-confirmation with list option
+    if export_review:
+        export_review_sheet(build_proposals(df, crf_col), export_review)
+        return None
+    if import_review:
+        apply_decisions(df, read_review_sheet(import_review))
+    elif grouped:
+        apply_decisions(df, run_grouped_confirmation(build_proposals(df, crf_col)))
+    else:
+        run_confirmation(df, crf_col)
+
+    # 3) Metadata sheet and “wide” report, 4) write all sheets (guarding Report)
+    write_review_workbook(output_file, df, build_metadata(df, crf_col), build_report(df, crf_col),
+                          sheet_name=sheet_name)
@@ -0,0 +1,177 @@
+"""
+CSV exports -> XLSX (and/or the loader's Parquet sidecar).
+
+Files are converted in a process pool. Rows stream from the csv reader into a
+constant-memory xlsxwriter workbook, so memory stays flat whatever the file
+size. A manifest in the output folder records each CSV's content hash and
+unchanged files are skipped on the next run. --format parquet writes the
+Parquet sidecar load_table() looks for next to the CSV, so the pipeline can
+read the CSV directly without an xlsx or a re-parse.
+
+    cde-detective convert in/ --processes 8 --format both
+"""
+import csv
+import glob
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .loader import CACHE_DIR_NAME, HAS_PYARROW, file_digest
+
+MANIFEST_NAME = ".convert_manifest.json"
+FORMATS = {"xlsx": ("xlsx",), "parquet": ("parquet",), "both": ("xlsx", "parquet")}
+
+_INT_RE = re.compile(r"-?(?:0|[1-9]\d{0,14})")
+_FLOAT_RE = re.compile(r"-?(?:\d+\.\d*|\.\d+)(?:[eE][-+]?\d+)?|-?\d+[eE][-+]?\d+")
+
+
+def _cell(value):
+    """Typed cell for the workbook: "" stays blank, plain numbers become numbers.
+    Text with leading zeros (record ids, codes) is kept as text."""
+    if value == "":
+        return None
+    if _INT_RE.fullmatch(value):
+        return int(value)
+    if _FLOAT_RE.fullmatch(value):
+        return float(value)
+    return value
+
+
+def write_xlsx(csv_path, out_path):
+    """Stream `csv_path` into a constant-memory workbook; returns the number of data rows."""
+    import xlsxwriter
+
+    tmp = f"{out_path}.tmp{os.getpid()}.xlsx"
+    workbook = xlsxwriter.Workbook(tmp, {"constant_memory": True, "strings_to_urls": False,
+                                         "strings_to_formulas": False})
+    worksheet = workbook.add_worksheet("Sheet1")
+    rows = 0
+    with open(csv_path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is not None:
+            worksheet.write_row(0, 0, header)
+        for rows, record in enumerate(reader, start=1):
+            worksheet.write_row(rows, 0, [_cell(v) for v in record])
+    workbook.close()
+    os.replace(tmp, out_path)
+    return rows
+
+
+def _cache_dir(csv_path):
+    return os.path.join(os.path.dirname(os.path.abspath(csv_path)), CACHE_DIR_NAME)
+
+
+def sidecar_path(csv_path, digest):
+    """Where write_parquet puts the sidecar for this version of `csv_path`."""
+    from .loader import _sidecar_prefix
+
+    return f"{_sidecar_prefix(csv_path, 0, _cache_dir(csv_path))}.{digest}.all.parquet"
+
+
+def write_parquet(csv_path):
+    """The sidecar load_table(csv_path) would write, without going through it."""
+    import pandas as pd
+
+    from .loader import _sidecar_prefix, _uniform_objects, _write_sidecar
+
+    cache_dir = _cache_dir(csv_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    df = _uniform_objects(pd.read_csv(csv_path))
+    return _write_sidecar(df, _sidecar_prefix(csv_path, 0, cache_dir), file_digest(csv_path), None)
+
+
+def _convert_one(csv_path, out_path, formats):
+    started = time.perf_counter()
+    rows = None
+    if "xlsx" in formats:
+        rows = write_xlsx(csv_path, out_path)
+    if "parquet" in formats:
+        write_parquet(csv_path)
+    return csv_path, rows, time.perf_counter() - started
+
+
+def _load_manifest(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _up_to_date(entry, digest, formats, csv_path, out_path):
+    """The manifest entry matches and every output it lists still exists (the cache may have been cleared)."""
+    return (
+        entry is not None
+        and entry.get("digest") == digest
+        and set(formats) <= set(entry.get("formats", []))
+        and ("xlsx" not in formats or os.path.exists(out_path))
+        and ("parquet" not in formats or os.path.exists(sidecar_path(csv_path, digest)))
+    )
+
+
+def convert_each_csv(input_folder, output_folder=None, processes=None, fmt="xlsx", force=False):
+    """
+    Convert every .csv in `input_folder` to {name}.xlsx in `output_folder`
+    (default: the input folder) and/or to its Parquet sidecar. Files whose
+    content hash matches the manifest from the previous run are skipped
+    unless `force`. Returns the paths that were converted.
+    """
+    output_folder = output_folder or input_folder
+    os.makedirs(output_folder, exist_ok=True)
+    formats = FORMATS[fmt]
+    if "parquet" in formats and not HAS_PYARROW:
+        raise RuntimeError("Parquet output needs pyarrow (pip install 'cde-detective[fast]')")
+
+    csv_paths = sorted(glob.glob(os.path.join(input_folder, "*.csv")))
+    if not csv_paths:
+        print(f"No CSV files found in {input_folder}")
+        return []
+
+    manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+    manifest = _load_manifest(manifest_path)
+    jobs, digests = [], {}
+    for csv_path in csv_paths:
+        name = os.path.basename(csv_path)
+        out_path = os.path.join(output_folder, os.path.splitext(name)[0] + ".xlsx")
+        digests[csv_path] = file_digest(csv_path)
+        if not force and _up_to_date(manifest.get(name), digests[csv_path], formats, csv_path, out_path):
+            continue
+        jobs.append((csv_path, out_path))
+    print(f"[Convert] {len(csv_paths)} CSV files, {len(csv_paths) - len(jobs)} unchanged since the last run")
+
+    started = time.perf_counter()
+    converted = []
+    processes = min(processes or os.cpu_count() or 1, len(jobs) or 1)
+
+    def record(csv_path, rows, seconds):
+        name = os.path.basename(csv_path)
+        manifest[name] = {"digest": digests[csv_path], "formats": sorted(formats)}
+        converted.append(csv_path)
+        size = f"{rows:,} rows, " if rows is not None else ""
+        print(f"✅ Converted `{name}` ({size}{seconds:.1f}s)")
+
+    if processes == 1:
+        for csv_path, out_path in jobs:
+            try:
+                record(*_convert_one(csv_path, out_path, formats))
+            except Exception as e:
+                print(f"⚠️ Skipping {csv_path!r}: {e}")
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = {pool.submit(_convert_one, csv_path, out_path, formats): csv_path
+                       for csv_path, out_path in jobs}
+            for future in as_completed(futures):
+                try:
+                    record(*future.result())
+                except Exception as e:
+                    print(f"⚠️ Skipping {futures[future]!r}: {e}")
+
+    tmp = f"{manifest_path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, manifest_path)
+    print(f"[Convert] {len(converted)} files on {processes} processes in {time.perf_counter() - started:.1f}s")
+    return converted
@@ -0,0 +1,148 @@
+"""
+The HEAL Core CRF labels the matcher is allowed to return.
+
+Keep this list in sync with `matching_instruction` in config_prestep.ini.
+"""
+
+import re
+
+NO_CRF_MATCH = "No CRF match"
+
+HEAL_CORE_CRFS = [
+    "Brief Pain Inventory (BPI)",
+    "BPI Pain Interference",
+    "BPI Pain Severity",
+    "Demographics",
+    "GAD2 Pain (Generalized Anxiety Disorder)",
+    "GAD7",
+    "NIDAL2 (NIDA Modified ASSIST L2)",
+    "PCS6 (Pain Catastrophizing Scale)",
+    "PCS13",
+    "PCS Child",
+    "PCS Parent",
+    "PedsQL (Pediatric Quality of Life Inventory)",
+    "PEG Pain",
+    "PGIC Pain(Patient Global Impression of Change Pain)",
+    "PGIS (Patient Global Impression of Severity)",
+    "PHQ2 (Patient Health Questionnaire 2)",
+    "PHQ8",
+    "PHQ9",
+    "PROMIS PF Pain (PROMIS Physical Function Pain)",
+    "PROMIS PF Pain 6b (PROMIS Physical Function Pain 6b)",
+    "PROMIS Sleep Disturbance 6a",
+    "Sleep Duration Pain",
+    "SleepASWS (Adolescent Sleep Wake Scale)",
+    "TAPS Pain",
+    "WHOQOL2",
+]
+
+CONFIDENCE_LEVELS = ["High", "Medium", "Low"]
+
+
+def confidence_from_probability(p):
+    """Map a classifier probability onto CONFIDENCE_LEVELS."""
+    return "High" if p >= 0.9 else "Medium" if p >= 0.7 else "Low"
+
+
+def _short_label(name: str) -> str:
+    """'PHQ2 (Patient Health Questionnaire 2)' -> 'phq2'"""
+    return name.split("(")[0].strip().lower()
+
+
+def _compact(text):
+    return re.sub(r"[^a-z0-9]", "", text.lower())
+
+
+def _keys(name):
+    """Compact lookup keys: whole name, text before '(' and text inside '(...)'."""
+    keys = [_compact(name), _compact(name.split("(")[0])]
+    keys += [_compact(p) for p in re.findall(r"\(([^)]*)\)", name)]
+    return [k for k in keys if k]
+
+
+_BY_LOWER = {c.lower(): c for c in HEAL_CORE_CRFS}
+_BY_SHORT = {_short_label(c): c for c in HEAL_CORE_CRFS}
+_BY_KEY = {k: c for c in HEAL_CORE_CRFS for k in _keys(c)}
+_first_tokens = [_compact(c.split()[0].split("(")[0]) for c in HEAL_CORE_CRFS]
+_BY_FIRST_TOKEN = {
+    t: c for t, c in zip(_first_tokens, HEAL_CORE_CRFS) if _first_tokens.count(t) == 1
+}
+
+
+def canonical_heal_crf(name):
+    """
+    Map a model answer onto the official HEAL Core CRF label.
+    Accepts exact, case-insensitive, short-label ("PCS6") and punctuation/space
+    variants ("PCS-13", "GAD 7"); returns None when the answer is not one of the
+    allowed labels.
+    """
+    if not isinstance(name, str):
+        return None
+    name = name.strip()
+    if name.lower() == NO_CRF_MATCH.lower():
+        return NO_CRF_MATCH
+    found = _BY_LOWER.get(name.lower()) or _BY_SHORT.get(_short_label(name))
+    if found:
+        return found
+    for key in _keys(name):
+        if key in _BY_KEY:
+            return _BY_KEY[key]
+    return None
+
+
+def loose_heal_crf(name):
+    """
+    Like canonical_heal_crf, but also reads reviewer notes ("No HEAL CRF Match,
+    related topic" -> No CRF match) and falls back to an unambiguous leading
+    token ("PHQ2 Pain" -> PHQ2). Meant for labelling historical validation
+    sheets, not for checking model answers.
+    """
+    if not isinstance(name, str) or not name.strip():
+        return None
+    if re.match(r"\s*no\b", name, flags=re.IGNORECASE):
+        return NO_CRF_MATCH
+    found = canonical_heal_crf(name)
+    if found:
+        return found
+    for key in _keys(name) + [_compact(name.split()[0].split("(")[0])]:
+        if key in _BY_FIRST_TOKEN:
+            return _BY_FIRST_TOKEN[key]
+    return None
+
+
+# HEAL Core CRF label (as returned by the matcher) -> `CRF Name` values used in
+# the master sheet (Compiled_CORE_CDEs ... 'ALL'). The full BPI also covers its
+# two subscales; PHQ2 appears under two names in the master sheet.
+HEAL_TO_MASTER_CRF = {
+    "Brief Pain Inventory (BPI)": ["Brief Pain Inventory (BPI)", "BPI Pain Interference", "BPI Pain Severity"],
+    "BPI Pain Interference": ["BPI Pain Interference"],
+    "BPI Pain Severity": ["BPI Pain Severity"],
+    "Demographics": ["Demographics"],
+    "GAD2 Pain (Generalized Anxiety Disorder)": ["GAD2 Pain"],
+    "GAD7": ["GAD7"],
+    "NIDAL2 (NIDA Modified ASSIST L2)": ["NIDAL2"],
+    "PCS6 (Pain Catastrophizing Scale)": ["PCS-6"],
+    "PCS13": ["PCS-13"],
+    "PCS Child": ["PCS-Child"],
+    "PCS Parent": ["PCS-Parent"],
+    "PedsQL (Pediatric Quality of Life Inventory)": ["PedsQL Inventory"],
+    "PEG Pain": ["PEG Pain"],
+    "PGIC Pain(Patient Global Impression of Change Pain)": ["PGIC Pain"],
+    "PGIS (Patient Global Impression of Severity)": ["PGIS"],
+    "PHQ2 (Patient Health Questionnaire 2)": ["Patient Health Questionnaire 2 (PHQ2)", "PHQ2 Pain"],
+    "PHQ8": ["PHQ8"],
+    "PHQ9": ["PHQ9"],
+    "PROMIS PF Pain (PROMIS Physical Function Pain)": ["PROMIS PF Pain"],
+    "PROMIS PF Pain 6b (PROMIS Physical Function Pain 6b)": ["PROMIS PF Pain 6b"],
+    "PROMIS Sleep Disturbance 6a": ["PROMIS Sleep Disturbance 6a"],
+    "Sleep Duration Pain": ["Sleep Duration Pain"],
+    "SleepASWS (Adolescent Sleep Wake Scale)": ["SleepASWS"],
+    "TAPS Pain": ["TAPS Pain"],
+    "WHOQOL2": ["WHOQOL2"],
+}
+
+
+def master_crf_names(heal_match):
+    """Master-sheet CRF Names for a HEAL match answer ([] for no/unknown match)."""
+    crf = canonical_heal_crf(heal_match)
+    return HEAL_TO_MASTER_CRF.get(crf, [])
@@ -0,0 +1,364 @@
+"""
+Variable-level search: compare study encodings + field labels with the HEAL CDE
+master sheet using fuzzy token-based similarity.
+"""
+import json
+import os
+
+import pandas as pd
+from fuzzywuzzy import fuzz
+
+from .crf_catalog import master_crf_names
+from .loader import load_table
+from .normalize import normalize, normalize_series
+from .results import load_enhanced
+
+DEFAULT_CDE_FILE = './KnowledgeBase/Compiled_CORE_CDEs list_English_one sheet_as of 2025-01-28.xlsx'
+DEFAULT_FLATTENED_FILE = './KnowledgeBase/All_HEALPAINCDEsDD_flattened.json'
+
+MATCH_COLUMNS = [
+    'Best Match CDE Name', 'Best Match Score', 'Best Match CRF Name',
+    'Potential Match 2 - CDE Name', 'Potential Match 2 - Score', 'Potential Match 2 - CRF Name',
+    'Potential Match 3 - CDE Name', 'Potential Match 3 - Score', 'Potential Match 3 - CRF Name'
+]
+
+# 'Search Scope' of rows whose CDE came from the form signature index (see signatures.py)
+SIGNATURE_SCOPE = 'Signature index'
+# 'Search Scope' of rows whose field label is a known question stem (score 100, no fuzzy scoring)
+EXACT_SCOPE = 'Exact stem'
+# Fields of the flattened HEAL CDE dictionary that hold alternative wordings of a CDE
+STEM_VARIANT_FIELDS = ['CDE Name', 'Short Description', 'Definition']
+# Shorter stems ("race", "white", "not reported") are answer options or generic
+# labels shared by many instruments; they go through the fuzzy search instead
+MIN_STEM_WORDS = 3
+
+KB_COLUMNS = ['Variable Name', 'CRF Name', 'PV Description', 'Additional Notes (Question Text)']
+
+
+def similarity_score(str1, str2):
+    """
+    Calculate token-based fuzzy similarity between two strings.
+    100% means an exact match, 0% means completely different.
+    """
+    return fuzz.token_set_ratio(str1, str2)
+
+
+def load_cde_kb(cde_file=DEFAULT_CDE_FILE):
+    """Load the master CDE sheet and add the 'Normalized Combined' search text."""
+    cde_df = load_table(cde_file, sheet_name='ALL', usecols=KB_COLUMNS)
+    cde_df = cde_df.dropna(subset=['PV Description', 'Additional Notes (Question Text)'])
+    cde_df['Normalized Combined'] = normalize_series(
+        cde_df['Additional Notes (Question Text)'].fillna('') + " | " + cde_df['PV Description'].fillna(''),
+        "encoding",
+    )
+    return cde_df
+
+
+def partition_cde_kb(cde_df):
+    """
+    Split the knowledge base by CRF Name.
+    Returns {crf_name: [(variable_name, normalized_text, crf_name), ...]} plus
+    the same list for the whole sheet under the key None.
+    """
+    def rows(df):
+        return list(zip(df['Variable Name'], df['Normalized Combined'], df['CRF Name']))
+
+    partitions = {None: rows(cde_df)}
+    crf_keys = cde_df['CRF Name'].astype(str).str.strip()
+    for crf, part in cde_df.groupby(crf_keys, sort=False):
+        partitions[crf] = rows(part)
+    return partitions
+
+
+def build_stem_index(cde_df, flattened_file=DEFAULT_FLATTENED_FILE):
+    """
+    Exact-lookup index of canonical question stems (normalize profile "stem"):
+    {stem: [(variable_name, crf_name), ...]} from the KB's question texts plus the
+    variant wordings of the same variables in the flattened HEAL CDE dictionary.
+    Variables the KB does not list are left out (there is no CRF Name for them),
+    and so are stems of fewer than MIN_STEM_WORDS words.
+    """
+    index = {}
+
+    def add(text, name, crf):
+        stem = normalize(text, "stem")
+        if stem and len(stem.split()) >= MIN_STEM_WORDS and (name, crf) not in index.setdefault(stem, []):
+            index[stem].append((name, crf))
+
+    crfs_by_name = {}
+    for name, text, crf in zip(cde_df['Variable Name'], cde_df['Additional Notes (Question Text)'],
+                               cde_df['CRF Name']):
+        add(text, name, crf)
+        crfs_by_name.setdefault(name, []).append(crf)
+
+    if flattened_file and os.path.exists(flattened_file):
+        with open(flattened_file, encoding='utf-8') as f:
+            for entry in json.load(f):
+                for crf in dict.fromkeys(crfs_by_name.get(entry.get('Variable Name'), [])):
+                    for field in STEM_VARIANT_FIELDS:
+                        for text in entry.get(field) or []:
+                            add(text, entry['Variable Name'], crf)
+    return index
+
+
+def exact_matches(stem, heal_match, stem_index):
+    """
+    Score-100 matches for a known stem among the CDEs of the row's HEAL match
+    partition; None when the stem is unknown there (or the row has no partition),
+    so the row goes through search_row like any other.
+    """
+    partition = set(master_crf_names(heal_match))
+    hits = [hit for hit in stem_index.get(stem) or [] if str(hit[1]).strip() in partition] if stem else None
+    if not hits:
+        return None
+    unique_matches, seen = [], set()
+    for name, crf in hits:
+        if name not in seen:
+            unique_matches.append((name, 100, crf))
+            seen.add(name)
+    return unique_matches
+
+
+def rank_candidates(text, candidates):
+    """
+    Score `text` against candidates and return [(name, score, crf), ...],
+    best first, one entry per CDE variable name.
+    """
+    scored = [(name, similarity_score(text, norm), crf) for name, norm, crf in candidates]
+    scored.sort(key=lambda x: x[1], reverse=True)
+    unique_matches, seen = [], set()
+    for name, score, crf in scored:
+        if name not in seen:
+            unique_matches.append((name, score, crf))
+            seen.add(name)
+    return unique_matches
+
+
+def search_row(text, heal_match, partitions, fallback_threshold=70):
+    """
+    Search the matched CRF's partition first; fall back to the whole sheet only
+    when there is no partition or its best score is below `fallback_threshold`.
+    Returns (ranked matches, search scope).
+    """
+    candidates = [c for crf in master_crf_names(heal_match) for c in partitions.get(crf, [])]
+    if candidates:
+        ranked = rank_candidates(text, candidates)
+        if ranked and ranked[0][1] >= fallback_threshold:
+            return ranked, 'CRF partition'
+        return rank_candidates(text, partitions[None]), 'Global (weak partition match)'
+    return rank_candidates(text, partitions[None]), 'Global'
+
+
+def load_study(study_file, encoding_column, field_label_column, study_sheet='Sheet1'):
+    """
+    Load a study dictionary, set aside its 'No CRF match' rows and add the
+    'Normalized Combined' search text. Returns (study_df, skipped_df).
+    """
+    full_study_df = load_enhanced(study_file, sheet_name=study_sheet)
+
+    # Filter out 'No CRF match rows'
+    if 'HEAL Core CRF Match' in full_study_df.columns:
+        skipped_df = full_study_df[full_study_df['HEAL Core CRF Match'] == 'No CRF match'].copy()
+        study_df = full_study_df[full_study_df['HEAL Core CRF Match'] != 'No CRF match'].copy()
+        print(f"Processing {len(study_df)} rows; skipping {len(skipped_df)} rows (No CRF match).")
+    else:
+        skipped_df = pd.DataFrame()
+        study_df = full_study_df.copy()
+
+    # Initialize new columns for matches (keeping CDE names reused from the form signature index)
+    reused = (study_df['Search Scope'] == SIGNATURE_SCOPE) if 'Search Scope' in study_df.columns else None
+    for col in MATCH_COLUMNS + ['Search Scope']:
+        if reused is not None and reused.any() and col in study_df.columns:
+            study_df[col] = study_df[col].astype(object).where(reused, None)
+        else:
+            study_df[col] = None
+
+    # Normalize study encodings and field labels
+    both = study_df[encoding_column].notna() & study_df[field_label_column].notna()
+    combined = study_df[encoding_column].astype(object).where(both, '').astype(str) + " | " \
+        + study_df[field_label_column].astype(object).where(both, '').astype(str)
+    study_df['Normalized Combined'] = normalize_series(combined, "encoding").where(both, '')
+    if reused is not None:
+        study_df.loc[reused, 'Normalized Combined'] = ''
+    return study_df, skipped_df
+
+
+def question_stems(study_df, field_label_column):
+    """Canonical stems of the study's field labels, aligned with study_df rows."""
+    return normalize_series(study_df[field_label_column], "stem").tolist()
+
+
+def search_texts(texts, heal_matches, partitions, fallback_threshold=70, stems=None, stem_index=None):
+    """
+    search_row for each normalized text (heal_matches may be None for a
+    global search). Rows whose stem is in `stem_index` (build_stem_index)
+    under a CRF of their HEAL match resolve there with score 100 and skip
+    the fuzzy scorer.
+    Returns [(top three matches, scope) or None, ...].
+    """
+    results = []
+    for i, text in enumerate(texts):
+        if text == '':
+            results.append(None)
+            continue
+        heal_match = heal_matches[i] if heal_matches is not None else None
+        if stem_index:
+            exact = exact_matches(stems[i], heal_match, stem_index)
+            if exact:
+                results.append((exact[:3], EXACT_SCOPE))
+                continue
+        unique_matches, scope = search_row(text, heal_match, partitions, fallback_threshold=fallback_threshold)
+        results.append((unique_matches[:3], scope))
+    return results
+
+
+def apply_matches(study_df, results):
+    """Write search_texts results (in study_df row order) into the match columns."""
+    scopes = {}
+    for idx, result in zip(study_df.index, results):
+        if result is None:
+            continue
+        unique_matches, scope = result
+        scopes[scope] = scopes.get(scope, 0) + 1
+        if not unique_matches:
+            continue
+
+        # Save matches
+        best_match, best_score, best_crf_name = unique_matches[0]
+        study_df.at[idx, 'Best Match CDE Name'] = best_match
+        study_df.at[idx, 'Best Match Score'] = best_score
+        study_df.at[idx, 'Best Match CRF Name'] = best_crf_name
+        study_df.at[idx, 'Search Scope'] = scope
+        for i, (match_name, match_score, crf_name) in enumerate(unique_matches[1:3], start=2):
+            study_df.at[idx, f'Potential Match {i} - CDE Name'] = match_name
+            study_df.at[idx, f'Potential Match {i} - Score'] = match_score
+            study_df.at[idx, f'Potential Match {i} - CRF Name'] = crf_name
+    return scopes
+
+
+def save_results(study_df, skipped_df, study_file, output_dir='out', cde_file=DEFAULT_CDE_FILE):
+    """
+    Append the skipped rows back (empty match columns) and write {study}_vlmd_cdesearch.xlsx,
+    stamped with the version and checksum of `cde_file` (see kb_versions).
+    """
+    from .kb_versions import kb_stamp, stamp_workbook
+
+    # ✅ --- 7. Merge skipped rows back with empty match columns ---
+    for col in MATCH_COLUMNS + ['Search Scope']:
+        if col not in skipped_df.columns:
+            skipped_df[col] = None
+    if 'Normalized Combined' not in skipped_df.columns:
+        skipped_df['Normalized Combined'] = None
+
+    final_df = pd.concat([study_df, skipped_df], ignore_index=True)
+
+    # --- 8. Save results ---
+    output_base = os.path.basename(study_file).rsplit('.', 1)[0]
+    output_file = os.path.join(output_dir, f"{output_base}_vlmd_cdesearch.xlsx")
+    with pd.ExcelWriter(output_file, engine='xlsxwriter') as writer:
+        final_df.to_excel(writer, index=False)
+        if os.path.exists(cde_file):
+            stamp_workbook(writer, kb_stamp(cde_file))
+    print(f"Comparison complete. Results saved to {output_file}.")
+    return output_file
+
+
+def compare_encodings(
+    study_file,
+    encoding_column='encodings',
+    field_label_column='field_label',
+    cde_file=DEFAULT_CDE_FILE,
+    study_sheet='Sheet1',
+    partitioned=True,
+    fallback_threshold=70,
+    output_dir='out',
+    partitions=None,
+    stem_index=None,
+    exact_stems=True,
+):
+    """
+    Compare study data dictionary encodings and field labels with HEAL CDE encodings using fuzzy token-based similarity.
+
+    Parameters:
+    - study_file: Path to the study data dictionary file (.xlsx or .csv).
+    - encoding_column: Name of the column containing encodings in the study file.
+    - field_label_column: Name of the column containing field labels in the study file.
+    - cde_file: Path to the HEAL CDE knowledge base file (.xlsx).
+    - study_sheet: Name of the sheet in the study file to process (default is 'Sheet1').
+    - partitioned: Search only the CDEs of the row's HEAL Core CRF Match first (default True).
+    - fallback_threshold: Best in-partition score below which the whole sheet is searched.
+    - output_dir: Folder for the {study}_vlmd_cdesearch.xlsx result (default 'out').
+    - partitions: Already-built partition_cde_kb() result; cde_file is not read when given.
+    - stem_index: Already-built build_stem_index() result.
+    - exact_stems: Resolve field labels that are known question stems before fuzzy scoring (default True).
+
+    Returns:
+    - str: Path of the workbook with the original study data and match results.
+
+    See parallel_encodings.compare_encodings_parallel for many files or very large ones.
+    """
+    study_df, skipped_df = load_study(study_file, encoding_column, field_label_column, study_sheet)
+
+    # Load, normalize and partition HEAL CDE encodings
+    if partitions is None or (exact_stems and stem_index is None):
+        cde_df = load_cde_kb(cde_file)
+        partitions = partitions or partition_cde_kb(cde_df)
+        if exact_stems and stem_index is None:
+            stem_index = build_stem_index(cde_df)
+    if not exact_stems:
+        stem_index = None
+    has_match_col = partitioned and 'HEAL Core CRF Match' in study_df.columns
+
+    # Run comparisons only on filtered rows
+    heal_matches = study_df['HEAL Core CRF Match'].tolist() if has_match_col else None
+    stems = question_stems(study_df, field_label_column) if stem_index else None
+    results = search_texts(study_df['Normalized Combined'].tolist(), heal_matches, partitions,
+                           fallback_threshold=fallback_threshold, stems=stems, stem_index=stem_index)
+    scopes = apply_matches(study_df, results)
+    print(f"Search scopes: {scopes}")
+
+    return save_results(study_df, skipped_df, study_file, output_dir, cde_file)
+
+
+def color_code_results(output_file):
+    """
+    Insert a 'Confidence Level' column after 'Best Match Score' and color the
+    score cells: green >= 80, orange 51-79, red otherwise.
+    """
+    from openpyxl import load_workbook
+    from openpyxl.styles import PatternFill
+
+    wb = load_workbook(output_file)
+    ws = wb.active
+
+    # Find "Best Match Score" column
+    best_match_score_col = None
+    for idx, cell in enumerate(ws[1], start=1):
+        if cell.value == "Best Match Score":
+            best_match_score_col = idx
+            break
+
+    if best_match_score_col:
+        # Insert Confidence Level column
+        confidence_col_idx = best_match_score_col + 1
+        ws.insert_cols(confidence_col_idx)
+        ws.cell(row=1, column=confidence_col_idx).value = "Confidence Level"
+
+        for row_idx, row in enumerate(ws.iter_rows(min_row=2, min_col=best_match_score_col,
+                                                   max_col=best_match_score_col), start=2):
+            for cell in row:
+                score = cell.value
+                confidence_cell = ws.cell(row=row_idx, column=confidence_col_idx)
+                if score is not None:
+                    if score >= 80:
+                        confidence_cell.value = "High confidence"
+                        cell.fill = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
+                    elif 51 <= score <= 79:
+                        confidence_cell.value = "Medium confidence"
+                        cell.fill = PatternFill(start_color="FFEB9C", end_color="FFEB9C", fill_type="solid")
+                    else:
+                        confidence_cell.value = "Low confidence"
+                        cell.fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
+
+    wb.save(output_file)
+    print(f"Color coding and confidence levels applied to {output_file}!")
@@ -0,0 +1,289 @@
+"""
+Harmonizer: collapse refined CRF names into canonical labels.
+"""
+import asyncio
+import json
+import time
+
+import pandas as pd
+from rapidfuzz import fuzz
+
+from .budget import BudgetExhausted, mark_degraded
+from .normalize import normalize
+from .offload import in_process, output
+from .prestep import is_rate_limit
+from .prompts import STAGE_BUDGETS, compile_messages, count_tokens, fit_items
+from .structured import (
+    HARMONIZE_SCHEMA,
+    PARSE_STATS,
+    HarmonizeResponse,
+    StructuredOutputError,
+    structured_completion,
+)
+
+HARMONIZER_MODEL = "gpt-4.1-mini"
+
+
+def auto_cluster_names(names, threshold=70, counts=None, groups=None):
+    """
+    Clusters similar names using fuzzy matching and assigns the most frequent as canonical.
+    `counts` optionally weights each name (e.g. by row count) when picking the canonical.
+    `groups` optionally maps each name to the set of groups (e.g. harmonizer batches)
+    it came from; names sharing a group are never put in the same cluster.
+    Returns a dict: {original_name: canonical_name}
+    """
+    clusters = []
+    mapping = {}
+    name_counts = counts if counts is not None else pd.Series(names).value_counts().to_dict()
+    # lowercase, no punctuation, generic words like "form" dropped
+    normalized_names = {name: normalize(name, "crf_core") for name in names}
+    for name in names:
+        found_cluster = False
+        for cluster in clusters:
+            if groups is not None and any(groups.get(name, set()) & groups.get(c, set()) for c in cluster):
+                continue
+            if any(fuzz.ratio(normalized_names[name], normalized_names[c]) >= threshold for c in cluster):
+                cluster.append(name)
+                found_cluster = True
+                break
+        if not found_cluster:
+            clusters.append([name])
+    for cluster in clusters:
+        canonical = max(cluster, key=lambda x: name_counts.get(x, 0))
+        for name in cluster:
+            mapping[name] = canonical
+    return mapping
+
+
+def batcher(seq, size=20):
+    """Yield successive size-sized chunks from seq."""
+    for pos in range(0, len(seq), size):
+        yield seq[pos:pos + size]
+
+
+def block_entries(entries, size=20, threshold=80, budget=None):
+    """
+    Pre-block harmonizer entries so fuzzy-similar names land in the same batch.
+    Greedy leader clustering on normalized names, then blocks are packed
+    (in name order) into batches of at most `size` entries and, with `budget`,
+    at most that many tokens of serialized entries.
+    """
+    blocks = []  # [(leader_norm, [entries])]
+    for e in entries:
+        norm = normalize(str(e["original"]), "crf_core")
+        for leader, members in blocks:
+            if fuzz.token_sort_ratio(norm, leader) >= threshold:
+                members.append(e)
+                break
+        else:
+            blocks.append((norm, [e]))
+    blocks.sort(key=lambda b: b[0])
+
+    batches, current, current_tokens = [], [], 0
+    for _, members in blocks:
+        for part in batcher(members, size):
+            if current and len(current) + len(part) > size:
+                batches.append(current)
+                current, current_tokens = [], 0
+            for e in part:
+                entry_tokens = count_tokens(json.dumps(e, ensure_ascii=False)) + 1 if budget else 0
+                if current and budget and current_tokens + entry_tokens > budget:
+                    batches.append(current)
+                    current, current_tokens = [], 0
+                current.append(e)
+                current_tokens += entry_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def harmonize_messages(entries, instruction):
+    """
+    The harmonizer reads the entries as one bare JSON array. Entries past the
+    harmonize budget are left out (they keep their names) rather than cutting the
+    JSON text; block_entries already packs live batches to fit.
+    """
+    entries = fit_items(entries, "harmonize")
+    return compile_messages("harmonize", instruction, {"": json.dumps(entries, ensure_ascii=False)},
+                            dedupe=False, clean=False, truncate=False)
+
+
+async def harmonize_with_retry(client, entries, instruction, what, tries=5, stats=None):
+    """
+    One harmonizer call with the prestep/match retry policy: unrepairable replies
+    are asked again, other errors (rate limits, timeouts) after a doubling backoff.
+    BudgetExhausted and the last attempt's error are raised to the caller.
+    """
+    stats = stats or PARSE_STATS
+    backoff = 1
+    for attempt in range(1, tries + 1):
+        try:
+            return await structured_completion(
+                client,
+                HARMONIZER_MODEL,
+                harmonize_messages(entries, instruction),
+                "harmonize_crf_names",
+                HARMONIZE_SCHEMA,
+                HarmonizeResponse,
+                temperature=0,
+                stats=stats,
+            )
+        except BudgetExhausted:
+            raise
+        except StructuredOutputError as e:
+            output.info(f"[parse] {what} attempt {attempt} unrepairable: {e}")
+            if attempt == tries:
+                raise
+            stats.parse_retries += 1
+        except Exception as e:
+            if is_rate_limit(e):
+                output.info(f"[rate limit] {what} attempt {attempt}, sleeping {backoff}s")
+            else:
+                output.info(f"[warning] {what} failed attempt {attempt}: {e}")
+            if attempt == tries:
+                raise
+            await asyncio.sleep(backoff)
+            backoff *= 2
+
+
+async def _harmonize_batch(client, batch, batch_num, instruction, semaphore, stats=None):
+    """
+    Map phase: harmonize one pre-blocked batch (harmonize_with_retry). Falls back
+    to identity once the retries are used up.
+    Returns (mapping, whether the API budget cut the call off).
+    """
+    degraded = False
+    async with semaphore:
+        output.info(f"\n[Harmonizer] Sending batch {batch_num} of {len(batch)}:")
+        for e in batch:
+            output.info(f"    {e}")
+
+        mapping = {}
+        try:
+            result, full = await harmonize_with_retry(client, batch, instruction, f"harmonize batch {batch_num}",
+                                                      stats=stats)
+            output.info(f"\n[Harmonizer] Raw model message (batch {batch_num}):")
+            output.info(full)
+            mapping = result.as_dict()
+        except BudgetExhausted:
+            output.info(f"[Harmonizer] Budget exhausted; batch {batch_num} keeps its names for the local reduce.")
+            degraded = True
+        except StructuredOutputError as e:
+            output.info(f"[Harmonizer] Unrepairable response for batch {batch_num}: {e}")
+        except Exception as e:
+            output.info(f"[Harmonizer] Batch {batch_num} failed: {e}")
+
+    # Fallback to identity for anything the model left out
+    originals = {e["original"] for e in batch}
+    mapping = {k: v for k, v in mapping.items() if k in originals}
+    if not mapping:
+        output.info(f"[Harmonizer] Empty mapping for batch {batch_num}; defaulting to identity.")
+    for orig in originals:
+        mapping.setdefault(orig, orig)
+    return mapping, degraded
+
+
+async def _reduce_labels_llm(client, labels, instruction, stats=None):
+    """
+    Reduce phase (LLM): one small call over the unique batch labels only.
+    Returns None when the API budget cut the call off (the caller reduces locally).
+    """
+    payload = [{"original": label, "rationale": ""} for label in labels]
+    try:
+        result, _ = await harmonize_with_retry(client, payload, instruction, "harmonize reduce", stats=stats)
+        mapping = result.as_dict()
+    except BudgetExhausted:
+        output.info("[Harmonizer] Budget exhausted; reducing labels locally.")
+        return None
+    except Exception as e:
+        output.info(f"[Harmonizer] Reduce call failed ({e}); keeping batch labels.")
+        mapping = {}
+    return {label: mapping.get(label, label) for label in labels}
+
+
+async def harmonize_crf_names_step(client, refined_df, instruction, batch_size=20,
+                                   reduce="local", reduce_threshold=90,
+                                   block_threshold=80, max_concurrency=10, stats=None):
+    """
+    Map-reduce harmonizer.
+    Map: fuzzy-blocked batches of unique (name, rationale) entries are sent concurrently.
+    Reduce: per-batch labels are reconciled across batches, either with a local
+    clustering pass (reduce="local") or one small LLM call (reduce="llm"). Labels
+    from the same batch are kept apart (the model already decided on them), and
+    a single batch has nothing to reconcile.
+    """
+    # Build and dedupe the payload
+    seen = set()
+    unique_entries = []
+    for orig, rat in zip(refined_df["Refined CRF Name"], refined_df["Rationale"]):
+        key = (orig, rat)
+        if key not in seen:
+            seen.add(key)
+            unique_entries.append({"original": orig, "rationale": rat})
+
+    if not unique_entries:
+        refined_df["Canonical CRF Name"] = refined_df["Refined CRF Name"]
+        output.info("[Harmonizer] No entries to harmonize, using identity mapping.")
+        return refined_df
+
+    # Map: all batches in flight at once
+    batches = block_entries(unique_entries, size=batch_size, threshold=block_threshold,
+                            budget=STAGE_BUDGETS.get("harmonize"))
+    semaphore = asyncio.Semaphore(max_concurrency)
+    started = time.perf_counter()
+    answers = await asyncio.gather(*[
+        _harmonize_batch(client, batch, batch_num, instruction, semaphore, stats)
+        for batch_num, batch in enumerate(batches, start=1)
+    ])
+    output.info(f"\n[Harmonizer] Map phase: {len(batches)} batches in {time.perf_counter() - started:.1f}s")
+
+    combined_mapping, degraded_names, label_batches = {}, set(), {}
+    for batch_num, ((mapping, degraded), batch) in enumerate(zip(answers, batches), start=1):
+        combined_mapping.update(mapping)
+        for e in batch:
+            label_batches.setdefault(mapping.get(e["original"], e["original"]), set()).add(batch_num)
+        if degraded:
+            degraded_names.update(e["original"] for e in batch)
+
+    output.info("\n[Harmonizer] Parsed mapping (original → harmonized):")
+    for orig, canon in combined_mapping.items():
+        output.info(f"    '{orig}' -> '{canon}'")
+
+    # Reduce: reconcile labels that different batches invented for the same form
+    batch_labels = refined_df["Refined CRF Name"].map(lambda x: combined_mapping.get(x, x))
+    label_counts = batch_labels.value_counts().to_dict()
+    unique_labels = list(label_counts)
+    reduce_map = None
+    if len(batches) == 1:
+        reduce_map = {label: label for label in unique_labels}
+    elif reduce == "llm":
+        reduce_map = await _reduce_labels_llm(client, unique_labels, instruction, stats)
+    if reduce_map is None:
+        # quadratic pure-Python fuzzy loop: run it outside the event loop's process
+        reduce_map = await in_process(auto_cluster_names, unique_labels, threshold=reduce_threshold,
+                                      counts=label_counts, groups=label_batches)
+
+    changed = {k: v for k, v in reduce_map.items() if k != v}
+    output.info(f"\n[Harmonizer] Reduce phase ({reduce if len(batches) > 1 else 'skipped, one batch'}): "
+                f"{len(unique_labels)} labels -> "
+                f"{len(set(reduce_map.values()))}")
+    for label, canon in changed.items():
+        output.info(f"    '{label}' -> '{canon}'")
+
+    # Apply the combined mapping
+    refined_df["Canonical CRF Name"] = batch_labels.map(lambda x: reduce_map.get(x, x))
+    if degraded_names:
+        mark_degraded(refined_df, refined_df["Refined CRF Name"].isin(degraded_names), "harmonize")
+
+    for col in ["Refined CRF Name", "Canonical CRF Name"]:
+        refined_df[col] = refined_df[col].apply(lambda x: ", ".join(x) if isinstance(x, list) else x)
+
+    output.info("\n[Harmonizer] Final Canonical CRF Name results:")
+    output.info(
+        "%s",
+        refined_df[["Refined CRF Name", "Canonical CRF Name"]]
+        .drop_duplicates()
+        .reset_index(drop=True)
+    )
+
+    return refined_df
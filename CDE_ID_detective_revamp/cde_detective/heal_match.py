@@ -0,0 +1,393 @@
+"""
+HEAL Core CRF matching of prestep outputs.
+"""
+import asyncio
+import json
+import re
+import time
+from functools import partial
+
+import pandas as pd
+
+from .budget import BudgetExhausted, mark_degraded, or_degrade
+from .cascade import CASCADE_STATS
+from .crf_catalog import NO_CRF_MATCH, confidence_from_probability, loose_heal_crf
+from .offload import output
+from .prestep import is_rate_limit
+from .prompts import STAGE_BUDGETS, clean_text, compile_messages, dedupe_sentences, fit_items, truncate_tokens
+from .structured import (
+    HEAL_MATCH_ALIASES,
+    HEAL_MATCH_SCHEMA,
+    PARSE_STATS,
+    HealMatchResponse,
+    StructuredOutputError,
+    structured_completion,
+)
+
+HEAL_MATCH_MODEL = "gpt-4.1-mini"
+HEAL_MATCH_OUTPUT_NOTE = (
+    "Please respond in strict JSON with keys "
+    "\"heal_core_crf\", \"confidence\", and \"rationale\". "
+    "Do not wrap in markdown or add any extra fields."
+)
+
+
+def heal_match_messages(full_prestep_response, instruction):
+    """Chat messages for one HEAL match request (shared by live and batch runs)."""
+    # the payload is JSON, budgeted when it was built (form_payload): leave its text alone
+    return compile_messages(
+        "heal_match",
+        instruction,
+        {"Prestep output": full_prestep_response},
+        output_note=HEAL_MATCH_OUTPUT_NOTE,
+        dedupe=False,
+        clean=False,
+        truncate=False,
+    )
+
+
+# Helper set 3 API call
+async def match_heal_core_crf(client, full_prestep_response, instruction, stats=None, model=HEAL_MATCH_MODEL):
+    result, full = await structured_completion(
+        client,
+        model,
+        heal_match_messages(full_prestep_response, instruction),
+        "heal_core_crf_match",
+        HEAL_MATCH_SCHEMA,
+        HealMatchResponse,
+        temperature=0.3,
+        aliases=HEAL_MATCH_ALIASES,
+        stats=stats,
+    )
+    output.info(f"\n--- HEAL-Match Response ---\n {full} \n--- End ---\n")
+
+    return result.heal_core_crf, result.confidence, result.rationale.strip()
+
+
+def local_heal_match(payload, prediction=None):
+    """
+    (match, confidence, rationale) without the API, for calls the budget cut off:
+    the local classifier's (label, probability) `prediction` when there is one,
+    else the HEAL Core CRF the payload's crf_name abbreviates ("PHQ-9 Form" ->
+    PHQ9), else No CRF match.
+    """
+    if prediction is not None:
+        label, p = prediction
+        return label, confidence_from_probability(p), f"API budget exhausted; local classifier p={p:.2f}"
+    try:
+        name = json.loads(payload).get("crf_name", "")
+    except (TypeError, ValueError, AttributeError):
+        name = ""
+    crf = loose_heal_crf(name)
+    if crf and crf != NO_CRF_MATCH:
+        return crf, "Low", f"API budget exhausted; matched by name ({name})"
+    return NO_CRF_MATCH, "Low", "API budget exhausted; no HEAL Core CRF in the name"
+
+
+async def match_with_retry(client, full_response, instruction, tries=5, stats=None, model=HEAL_MATCH_MODEL):
+    stats = stats or PARSE_STATS
+    backoff = 1
+    for attempt in range(1, tries + 1):
+        try:
+            return await match_heal_core_crf(client, full_response, instruction, stats, model)
+        except BudgetExhausted:
+            raise
+        except StructuredOutputError as e:
+            output.info(f"[parse] match attempt {attempt} unrepairable: {e}")
+            if attempt == tries:
+                return NO_CRF_MATCH, "Low", ""
+            stats.parse_retries += 1
+            continue
+        except Exception as e:
+            if is_rate_limit(e):
+                output.info(f"[rate limit] match attempt {attempt}, sleeping {backoff}s")
+            else:
+                output.info(f"[warning] match failed attempt {attempt}: {e}")
+
+            if attempt == tries:
+                return NO_CRF_MATCH, "Low", ""
+
+            await asyncio.sleep(backoff)
+            backoff *= 2
+
+
+# Loop over prestep outputs
+async def run_heal_match(client, df, instruction, chunk_size=50, stats=None):
+    all_match, all_conf, all_mrat, degraded = [], [], [], []
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start+chunk_size]
+        tasks = [
+            or_degrade(match_with_retry(client, row["Full Response"], instruction, stats=stats),
+                       partial(local_heal_match, row["Full Response"]))
+            for _, row in chunk.iterrows()
+        ]
+        for (match, conf, mrat), cut in await asyncio.gather(*tasks):
+            all_match.append(match)
+            all_conf.append(conf)
+            all_mrat.append(mrat)
+            degraded.append(cut)
+        if not all(degraded[start:]):
+            await asyncio.sleep(1)
+    df["HEAL Core CRF Match"], df["Confidence Level"], df["Match Rationale"] = all_match, all_conf, all_mrat
+    if any(degraded):
+        output.info(f"[HEAL-Match] Budget: {sum(degraded)} of {len(df)} rows matched locally")
+        mark_degraded(df, pd.Series(degraded, index=df.index), "match")
+    return df
+
+
+# --- form-level matching ---------------------------------------------------
+# The HEAL Core CRF match is a property of the whole canonical form, so decide
+# once per form from a small, diverse sample of its variables and broadcast.
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def _tokens(text):
+    return set(_TOKEN_RE.findall(str(text).lower())) if isinstance(text, str) else set()
+
+
+def sample_form_variables(form_df, variable_column, description_column, k=8):
+    """
+    Pick up to `k` rows that cover the form's vocabulary: start with the most
+    descriptive label, then repeatedly add the row least similar (Jaccard on
+    label tokens) to anything already picked.
+    Returns a list of {"variable", "description"} dicts.
+    """
+    rows = form_df[[variable_column, description_column]].drop_duplicates(subset=[description_column])
+    rows = rows[rows[description_column].notna()]
+    if rows.empty:
+        rows = form_df[[variable_column, description_column]].head(1)
+    candidates = [(r[0], r[1], _tokens(r[1])) for r in rows.itertuples(index=False)]
+
+    picked = [max(candidates, key=lambda c: len(c[2]))]
+    candidates.remove(picked[0])
+    while candidates and len(picked) < k:
+        def closeness(c):
+            return max(len(c[2] & p[2]) / (len(c[2] | p[2]) or 1) for p in picked)
+        best = min(candidates, key=closeness)
+        picked.append(best)
+        candidates.remove(best)
+
+    descriptions = dedupe_sentences([clean_text(d) for _, d, _ in picked])
+    return [{"variable": str(v), "description": d} for (v, _, _), d in zip(picked, descriptions)]
+
+
+def form_payload(canonical_name, samples, rationale=""):
+    """
+    JSON sent to the matcher for one canonical form. The rationale and the
+    sample list are cut to the heal_match budget before serializing.
+    """
+    budget = STAGE_BUDGETS.get("heal_match")
+    if budget:
+        rationale = truncate_tokens(rationale, budget // 4) if rationale else rationale
+        samples = [{**s, "description": truncate_tokens(s["description"], budget // 4)}
+                   if isinstance(s.get("description"), str) else s for s in samples]
+
+    def render(kept):
+        return json.dumps({
+            "crf_name": canonical_name,
+            "rationale": rationale,
+            "sample_variables": kept,
+        }, ensure_ascii=False)
+
+    return render(fit_items(samples, "heal_match", render) if samples else samples)
+
+
+def form_text(form_name, crf_name, samples):
+    """Feature text for the local classifier; used identically for training and inference."""
+    labels = " ; ".join(s["description"] for s in samples if s.get("description"))
+    return f"{form_name or ''} | {crf_name or ''} | {labels}"
+
+
+async def run_heal_match_by_form(client, df, instruction, variable_column="Variable / Field Name",
+                                 description_column="Field Label", form_column="Canonical CRF Name",
+                                 crf_column="Form Name", sample_size=8, max_concurrency=10, stats=None,
+                                 local_matcher=None, escalate_below=0.8, decide_forms=None, cascade=None,
+                                 fallback_matcher=None, known=None):
+    """
+    Form-level HEAL matching: one call per unique `form_column` value instead of one per row.
+    With `local_matcher` (a LocalCRFMatcher) every form is classified offline first and
+    only forms with probability below `escalate_below` are sent to the LLM
+    (escalate_below=0 never calls the LLM).
+    `decide_forms` replaces the live calls: an async callable taking {form: payload}
+    and returning {form: (match, confidence, rationale)} (see cde_detective.batch).
+    With a `cascade` the live calls go to its fast model first; forms answered below
+    its confidence level, or where the fast model and the local classifier disagree,
+    are asked again with the strong model.
+    Forms whose calls the API budget cut off are decided by local_heal_match, with
+    `fallback_matcher` (a LocalCRFMatcher) as the classifier when `local_matcher` is not
+    set, and their rows are marked in the Degraded column.
+    `known` ({form: (match, confidence, rationale)}, see speculation_hits) decides
+    those forms without a call.
+    Adds the usual three columns to `df` and returns (df, consistency report DataFrame).
+    """
+    prior = df["HEAL Core CRF Match"].astype(object) if "HEAL Core CRF Match" in df.columns else None
+    forms = df[form_column].astype(object).fillna("").astype(str)
+    groups = {name: idx for name, idx in df.groupby(forms, sort=False).groups.items()}
+
+    samples_by_form = {
+        name: sample_form_variables(df.loc[idx], variable_column, description_column, k=sample_size)
+        for name, idx in groups.items()
+    }
+
+    def texts_for(names):
+        return [
+            form_text(", ".join(df.loc[groups[name], crf_column].dropna().astype(str).unique())
+                      if crf_column in df.columns else "", name, samples_by_form[name])
+            for name in names
+        ]
+
+    local = {}
+    if local_matcher is not None:
+        started = time.perf_counter()
+        local = dict(zip(groups, local_matcher.predict(texts_for(groups))))
+        elapsed = time.perf_counter() - started
+        output.info(f"[HEAL-Match] Local classifier: {len(local)} forms in {elapsed * 1000:.0f} ms")
+        if cascade is not None:
+            CASCADE_STATS.add("heal_match", "local", len(local), elapsed)
+
+    known = known or {}
+    to_llm = [name for name in groups
+              if name not in known and (name not in local or local[name][1] < escalate_below)]
+    output.info(f"[HEAL-Match] Form-level mode: {len(groups)} forms -> {len(to_llm)} calls "
+                f"(row-level would be {len(df)})" + (f", {len(known)} decided speculatively" if known else ""))
+
+    payloads = {}
+    for name in to_llm:
+        form_df = df.loc[groups[name]]
+        rationale = ""
+        if "Rationale" in form_df.columns:
+            common = form_df["Rationale"].dropna().astype(str).mode()
+            rationale = common.iloc[0] if len(common) else ""
+        payloads[name] = form_payload(name, samples_by_form[name], rationale)
+
+    tier_by_form, cut = {}, set()
+    if decide_forms is not None:
+        decided = await decide_forms(payloads)
+    else:
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def decide(name, model):
+            async with semaphore:
+                result, degraded = await or_degrade(
+                    match_with_retry(client, payloads[name], instruction, stats=stats, model=model),
+                    partial(local_heal_match, payloads[name], local.get(name)),
+                )
+                return name, result, degraded
+
+        async def decide_all(names, model):
+            answers = await asyncio.gather(*[decide(name, model) for name in names])
+            return {name: result for name, result, _ in answers}, {name for name, _, d in answers if d}
+
+        if cascade is None:
+            decided, cut = await decide_all(to_llm, HEAL_MATCH_MODEL)
+        else:
+            with CASCADE_STATS.tier("heal_match", cascade.fast_model, len(to_llm)):
+                decided, cut = await decide_all(to_llm, cascade.fast_model)
+            tier_by_form = dict.fromkeys(to_llm, cascade.fast_model)
+            escalate = [
+                name for name in to_llm
+                if name not in cut and (
+                    not cascade.confident(decided[name][1])
+                    or (cascade.escalate_on_disagreement and name in local and local[name][0] != decided[name][0])
+                )
+            ]
+            output.info(f"[HEAL-Match] Cascade: {len(to_llm) - len(escalate)} forms kept from {cascade.fast_model}, "
+                        f"{len(escalate)} escalated to {cascade.strong_model}")
+            if escalate:
+                CASCADE_STATS.escalate("heal_match", len(escalate))
+                with CASCADE_STATS.tier("heal_match", cascade.strong_model, len(escalate)):
+                    strong, strong_cut = await decide_all(escalate, cascade.strong_model)
+                # a strong call the budget cut off keeps the fast answer
+                strong = {name: result for name, result in strong.items() if name not in strong_cut}
+                decided.update(strong)
+                tier_by_form.update(dict.fromkeys(strong, cascade.strong_model))
+
+        if cut:
+            fallback = [name for name in cut if name not in local]
+            if fallback_matcher is not None and fallback:
+                for name, prediction in zip(fallback, fallback_matcher.predict(texts_for(fallback))):
+                    decided[name] = local_heal_match(payloads[name], prediction)
+            tier_by_form.update(dict.fromkeys(cut, "Degraded"))
+            output.info(f"[HEAL-Match] Budget: {len(cut)} of {len(to_llm)} forms matched locally")
+
+    decisions = []
+    for name in groups:
+        if name in known:
+            decisions.append((name, "Speculative", known[name]))
+        elif name in decided:
+            decisions.append((name, tier_by_form.get(name, "LLM"), decided[name]))
+        else:
+            label, p = local[name]
+            decisions.append((name, "Local", (label, confidence_from_probability(p),
+                                              f"Local classifier p={p:.2f}")))
+
+    match_by_form, report_rows = {}, []
+    for name, decided_by, (match, conf, mrat) in decisions:
+        match_by_form[name] = (match, conf, mrat)
+        idx = groups[name]
+        row = {
+            form_column: name,
+            "Rows": len(idx),
+            "Sampled Variables": len(samples_by_form[name]),
+            "Source Forms": ", ".join(sorted(df.loc[idx, crf_column].dropna().astype(str).unique()))
+            if crf_column in df.columns else "",
+            "HEAL Core CRF Match": match,
+            "Confidence Level": conf,
+            "Match Rationale": mrat,
+        }
+        if local_matcher is not None or cascade is not None or cut or known:
+            row["Decided By"] = decided_by
+        if local_matcher is not None:
+            row["Local Probability"] = round(local[name][1], 3) if name in local else None
+        if prior is not None:
+            previous = prior.loc[idx].fillna(NO_CRF_MATCH).astype(str)
+            row["Row-level Matches"] = ", ".join(sorted(previous.unique()))
+            row["Row Agreement"] = round(float((previous == match).mean()), 3)
+        report_rows.append(row)
+
+    df["HEAL Core CRF Match"] = forms.map(lambda f: match_by_form[f][0])
+    df["Confidence Level"] = forms.map(lambda f: match_by_form[f][1])
+    df["Match Rationale"] = forms.map(lambda f: match_by_form[f][2])
+    if cut:
+        mark_degraded(df, forms.isin(cut), "match")
+
+    report_df = pd.DataFrame(report_rows)
+    # Original forms whose rows ended up with different HEAL matches
+    if crf_column in df.columns:
+        spread = df.groupby(crf_column)["HEAL Core CRF Match"].nunique()
+        split = set(spread[spread > 1].index.astype(str))
+        report_df["Split Source Form"] = report_df["Source Forms"].map(
+            lambda s: any(f in split for f in s.split(", ")) if s else False
+        )
+        if split:
+            output.info(f"[HEAL-Match] {len(split)} original forms map to more than one HEAL match: "
+                        f"{sorted(split)}")
+
+    return df, report_df
+
+
+# --- speculative matching --------------------------------------------------------
+# The raw form name plus a few labels usually settles the match already, so the
+# pipeline can match the raw forms while the prestep and harmonizer run and
+# only re-ask for the canonical forms the refinement reshaped.
+
+def speculation_hits(df, speculative, raw_column="Form Name", form_column="Canonical CRF Name"):
+    """
+    Canonical forms whose speculative decision ({raw form: (match, confidence,
+    rationale)}, made on `raw_column` before the prestep) still holds: every
+    raw form feeding the canonical form lies wholly inside it, and those raw
+    forms were all given the same match. Returns {canonical form: decision}.
+    """
+    raw = df[raw_column].astype(object).fillna("").astype(str)
+    forms = df[form_column].astype(object).fillna("").astype(str)
+    canonical_per_raw = forms.groupby(raw).nunique()
+    hits = {}
+    for name, sources in raw.groupby(forms, sort=False):
+        counts = sources.value_counts()
+        if any(canonical_per_raw[r] > 1 or r not in speculative for r in counts.index):
+            continue
+        if len({speculative[r][0] for r in counts.index}) == 1:
+            hits[name] = speculative[counts.index[0]]
+    return hits
+
@@ -0,0 +1,266 @@
+"""
+HEAL CDE knowledge-base versions: stamping outputs and revalidating them.
+
+Every CDE search workbook carries the version (the date in the KB file name)
+and content checksum of the KB it was scored against, as custom document
+properties. When the master list is updated, `revalidate` diffs the two KB
+versions per (Variable Name, CRF Name) and re-scores only the rows whose
+matched or candidate CDEs were added, removed or changed:
+
+    cde-detective revalidate out/ ../Archive/Outputs/ \\
+        --old "KnowledgeBase/Compiled_CORE_CDEs list_English_as of 2023_06-03.xlsx" \\
+        --new "KnowledgeBase/Compiled_CORE_CDEs list_English_one sheet_as of 2025-01-28.xlsx"
+"""
+import glob
+import os
+import re
+import time
+import zipfile
+from datetime import date
+from xml.etree import ElementTree
+
+import pandas as pd
+
+from .crf_catalog import master_crf_names
+from .loader import file_digest
+
+STAMP_VERSION, STAMP_CHECKSUM, STAMP_FILE = "KB Version", "KB Checksum", "KB File"
+SEARCH_SUFFIX = "_vlmd_cdesearch.xlsx"
+MATCH_NAME_COLUMNS = ["Best Match CDE Name", "Potential Match 2 - CDE Name", "Potential Match 3 - CDE Name"]
+
+_DATE_RE = re.compile(r"(\d{4})[-_](\d{2})[-_](\d{2})")
+_CUSTOM_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/custom-properties}"
+
+
+def kb_version(cde_file):
+    """The date in the KB file name ("... as of 2023_06-03" -> "2023-06-03"), else its modification date."""
+    match = _DATE_RE.search(os.path.basename(cde_file))
+    if match:
+        return "-".join(match.groups())
+    return date.fromtimestamp(os.path.getmtime(cde_file)).isoformat()
+
+
+def kb_stamp(cde_file):
+    return {
+        STAMP_FILE: os.path.basename(cde_file),
+        STAMP_VERSION: kb_version(cde_file),
+        STAMP_CHECKSUM: file_digest(cde_file),
+    }
+
+
+def stamp_workbook(writer, stamp):
+    """Write `stamp` as custom document properties of an xlsxwriter-backed pd.ExcelWriter."""
+    for name, value in stamp.items():
+        writer.book.set_custom_property(name, value)
+
+
+def read_stamp(path):
+    """Custom document properties of an .xlsx ({} when there are none)."""
+    try:
+        with zipfile.ZipFile(path) as z:
+            xml = z.read("docProps/custom.xml")
+    except (KeyError, zipfile.BadZipFile, OSError):
+        return {}
+    props = {}
+    for prop in ElementTree.fromstring(xml).iter(f"{_CUSTOM_NS}property"):
+        props[prop.get("name")] = next((child.text for child in prop), None)
+    return props
+
+
+# --- diff ----------------------------------------------------------------------------
+
+def _kb_entries(cde_df):
+    keys = zip(cde_df["Variable Name"].astype(str), cde_df["CRF Name"].astype(str).str.strip())
+    entries = {}
+    for key, text in zip(keys, cde_df["Normalized Combined"]):
+        entries.setdefault(key, set()).add(text)
+    return entries
+
+
+def diff_kb(old_df, new_df):
+    """
+    CDE-level differences between two load_cde_kb() frames, keyed by
+    (Variable Name, CRF Name). Returns a DataFrame with a Change column
+    (added / removed / changed) and the old and new search texts.
+    """
+    old, new = _kb_entries(old_df), _kb_entries(new_df)
+    rows = []
+    for key in sorted(old.keys() | new.keys()):
+        if key not in old:
+            change = "added"
+        elif key not in new:
+            change = "removed"
+        elif old[key] != new[key]:
+            change = "changed"
+        else:
+            continue
+        rows.append({
+            "Variable Name": key[0],
+            "CRF Name": key[1],
+            "Change": change,
+            "Old Text": " || ".join(sorted(old.get(key, ()))),
+            "New Text": " || ".join(sorted(new.get(key, ()))),
+        })
+    return pd.DataFrame(rows, columns=["Variable Name", "CRF Name", "Change", "Old Text", "New Text"])
+
+
+def rows_to_rescore(df, diff):
+    """
+    Boolean mask of result rows affected by `diff`: one of their three matches
+    was touched, or their candidate set (the matched CRF's partition, or the
+    whole sheet for global searches) gained, lost or changed a CDE.
+    """
+    from .encodings import SIGNATURE_SCOPE
+
+    if diff.empty or "Normalized Combined" not in df.columns:
+        return pd.Series(False, index=df.index)
+    touched_names = set(diff["Variable Name"])
+    touched_crfs = set(diff["CRF Name"])
+
+    searched = df["Normalized Combined"].fillna("").astype(str) != ""
+    if "Search Scope" in df.columns:
+        scopes = df["Search Scope"].astype(object)
+        searched &= scopes != SIGNATURE_SCOPE
+    else:
+        scopes = pd.Series(None, index=df.index, dtype=object)
+
+    matched = pd.Series(False, index=df.index)
+    for col in MATCH_NAME_COLUMNS:
+        if col in df.columns:
+            matched |= df[col].astype(object).isin(touched_names)
+
+    heal = df["HEAL Core CRF Match"].astype(object) if "HEAL Core CRF Match" in df.columns else None
+    partition_hit = pd.Series(False, index=df.index)
+    if heal is not None:
+        hit_by_match = {m: bool(set(master_crf_names(m)) & touched_crfs) for m in heal.dropna().unique()}
+        partition_hit = heal.map(hit_by_match).fillna(False).astype(bool)
+    global_search = scopes.astype(str).str.startswith("Global") | (heal is None)
+    return searched & (matched | partition_hit | global_search)
+
+
+# --- revalidation ----------------------------------------------------------------------
+
+def _search_outputs(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, f"*{SEARCH_SUFFIX}"))))
+        else:
+            files.append(path)
+    return files
+
+
+def _coded_confidence_column(df):
+    """The 'Confidence Level' column color_code_results inserted after 'Best Match Score', if any."""
+    if "Best Match Score" not in df.columns:
+        return None
+    position = df.columns.get_loc("Best Match Score") + 1
+    if position < df.shape[1] and str(df.columns[position]).startswith("Confidence Level"):
+        return df.columns[position]
+    return None
+
+
+def revalidate_output(path, diff, new_partitions, new_stem_index, new_stamp, old_checksum,
+                      field_label_column="description", fallback_threshold=70, output_dir=None,
+                      dry_run=False):
+    """
+    Re-score the affected rows of one CDE search workbook against the new KB.
+    Returns (summary row, [moved row dicts]).
+    """
+    from .encodings import MATCH_COLUMNS, apply_matches, color_code_results, question_stems, search_texts
+
+    name = os.path.basename(path)
+    stamp = read_stamp(path)
+    summary = {"Study": name[:-len(SEARCH_SUFFIX)] if name.endswith(SEARCH_SUFFIX) else name,
+               "File": path, "Stamped Version": stamp.get(STAMP_VERSION, "unstamped")}
+    if stamp.get(STAMP_CHECKSUM) == new_stamp[STAMP_CHECKSUM]:
+        return {**summary, "Status": "current"}, []
+    if stamp.get(STAMP_CHECKSUM) not in (None, old_checksum):
+        return {**summary, "Status": "skipped: scored against a different KB than --old"}, []
+
+    df = pd.read_excel(path)
+    coded = _coded_confidence_column(df)
+    if coded is not None:
+        df = df.drop(columns=[coded])
+    mask = rows_to_rescore(df, diff)
+    rescored = df.index[mask]
+
+    before = df.loc[rescored, ["Best Match CDE Name", "Best Match Score"]].copy()
+    if len(rescored):
+        subset = df.loc[rescored].copy()
+        for col in MATCH_COLUMNS + ["Search Scope"]:
+            subset[col] = None
+        heal = subset["HEAL Core CRF Match"].astype(object).tolist() \
+            if "HEAL Core CRF Match" in subset.columns else None
+        stems = question_stems(subset, field_label_column) if field_label_column in subset.columns else None
+        results = search_texts(subset["Normalized Combined"].astype(str).tolist(), heal, new_partitions,
+                               fallback_threshold, stems=stems, stem_index=new_stem_index if stems else None)
+        apply_matches(subset, results)
+        for col in MATCH_COLUMNS + ["Search Scope"]:
+            df[col] = df[col].astype(object) if col in df.columns else None
+            df.loc[rescored, col] = subset[col]
+
+    moved = []
+    for idx in rescored:
+        old_name, new_name = before.at[idx, "Best Match CDE Name"], df.at[idx, "Best Match CDE Name"]
+        if str(old_name) != str(new_name):
+            moved.append({
+                "Study": summary["Study"],
+                "Row": int(idx) + 2,
+                "Field": df.at[idx, df.columns[0]],
+                "Old Best Match": old_name,
+                "Old Score": before.at[idx, "Best Match Score"],
+                "New Best Match": new_name,
+                "New Score": df.at[idx, "Best Match Score"],
+            })
+
+    if not dry_run:
+        output_file = os.path.join(output_dir, name) if output_dir else path
+        with pd.ExcelWriter(output_file, engine="xlsxwriter") as writer:
+            df.to_excel(writer, index=False)
+            stamp_workbook(writer, new_stamp)
+        if coded is not None:
+            color_code_results(output_file)
+    return {**summary, "Status": "dry run" if dry_run else "revalidated", "Rows": len(df),
+            "Rows Rescored": len(rescored), "Best Match Moved": len(moved)}, moved
+
+
+def revalidate(paths, old_cde_file, new_cde_file, output_dir=None, report_file=None,
+               field_label_column="description", fallback_threshold=70, dry_run=False):
+    """
+    Revalidate every *_vlmd_cdesearch.xlsx in `paths` (files or folders) from the
+    old KB to the new one and write a report workbook (Studies, Moved, KB Diff).
+    Returns the report path.
+    """
+    from .encodings import build_stem_index, load_cde_kb, partition_cde_kb
+
+    started = time.perf_counter()
+    old_df, new_df = load_cde_kb(old_cde_file), load_cde_kb(new_cde_file)
+    diff = diff_kb(old_df, new_df)
+    counts = diff["Change"].value_counts().to_dict()
+    old_stamp, new_stamp = kb_stamp(old_cde_file), kb_stamp(new_cde_file)
+    print(f"[KB] {old_stamp[STAMP_VERSION]} -> {new_stamp[STAMP_VERSION]}: "
+          + (", ".join(f"{n} {change}" for change, n in counts.items()) or "no CDE-level changes"))
+
+    partitions, stem_index = partition_cde_kb(new_df), build_stem_index(new_df)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    summaries, moved = [], []
+    for path in _search_outputs(paths):
+        summary, rows = revalidate_output(path, diff, partitions, stem_index, new_stamp,
+                                          old_stamp[STAMP_CHECKSUM], field_label_column,
+                                          fallback_threshold, output_dir, dry_run)
+        print(f"[KB] {summary['Study']}: {summary['Status']}"
+              + (f", {summary['Rows Rescored']}/{summary['Rows']} rows re-scored, "
+                 f"{summary['Best Match Moved']} best matches moved" if "Rows" in summary else ""))
+        summaries.append(summary)
+        moved.extend(rows)
+
+    report_file = report_file or os.path.join(
+        output_dir or "out", f"kb_revalidation_{old_stamp[STAMP_VERSION]}_to_{new_stamp[STAMP_VERSION]}.xlsx")
+    with pd.ExcelWriter(report_file, engine="xlsxwriter") as writer:
+        pd.DataFrame(summaries).to_excel(writer, sheet_name="Studies", index=False)
+        pd.DataFrame(moved).to_excel(writer, sheet_name="Moved", index=False)
+        diff.to_excel(writer, sheet_name="KB Diff", index=False)
+    print(f"[KB] {len(summaries)} outputs checked in {time.perf_counter() - started:.1f}s; report: {report_file}")
+    return report_file
@@ -0,0 +1,169 @@
+"""
+Shared data-dictionary loader.
+
+Reads only the columns a tool needs (calamine when installed, openpyxl
+otherwise), stores repetitive text columns as categoricals and keeps a Parquet
+sidecar keyed by the file's content hash, so re-loading the same workbook in
+the merger, quiz or encoding search is a memory-mapped read instead of a
+re-parse.
+"""
+import glob
+import hashlib
+import importlib.util
+import os
+import threading
+import time
+
+import pandas as pd
+
+from .offload import output
+
+CACHE_DIR_NAME = ".cde_cache"
+
+# Columns that repeat a handful of values over thousands of rows
+CATEGORICAL_COLUMNS = [
+    "Form Name", "section", "Section Header", "Field Type",
+    "Refined CRF Name", "Canonical CRF Name", "HEAL Core CRF Match", "Confidence Level",
+    "CRF Name",
+]
+
+HAS_CALAMINE = importlib.util.find_spec("python_calamine") is not None
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Content hash of a file (blake2b, 16 hex chars)."""
+    h = hashlib.blake2b(digest_size=8)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _mb(df):
+    return df.memory_usage(deep=True).sum() / 1e6
+
+
+def _sidecar_prefix(path, sheet_name, cache_dir):
+    stem = os.path.basename(path)
+    sheet = "csv" if path.lower().endswith(".csv") else str(sheet_name)
+    sheet = "".join(ch if ch.isalnum() else "_" for ch in sheet)
+    return os.path.join(cache_dir, f"{stem}.{sheet}")
+
+
+def _find_sidecar(prefix, digest, usecols):
+    """An existing sidecar for this file version that holds every requested column."""
+    import pyarrow.parquet as pq
+
+    for candidate in sorted(glob.glob(f"{prefix}.{digest}.*.parquet")):
+        try:
+            names = set(pq.read_schema(candidate).names)
+        except Exception:
+            continue
+        if usecols is None:
+            if candidate.endswith(".all.parquet"):
+                return candidate
+        elif set(usecols) <= names:
+            return candidate
+    return None
+
+
+def _write_sidecar(df, prefix, digest, usecols):
+    """
+    Write the sidecar and drop the ones left behind by older versions of the file.
+    The Parquet file is written under a temporary name and renamed into place, so
+    a reader (or a crash) never sees a partial sidecar under a valid digest.
+    """
+    cols_key = "all" if usecols is None else hashlib.blake2b(
+        "\x1f".join(sorted(usecols)).encode(), digest_size=4).hexdigest()
+    path = f"{prefix}.{digest}.{cols_key}.parquet"
+    for stale in glob.glob(f"{prefix}.*.parquet"):
+        if f".{digest}." not in os.path.basename(stale):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass  # another process got there first
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+    except Exception as e:
+        # e.g. unsupported object types; just skip the cache
+        output.info(f"[Loader] Could not write Parquet sidecar ({e}); loading from source next time.")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return path
+
+
+def _uniform_objects(df):
+    """
+    Parquet needs one type per column: in object columns that mix text with
+    numbers, store the non-null values as text. Applied on every parse so a
+    fresh load and a sidecar load give the same frame.
+    """
+    for col in df.columns[df.dtypes == object]:
+        values = df[col].dropna()
+        if values.map(type).nunique() > 1:
+            df[col] = df[col].map(lambda v: v if pd.isna(v) else str(v))
+    return df
+
+
+def apply_categoricals(df, columns=None):
+    """Convert the given (or default) columns that exist in `df` to categoricals."""
+    columns = CATEGORICAL_COLUMNS if columns is None else columns
+    for col in columns:
+        if col in df.columns and (df[col].dtype == object or pd.api.types.is_string_dtype(df[col])):
+            df[col] = df[col].astype("category")
+    return df
+
+
+def load_table(path, sheet_name=0, usecols=None, categorical=None, cache=True, cache_dir=None):
+    """
+    Load an .xlsx/.csv data dictionary.
+
+    Parameters:
+    - usecols: columns to read (None = all). Missing columns raise a ValueError.
+    - categorical: columns stored as pandas categoricals (None = CATEGORICAL_COLUMNS,
+      [] = none). Leave out columns the caller rewrites with new values.
+    - cache: read/write the Parquet sidecar in `cache_dir`
+      (default: .cde_cache next to the input file).
+
+    Returns a DataFrame in the requested column order.
+    """
+    started = time.perf_counter()
+    usecols = list(usecols) if usecols is not None else None
+    cache = cache and HAS_PYARROW
+    source = os.path.basename(path)
+    if not path.lower().endswith(".csv"):
+        source += f"[{sheet_name}]"
+
+    if cache:
+        cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR_NAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        prefix = _sidecar_prefix(path, sheet_name, cache_dir)
+        digest = file_digest(path)
+        sidecar = _find_sidecar(prefix, digest, usecols)
+        if sidecar:
+            df = pd.read_parquet(sidecar, columns=usecols, memory_map=True)
+            df = apply_categoricals(df, categorical)
+            output.info(f"[Loader] {source}: {len(df):,} rows x {df.shape[1]} cols from Parquet sidecar, "
+                        f"{_mb(df):.1f} MB ({time.perf_counter() - started:.2f}s)")
+            return df
+
+    if path.lower().endswith(".csv"):
+        df = pd.read_csv(path, usecols=usecols)
+    else:
+        engine = "calamine" if HAS_CALAMINE else "openpyxl"
+        df = pd.read_excel(path, sheet_name=sheet_name, usecols=usecols, engine=engine)
+    if usecols is not None:
+        df = df[usecols]
+    df = _uniform_objects(df)
+    if cache:
+        _write_sidecar(df, prefix, digest, usecols)
+
+    before = _mb(df)
+    df = apply_categoricals(df, categorical)
+    output.info(f"[Loader] {source}: {len(df):,} rows x {df.shape[1]} cols parsed, "
+                f"{before:.1f} MB -> {_mb(df):.1f} MB with categoricals "
+                f"({time.perf_counter() - started:.2f}s)")
+    return df
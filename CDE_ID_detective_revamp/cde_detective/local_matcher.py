@@ -0,0 +1,328 @@
+"""
+Offline HEAL Core CRF matcher: char/word TF-IDF features + a calibrated
+logistic regression, trained from the validated dictionaries we already have.
+
+Runs on CPU with no network; the HEAL-match stage uses it first and only
+escalates low-probability forms to the LLM.
+
+Limits: it only knows the forms and wordings of the dictionaries it was
+trained on, and "No CRF match" is by far the largest class there. Trained on
+the shipped ValidatedCDEuse files it labels the classify example below
+"No CRF match" (p=0.565). Prefer backend = hybrid; backend = local suits
+re-runs over studies like the training ones, not unseen instruments.
+
+Train:
+    python -m cde_detective.local_matcher train
+    python -m cde_detective.local_matcher classify "PHQ-9 | Little interest or pleasure in doing things"
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from collections import Counter
+from datetime import datetime
+
+import joblib
+import pandas as pd
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import cross_val_score
+from sklearn.pipeline import FeatureUnion, Pipeline
+
+from .crf_catalog import (
+    HEAL_CORE_CRFS,
+    HEAL_TO_MASTER_CRF,
+    NO_CRF_MATCH,
+    loose_heal_crf,
+)
+from .heal_match import form_text, sample_form_variables
+from .loader import load_table
+
+DEFAULT_MODEL_FILE = "models/heal_match_local.joblib"
+DEFAULT_VALIDATED_DIR = "ValidatedCDEuse"
+DEFAULT_CONFIRMED_GLOB = "out/*_matches_confirmed.xlsx"
+DEFAULT_FINETUNE_JSONL = "../Archive/trainingdataforfinetuning_v2024-07-24_module1.jsonl"
+DEFAULT_CRF_DESCRIPTIONS = "KnowledgeBase/CRF_descriptions.json"
+DEFAULT_CDE_FILE = "KnowledgeBase/Compiled_CORE_CDEs list_English_one sheet_as of 2025-01-28.xlsx"
+
+# Column names differ between REDCap, VLMD and older enhanced sheets
+FORM_COLUMNS = ["Form Name", "section", "module", "Original CRF Name"]
+NAME_COLUMNS = ["Canonical CRF Name", "Extracted CRF Name"]
+LABEL_COLUMNS = ["Manual Verification", "Manual Validation", "Manual Validation]", "HEAL Core CRF Match"]
+VARIABLE_COLUMNS = ["Variable / Field Name", "name", "Variable Name", "field_name"]
+DESCRIPTION_COLUMNS = ["Field Label", "description", "title", "Description", "Description/Pre Text",
+                       "field_description", "Definition"]
+
+SAMPLE_SIZE = 8
+
+
+def _first_column(df, candidates):
+    return next((c for c in candidates if c in df.columns), None)
+
+
+def _clean(text):
+    return re.sub(r"\s+", " ", str(text)).strip()
+
+
+# --- training data ---------------------------------------------------------
+
+def examples_from_enhanced(df, source):
+    """One example per (form, extracted/canonical name) in a reviewed EnhancedDD sheet."""
+    name_col = _first_column(df, NAME_COLUMNS)
+    label_col = _first_column(df, LABEL_COLUMNS)
+    if name_col is None or label_col is None:
+        return []
+    form_col = _first_column(df, FORM_COLUMNS) or name_col
+    var_col = _first_column(df, VARIABLE_COLUMNS) or name_col
+    desc_col = _first_column(df, DESCRIPTION_COLUMNS) or name_col
+
+    examples = []
+    for (form, name), group in df.groupby([form_col, name_col], sort=False):
+        labels = group[label_col].map(loose_heal_crf).dropna()
+        if labels.empty:
+            continue
+        samples = sample_form_variables(group, var_col, desc_col, k=SAMPLE_SIZE)
+        examples.append({
+            "text": form_text(form, name, samples),
+            "label": labels.mode().iloc[0],
+            "source": source,
+        })
+    return examples
+
+
+def examples_from_metadata(df, source):
+    """Fallback for workbooks that only carry the reviewed Metadata sheet."""
+    name_col = _first_column(df, NAME_COLUMNS)
+    label_col = _first_column(df, LABEL_COLUMNS)
+    if name_col is None or label_col is None:
+        return []
+    form_col = _first_column(df, FORM_COLUMNS) or name_col
+    examples = []
+    for form, name, label in zip(df[form_col], df[name_col], df[label_col]):
+        label = loose_heal_crf(label)
+        if label:
+            examples.append({"text": form_text(form, name, []), "label": label, "source": source})
+    return examples
+
+
+def examples_from_workbook(path):
+    try:
+        sheets = pd.read_excel(path, sheet_name=None)
+    except Exception as e:
+        print(f"⚠️ Skipping {path!r}: {e}")
+        return []
+    source = os.path.basename(path)
+    examples = []
+    for name, df in sheets.items():
+        if name in ("Metadata", "CRF Results"):
+            continue
+        examples.extend(examples_from_enhanced(df, source))
+    if not examples:
+        for name in ("Metadata", "CRF Results"):
+            if name in sheets:
+                examples.extend(examples_from_metadata(sheets[name], source))
+    return examples
+
+
+def examples_from_crf_descriptions(path=DEFAULT_CRF_DESCRIPTIONS):
+    """Seed examples so every HEAL Core CRF has at least a few positives."""
+    examples = [
+        {"text": form_text(label, label, []), "label": label, "source": "crf_catalog"}
+        for label in HEAL_CORE_CRFS
+    ]
+    if not os.path.exists(path):
+        return examples
+    with open(path, encoding="utf-8") as f:
+        crfs = json.load(f)["CRFs"]
+    for crf in crfs:
+        label = loose_heal_crf(crf["name"])
+        if not label:
+            continue
+        for alias in [crf["name"]] + crf.get("abbreviations", []):
+            samples = [{"description": crf.get("description", "")}]
+            examples.append({"text": form_text(alias, alias, samples), "label": label,
+                             "source": os.path.basename(path)})
+    return examples
+
+
+def examples_from_finetune_jsonl(path=DEFAULT_FINETUNE_JSONL, cde_file=DEFAULT_CDE_FILE):
+    """
+    Module-level examples from the archived fine-tuning file. Assistant replies
+    name CDE variables; their CRF comes from the master sheet. Lines that are
+    not valid JSON (about a third of the file) are skipped.
+    """
+    if not (os.path.exists(path) and os.path.exists(cde_file)):
+        return []
+    master = load_table(cde_file, sheet_name="ALL", usecols=["Variable Name", "CRF Name"], categorical=[])
+    master_to_heal = {}
+    for heal, names in HEAL_TO_MASTER_CRF.items():
+        for name in names:
+            # subscale names stay with their own label rather than the full BPI
+            if len(names) == 1 or name not in master_to_heal:
+                master_to_heal[name] = heal
+    var_to_heal = {
+        v: master_to_heal.get(str(c).strip())
+        for v, c in zip(master["Variable Name"], master["CRF Name"])
+    }
+
+    by_module = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                messages = json.loads(line)["messages"]
+                entries = json.loads(messages[-1]["content"])
+            except (ValueError, KeyError, TypeError):
+                continue
+            user = messages[-2]["content"]
+            module = re.search(r"module '([^']+)'", user)
+            title = re.search(r'"title": "([^"]*)"', user)
+            key = module.group(1) if module else "unknown"
+            rec = by_module.setdefault(key, {"titles": [], "labels": []})
+            if title:
+                rec["titles"].append(title.group(1))
+            for e in entries if isinstance(entries, list) else []:
+                if e.get("CDE Matching") == "HEAL CDE Match":
+                    rec["labels"].append(var_to_heal.get(e.get("Variable Name")) or NO_CRF_MATCH)
+                else:
+                    rec["labels"].append(NO_CRF_MATCH)
+
+    examples = []
+    for module, rec in by_module.items():
+        if not rec["labels"]:
+            continue
+        samples = [{"description": t} for t in rec["titles"][:SAMPLE_SIZE]]
+        examples.append({"text": form_text(module, module, samples),
+                         "label": Counter(rec["labels"]).most_common(1)[0][0],
+                         "source": os.path.basename(path)})
+    return examples
+
+
+def build_training_set(validated_dir=DEFAULT_VALIDATED_DIR, confirmed_glob=DEFAULT_CONFIRMED_GLOB,
+                       finetune_jsonl=DEFAULT_FINETUNE_JSONL, crf_descriptions=DEFAULT_CRF_DESCRIPTIONS,
+                       cde_file=DEFAULT_CDE_FILE):
+    paths = sorted(glob.glob(os.path.join(validated_dir, "*.xlsx")))
+    paths += sorted(glob.glob(confirmed_glob)) if confirmed_glob else []
+    examples = []
+    for path in paths:
+        if os.path.basename(path).startswith("~$"):
+            continue
+        examples.extend(examples_from_workbook(path))
+    if finetune_jsonl:
+        examples.extend(examples_from_finetune_jsonl(finetune_jsonl, cde_file))
+    examples.extend(examples_from_crf_descriptions(crf_descriptions))
+    df = pd.DataFrame(examples, columns=["text", "label", "source"])
+    df["text"] = df["text"].map(_clean)
+    return df.drop_duplicates(subset=["text", "label"]).reset_index(drop=True)
+
+
+# --- model -----------------------------------------------------------------
+
+def _pipeline(cv):
+    features = FeatureUnion([
+        ("char", TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 5), sublinear_tf=True, lowercase=True)),
+        ("word", TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True, lowercase=True)),
+    ])
+    base = LogisticRegression(max_iter=2000, C=10, class_weight="balanced")
+    return Pipeline([
+        ("features", features),
+        ("clf", CalibratedClassifierCV(base, method="sigmoid", cv=cv)),
+    ])
+
+
+class LocalCRFMatcher:
+    """Calibrated CPU classifier from form text to a HEAL Core CRF label (or No CRF match)."""
+
+    def __init__(self, pipeline, meta=None):
+        self.pipeline = pipeline
+        self.meta = meta or {}
+
+    @classmethod
+    def train(cls, training_df, cv=3):
+        # every class needs at least `cv` examples for calibration folds
+        counts = training_df["label"].value_counts()
+        padded = [training_df]
+        for label, n in counts[counts < cv].items():
+            rows = training_df[training_df["label"] == label]
+            padded.append(rows.sample(cv - n, replace=True, random_state=0))
+        data = pd.concat(padded, ignore_index=True)
+
+        pipeline = _pipeline(cv).fit(data["text"], data["label"])
+        meta = {
+            "trained_at": datetime.now().isoformat(timespec="seconds"),
+            "examples": int(len(training_df)),
+            "classes": sorted(counts.index.tolist()),
+            "sources": sorted(training_df["source"].unique().tolist()),
+        }
+        return cls(pipeline, meta)
+
+    def predict(self, texts):
+        """Return [(label, probability), ...] for each text."""
+        texts = [_clean(t) for t in texts]
+        if not texts:
+            return []
+        proba = self.pipeline.predict_proba(texts)
+        classes = self.pipeline.classes_
+        best = proba.argmax(axis=1)
+        return [(classes[i], float(proba[row, i])) for row, i in enumerate(best)]
+
+    def save(self, path=DEFAULT_MODEL_FILE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        joblib.dump({"pipeline": self.pipeline, "meta": self.meta}, path)
+
+    @classmethod
+    def load(cls, path=DEFAULT_MODEL_FILE):
+        blob = joblib.load(path)
+        return cls(blob["pipeline"], blob.get("meta"))
+
+
+# --- command line ----------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train or query the offline HEAL Core CRF matcher.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    train = sub.add_parser("train", help="Train from validated dictionaries")
+    train.add_argument("--validated-dir", default=DEFAULT_VALIDATED_DIR)
+    train.add_argument("--confirmed", default=DEFAULT_CONFIRMED_GLOB,
+                       help="Glob of reviewer-confirmed outputs")
+    train.add_argument("--finetune-jsonl", default=DEFAULT_FINETUNE_JSONL)
+    train.add_argument("--crf-descriptions", default=DEFAULT_CRF_DESCRIPTIONS)
+    train.add_argument("--cde-file", default=DEFAULT_CDE_FILE)
+    train.add_argument("-o", "--out", default=DEFAULT_MODEL_FILE)
+
+    classify = sub.add_parser("classify", help="Classify one or more form texts")
+    classify.add_argument("texts", nargs="+")
+    classify.add_argument("-m", "--model", default=DEFAULT_MODEL_FILE)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "train":
+        df = build_training_set(args.validated_dir, args.confirmed, args.finetune_jsonl,
+                                args.crf_descriptions, args.cde_file)
+        print(f"Training examples: {len(df)} from {df['source'].nunique()} files")
+        print(df["label"].value_counts().to_string())
+        # calibration inside each fold needs >= 2 examples per class, so only
+        # classes with >= 6 examples take part in the estimate
+        counts = df["label"].value_counts()
+        cv_df = df[df["label"].isin(counts[counts >= 6].index)]
+        scores = cross_val_score(_pipeline(2), cv_df["text"], cv_df["label"], cv=3)
+        print(f"3-fold accuracy ({cv_df['label'].nunique()} classes with >= 6 examples): "
+              f"{scores.mean():.3f} (+/- {scores.std():.3f})")
+        matcher = LocalCRFMatcher.train(df)
+        matcher.save(args.out)
+        print(f"✅ Saved local matcher to {args.out}")
+    else:
+        matcher = LocalCRFMatcher.load(args.model)
+        started = time.perf_counter()
+        results = matcher.predict(args.texts)
+        elapsed = time.perf_counter() - started
+        for text, (label, p) in zip(args.texts, results):
+            print(f"{label}\t{p:.3f}\t{text}")
+        print(f"({len(results)} forms in {elapsed * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
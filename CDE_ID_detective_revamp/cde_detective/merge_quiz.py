@@ -0,0 +1,141 @@
+"""
+Interactive merge quiz for near-duplicate Canonical CRF Names.
+
+    cde-detective merge-quiz out/Study_2025-08-07.xlsx
+"""
+
+import pandas as pd
+from rapidfuzz import fuzz
+
+from .normalize import normalize, normalize_series
+from .workbook import CANONICAL_COL, RATIONALE_COL, build_metadata, build_report, write_review_workbook
+
+DESCRIPTION_COL      = "Field Label"
+MERGES_FILE          = "confirmed_merges.csv"  # optional CSV output
+SIMILARITY_THRESHOLD = 85
+
+
+def run_quiz(df: pd.DataFrame, threshold: int = SIMILARITY_THRESHOLD,
+             merges_file: str = MERGES_FILE, description_col: str = DESCRIPTION_COL) -> pd.DataFrame:
+    """
+    Interactive merge quiz on unique canonical names.
+    Returns a DataFrame of confirmed merges with columns:
+      Canonical1, Canonical2, MergedName
+    """
+    # 1) unique canonicals
+    canonicals = df[CANONICAL_COL].dropna().unique()
+    # 2) normalize & map
+    norm = [normalize(c, "crf_key") for c in canonicals]
+    norm_map = dict(zip(norm, canonicals))
+    # 3) fuzzy-match pairs
+    matches = []
+    seen = set()
+    for i, a in enumerate(norm):
+        for j, b in enumerate(norm):
+            if i >= j:
+                continue
+            pair = tuple(sorted([a, b]))
+            if pair in seen:
+                continue
+            score = fuzz.token_sort_ratio(a, b)
+            if score >= threshold:
+                c1, c2 = norm_map[a], norm_map[b]
+                matches.append((c1, c2, score))
+            seen.add(pair)
+
+    # 4) interactive quiz
+    confirmed = []
+    decisions = {}  # (c1, c2) -> merged_name or None
+    print(f"\n--- Canonical-name Merge Quiz (Threshold: {threshold}) ---\n")
+    for c1, c2, score in matches:
+        key = (c1, c2)
+        # auto-apply
+        if key in decisions:
+            merged = decisions[key]
+            if merged:
+                confirmed.append((c1, c2, merged))
+                print(f"↪ Auto-merge {c1} ←→ {c2} → '{merged}'")
+            else:
+                print(f"↪ Auto-skip  {c1} ←→ {c2}")
+            continue
+
+        # prompt
+        row1 = df[df[CANONICAL_COL] == c1].iloc[0]
+        row2 = df[df[CANONICAL_COL] == c2].iloc[0]
+        print(f"\nPotential match (Score: {score})")
+        print(f"  1) Canonical: {c1}")
+        print(f"     Description: {row1[description_col]}")
+        print(f"     Rationale:   {row1[RATIONALE_COL]}")
+        print(f"  2) Canonical: {c2}")
+        print(f"     Description: {row2[description_col]}")
+        print(f"     Rationale:   {row2[RATIONALE_COL]}")
+        ans = input("\n[y]es / [n]o / [c]ustom / [s]kip all: ").strip().lower()
+        if ans == "s":
+            print("⏭ Skipping all remaining.")
+            break
+        if ans == "y":
+            merged_name = c1
+        elif ans == "c":
+            merged_name = input("Enter custom merged name: ").strip()
+        else:
+            merged_name = None
+
+        decisions[key] = merged_name
+        if merged_name:
+            confirmed.append((c1, c2, merged_name))
+            print(f"✔ Scheduled merge as '{merged_name}'")
+        else:
+            print("✖ Skipping this pair")
+
+    # build DataFrame
+    merges_df = (
+        pd.DataFrame(confirmed, columns=["Canonical1", "Canonical2", "MergedName"])
+    )
+    # optional CSV dump
+    if not merges_df.empty and merges_file:
+        merges_df.to_csv(merges_file, index=False)
+        print(f"\nSaved merge decisions to {merges_file}")
+    else:
+        print("\nNo merges confirmed.")
+
+    return merges_df
+
+
+def apply_merges(df: pd.DataFrame, merges_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Apply confirmed merges to df[CANONICAL_COL], prettify names,
+    and return the updated DataFrame.
+    """
+    if not merges_df.empty:
+        replace_map = {}
+        for _, row in merges_df.iterrows():
+            replace_map[row["Canonical1"]] = row["MergedName"]
+            replace_map[row["Canonical2"]] = row["MergedName"]
+        df[CANONICAL_COL] = df[CANONICAL_COL].replace(replace_map)
+    else:
+        print("→ No merges to apply, skipping replace step.")
+
+    # prettify
+    df[CANONICAL_COL] = normalize_series(df[CANONICAL_COL], "display")
+    return df
+
+
+def merge_canonical_names(input_file, output_file, sheet_name="EnhancedDD", crf_col="Form Name",
+                          description_col=DESCRIPTION_COL, threshold=SIMILARITY_THRESHOLD,
+                          merges_file=MERGES_FILE):
+    from .results import load_enhanced
+
+    # load
+    df = load_enhanced(input_file, sheet_name=sheet_name, categorical=[crf_col])
+
+    # run quiz & apply merges
+    merges_df = run_quiz(df, threshold=threshold, merges_file=merges_file, description_col=description_col)
+    df_merged = apply_merges(df, merges_df)
+
+    # build downstream artifacts
+    metadata_df = build_metadata(df_merged, crf_col)
+    metadata_df[CANONICAL_COL] = normalize_series(metadata_df[CANONICAL_COL], "display")
+    report_df   = build_report(df_merged, crf_col)
+
+    # write out everything
+    write_review_workbook(output_file, df_merged, metadata_df, report_df, sheet_name=sheet_name)
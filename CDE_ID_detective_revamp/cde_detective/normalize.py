@@ -0,0 +1,99 @@
+"""
+Text normalization shared by the harmonizer, the merge quiz, the encoding
+search and the form signature index.
+
+Each profile is a fixed sequence of precompiled substitutions applied after
+lowercasing. normalize() is the scalar path, memoized because the same form
+names and labels come back on every row; normalize_series() runs the same
+steps over a whole column with the vectorized .str methods.
+
+    crf_key   keys for comparing CRF names (merge quiz): "_"/"-" become spaces, punctuation dropped
+    crf_core  crf_key without generic words ("form", "log", ...), for clustering (harmonizer)
+    label     field labels and variable names: letters, digits and spaces only
+    encoding  label text that keeps "=" (as in "1=Yes"), used for KB / study search text
+    stem      question stems for exact lookup: label with HTML tags and item numbering ("1.", "Q3)") removed
+    display   human-readable names: "_"/"-" runs become spaces, case kept
+"""
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+import pandas as pd
+
+_SEPARATORS = (re.compile(r"[_\-]+"), " ")
+_WHITESPACE = (re.compile(r"\s+"), " ")
+
+
+@dataclass(frozen=True)
+class Profile:
+    name: str
+    steps: tuple              # ((compiled pattern, replacement), ...) applied in order
+    lower: bool = True
+    keep_missing: bool = False  # non-text values pass through instead of becoming ""
+
+
+PROFILES = {
+    profile.name: profile
+    for profile in (
+        Profile("crf_key", (_SEPARATORS, (re.compile(r"[^\w\s]"), ""), _WHITESPACE)),
+        Profile("crf_core", (
+            _SEPARATORS,
+            (re.compile(r"[^a-z0-9\s]"), ""),
+            (re.compile(r"\b(?:forms?|logs?|assessments?|information|status)\b"), ""),
+            _WHITESPACE,
+        )),
+        Profile("label", ((re.compile(r"[^a-z0-9\s]"), ""), _WHITESPACE)),
+        Profile("encoding", ((re.compile(r"[^a-z0-9\s=]"), ""), _WHITESPACE)),
+        Profile("stem", (
+            (re.compile(r"<[^>]*>"), " "),
+            (re.compile(r"^\s*(?:q(?:uestion)?\s*)?(?:\d+[a-z]?|[a-z])\s*[.):]\s+"), ""),
+            (re.compile(r"[^a-z0-9\s]"), ""),
+            _WHITESPACE,
+        )),
+        Profile("display", (_SEPARATORS, _WHITESPACE), lower=False, keep_missing=True),
+    )
+}
+
+
+def _profile(profile):
+    try:
+        return PROFILES[profile] if isinstance(profile, str) else profile
+    except KeyError:
+        raise ValueError(f"unknown normalization profile {profile!r}; expected one of {sorted(PROFILES)}")
+
+
+@lru_cache(maxsize=1 << 16)
+def _normalize_text(profile, text):
+    if profile.lower:
+        text = text.lower()
+    for pattern, replacement in profile.steps:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+
+def normalize(value, profile="encoding"):
+    """Normalize one value; non-text values give "" (or come back unchanged for `display`)."""
+    profile = _profile(profile)
+    if not isinstance(value, str):
+        return value if profile.keep_missing else ""
+    return _normalize_text(profile, value)
+
+
+def normalize_series(series, profile="encoding"):
+    """normalize() over a whole column, one vectorized pass per step."""
+    profile = _profile(profile)
+    values = series.astype(object)
+    is_text = values.map(lambda v: isinstance(v, str), na_action="ignore").fillna(False).astype(bool)
+    text = values[is_text].astype(str)
+    if profile.lower:
+        text = text.str.lower()
+    for pattern, replacement in profile.steps:
+        text = text.str.replace(pattern, replacement, regex=True)
+    out = values.copy() if profile.keep_missing else pd.Series("", index=series.index, dtype=object)
+    out[is_text] = text.str.strip()
+    return out
+
+
+def cache_info():
+    """Hit/miss counts of the memoized scalar path."""
+    return _normalize_text.cache_info()
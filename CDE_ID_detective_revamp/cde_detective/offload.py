@@ -0,0 +1,220 @@
+"""
+Keeping the event loop free for API traffic ([EventLoop] in config_prestep.ini).
+
+One event loop drives every request of a run (and, in the service, of every
+job). Anything synchronous on it (workbook reads and writes, pandas joins,
+local clustering, ledger JSON, printing full responses) holds all in-flight
+requests until it returns. The pipeline moves that work off the loop:
+
+    in_thread(func, ...)   blocking file I/O and pandas, via asyncio.to_thread
+    in_process(func, ...)  pure-Python CPU work in a shared process pool
+                           (arguments and result must pickle); a thread when
+                           [EventLoop] processes = 0
+    output                 the stages' progress logger (cde_detective.output)
+    queued_output()        output.info() only puts the line on a queue; a listener
+                           thread writes it out (logging QueueHandler/QueueListener)
+    watch_loop()           samples how late the loop wakes up; its LoopStats
+                           summary reports lag percentiles, stalls per stage and
+                           how much work was offloaded
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+
+PROCESSES = 1
+QUEUED_OUTPUT = True
+LAG_INTERVAL = 0.05   # seconds between lag samples
+STALL_MS = 100        # a wakeup later than this counts as a stall
+
+_pool = None
+_pool_lock = threading.Lock()
+_current_stats = contextvars.ContextVar("loop_stats", default=None)
+
+
+def configure_offload(config):
+    """Override the module settings from an [EventLoop] section, if present."""
+    global PROCESSES, QUEUED_OUTPUT, LAG_INTERVAL, STALL_MS
+    if config is not None and config.has_section("EventLoop"):
+        PROCESSES = config.getint("EventLoop", "processes", fallback=PROCESSES)
+        QUEUED_OUTPUT = config.getboolean("EventLoop", "queued_output", fallback=QUEUED_OUTPUT)
+        LAG_INTERVAL = config.getfloat("EventLoop", "lag_interval", fallback=LAG_INTERVAL)
+        STALL_MS = config.getfloat("EventLoop", "stall_ms", fallback=STALL_MS)
+
+
+@dataclass
+class LoopStats:
+    lags: list = field(default_factory=list)         # seconds late, one per wakeup
+    stalls: dict = field(default_factory=dict)       # stage -> [count, worst seconds]
+    offloaded: dict = field(default_factory=dict)    # "thread"/"process" -> [calls, seconds]
+    stage: str = None
+
+    def record_lag(self, lag, stall_ms=None):
+        self.lags.append(lag)
+        if lag * 1000 > (STALL_MS if stall_ms is None else stall_ms):
+            count, worst = self.stalls.get(self.stage, (0, 0.0))
+            self.stalls[self.stage] = [count + 1, max(worst, lag)]
+
+    def record_offload(self, kind, seconds):
+        calls, total = self.offloaded.get(kind, (0, 0.0))
+        self.offloaded[kind] = [calls + 1, total + seconds]
+
+    def summary(self):
+        if not self.lags:
+            return "[Loop] no lag samples"
+        lags = sorted(self.lags)
+
+        def ms(q):
+            return f"{lags[min(int(q * len(lags)), len(lags) - 1)] * 1000:.1f}ms"
+
+        stalls = sum(count for count, _ in self.stalls.values())
+        text = (f"[Loop] lag p50 {ms(0.5)}, p95 {ms(0.95)}, max {lags[-1] * 1000:.0f}ms over "
+                f"{len(lags)} wakeups; {stalls} stalls > {STALL_MS:g}ms")
+        if stalls:
+            text += " (" + ", ".join(f"{stage or 'setup'} {count}, worst {worst * 1000:.0f}ms"
+                                     for stage, (count, worst) in self.stalls.items()) + ")"
+        if self.offloaded:
+            text += "; offloaded " + ", ".join(f"{kind} {calls} calls {seconds:.1f}s"
+                                               for kind, (calls, seconds) in self.offloaded.items())
+        return text
+
+
+# --- offloading --------------------------------------------------------------------
+
+def _record(kind, started):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.record_offload(kind, time.perf_counter() - started)
+
+
+async def in_thread(func, *args, **kwargs):
+    """await func(*args, **kwargs) in a worker thread."""
+    started = time.perf_counter()
+    try:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    finally:
+        _record("thread", started)
+
+
+def process_pool():
+    """The shared process pool (created on first use); None when [EventLoop] processes = 0."""
+    global _pool
+    if PROCESSES <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # fork is unsafe once the service's loop and HTTP threads are running
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(max_workers=PROCESSES, mp_context=multiprocessing.get_context(method))
+        return _pool
+
+
+async def in_process(func, *args, **kwargs):
+    """
+    await func(*args, **kwargs) in the process pool (a thread when the pool is off).
+    If the workers cannot start, e.g. a script without an `if __name__ == "__main__":`
+    guard, the pool is switched off for the rest of the session.
+    """
+    global PROCESSES, _pool
+    pool = process_pool()
+    if pool is None:
+        return await in_thread(func, *args, **kwargs)
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, functools.partial(func, *args, **kwargs))
+    except BrokenProcessPool:
+        output.info("[Loop] Process pool unavailable; CPU-bound steps run in a thread instead")
+        with _pool_lock:
+            PROCESSES, _pool = 0, None
+        return await in_thread(func, *args, **kwargs)
+    finally:
+        _record("process", started)
+
+
+# --- event-loop lag ------------------------------------------------------------------
+
+async def _sample_lag(stats, interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        stats.record_lag(max(loop.time() - started - interval, 0.0))
+
+
+@asynccontextmanager
+async def watch_loop(stats=None, interval=None):
+    """
+    Sample the running loop's lag into `stats` (a new LoopStats by default) for the
+    duration of the block. in_thread/in_process calls made inside it, including
+    from tasks it creates, are counted there as well.
+    """
+    stats = stats or LoopStats()
+    token = _current_stats.set(stats)
+    sampler = asyncio.create_task(_sample_lag(stats, interval or LAG_INTERVAL))
+    try:
+        yield stats
+    finally:
+        sampler.cancel()
+        _current_stats.reset(token)
+
+
+# --- pipeline output -----------------------------------------------------------------
+
+class _StdoutHandler(logging.StreamHandler):
+    """Writes to whatever sys.stdout is when the record is emitted (notebooks, pytest capture)."""
+
+    def emit(self, record):
+        self.stream = sys.stdout
+        super().emit(record)
+
+
+_stdout = _StdoutHandler()
+_stdout.setFormatter(logging.Formatter("%(message)s"))
+
+# Progress and stats lines of the pipeline stages: output.info(...) where a
+# script would print(). Written straight to stdout unless queued_output() is active.
+output = logging.getLogger("cde_detective.output")
+output.setLevel(logging.INFO)
+output.propagate = False
+output.handlers[:] = [_stdout]
+
+_output_lock = threading.Lock()
+_output = {"users": 0, "listener": None}
+
+
+@contextmanager
+def queued_output(enabled=None):
+    """
+    For the duration of the block, `output` records only go on a queue
+    (QueueHandler); a QueueListener thread writes them to stdout. sys.stdout
+    itself is left alone. Re-entrant, so concurrent service jobs can each use it.
+    """
+    if not (QUEUED_OUTPUT if enabled is None else enabled):
+        yield
+        return
+    with _output_lock:
+        if _output["users"] == 0:
+            records = queue.SimpleQueue()
+            output.handlers[:] = [logging.handlers.QueueHandler(records)]
+            _output["listener"] = logging.handlers.QueueListener(records, _stdout)
+            _output["listener"].start()
+        _output["users"] += 1
+    try:
+        yield
+    finally:
+        with _output_lock:
+            _output["users"] -= 1
+            if _output["users"] == 0:
+                output.handlers[:] = [_stdout]
+                _output["listener"].stop()  # writes out whatever is still queued
+                _output["listener"] = None
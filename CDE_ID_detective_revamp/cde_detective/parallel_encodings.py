@@ -0,0 +1,190 @@
+"""
+Multi-process encoding search over many study dictionaries (or row shards of
+one large dictionary).
+
+The CDE sheet is loaded and normalized once, then packed into a flat,
+read-only memory-mapped file (utf-8 blob + int64 offsets). Workers map that
+file instead of re-reading the Excel sheet; each builds its partitions once
+from the mapped buffer. Shard results are merged back by (file, shard) index,
+so the output is identical to compare_encodings regardless of completion order.
+
+    cde-detective encodings out/ --processes 32
+"""
+import mmap
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from .encodings import (
+    DEFAULT_CDE_FILE,
+    apply_matches,
+    build_stem_index,
+    load_cde_kb,
+    load_study,
+    question_stems,
+    save_results,
+    search_texts,
+)
+from .loader import CACHE_DIR_NAME, file_digest
+
+KB_MAGIC = b"CDEKB001"
+KB_FIELDS = ("Variable Name", "Normalized Combined", "CRF Name")
+_HEADER = np.dtype([("magic", "S8"), ("rows", "<i8"), ("fields", "<i8")])
+
+
+# --- packed knowledge base -------------------------------------------------------
+
+def _as_text(value):
+    return "" if value is None or value != value else str(value)
+
+
+def kb_path(cde_file, cache_dir=None):
+    """Packed KB file next to the loader's Parquet sidecars, keyed by the CDE file's content."""
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(cde_file)), CACHE_DIR_NAME)
+    stem = os.path.basename(cde_file).rsplit(".", 1)[0]
+    return os.path.join(cache_dir, f"{stem}.{file_digest(cde_file)[:16]}.kb")
+
+
+def pack_kb(cde_df, path):
+    """Write KB_FIELDS of a load_cde_kb() frame as header | offsets[fields, rows + 1] | utf-8 blob."""
+    columns = [[_as_text(v).encode("utf-8") for v in cde_df[name]] for name in KB_FIELDS]
+    rows = len(cde_df)
+    offsets = np.zeros((len(KB_FIELDS), rows + 1), dtype="<i8")
+    base = 0
+    for f, values in enumerate(columns):
+        offsets[f, 0] = base
+        offsets[f, 1:] = base + np.cumsum([len(v) for v in values], dtype="<i8")
+        base = int(offsets[f, -1])
+
+    header = np.array([(KB_MAGIC, rows, len(KB_FIELDS))], dtype=_HEADER)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(header.tobytes())
+        f.write(offsets.tobytes())
+        for values in columns:
+            f.write(b"".join(values))
+    os.replace(tmp, path)
+    return path
+
+
+def publish_kb(cde_file=DEFAULT_CDE_FILE, cache_dir=None):
+    """Path of the packed KB for `cde_file`, building it (load + normalize once) if needed."""
+    path = kb_path(cde_file, cache_dir)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pack_kb(load_cde_kb(cde_file), path)
+        print(f"[Encodings] packed KB written to {path}")
+    return path
+
+
+class MappedKB:
+    """Read-only view of a packed KB file; strings are decoded straight from the mapping."""
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = np.frombuffer(self._map, dtype=_HEADER, count=1)[0]
+        if header["magic"] != KB_MAGIC:
+            raise ValueError(f"not a packed CDE knowledge base: {path}")
+        self.rows = int(header["rows"])
+        fields = int(header["fields"])
+        self.offsets = np.frombuffer(self._map, dtype="<i8", count=fields * (self.rows + 1),
+                                     offset=_HEADER.itemsize).reshape(fields, self.rows + 1)
+        self._data_start = _HEADER.itemsize + self.offsets.nbytes
+
+    def column(self, field):
+        f = KB_FIELDS.index(field)
+        starts = self.offsets[f, :-1] + self._data_start
+        ends = self.offsets[f, 1:] + self._data_start
+        return [self._map[a:b].decode("utf-8") for a, b in zip(starts.tolist(), ends.tolist())]
+
+    def partitions(self):
+        """Same structure as encodings.partition_cde_kb, built from the mapping."""
+        rows = list(zip(*(self.column(field) for field in KB_FIELDS)))
+        partitions = {None: rows}
+        for row in rows:
+            partitions.setdefault(row[2].strip(), []).append(row)
+        return partitions
+
+
+# --- workers -----------------------------------------------------------------------
+
+_PARTITIONS = None
+_STEM_INDEX = None
+
+
+def _init_worker(path, stem_index=None):
+    global _PARTITIONS, _STEM_INDEX
+    _PARTITIONS = MappedKB(path).partitions()
+    _STEM_INDEX = stem_index
+
+
+def _search_shard(file_idx, shard_idx, texts, heal_matches, fallback_threshold, stems=None):
+    return file_idx, shard_idx, search_texts(texts, heal_matches, _PARTITIONS, fallback_threshold,
+                                             stems=stems, stem_index=_STEM_INDEX)
+
+
+def _shards(n, shard_rows):
+    return [(start, min(start + shard_rows, n)) for start in range(0, n, shard_rows)] or [(0, 0)]
+
+
+def compare_encodings_parallel(
+    study_files,
+    encoding_column='encodings',
+    field_label_column='field_label',
+    cde_file=DEFAULT_CDE_FILE,
+    study_sheet='Sheet1',
+    partitioned=True,
+    fallback_threshold=70,
+    output_dir='out',
+    processes=None,
+    shard_rows=500,
+    exact_stems=True,
+):
+    """
+    compare_encodings for every file in `study_files`, spread over a process pool.
+
+    Each study is split into shards of `shard_rows` rows; a file's workbook is
+    written as soon as all of its shards are back. Returns the output paths in
+    the order of `study_files`.
+    """
+    start = time.perf_counter()
+    path = publish_kb(cde_file)
+    processes = processes or os.cpu_count()
+    # the stem index is small; each worker gets its own copy once, at start-up
+    stem_index = build_stem_index(load_cde_kb(cde_file)) if exact_stems else None
+
+    outputs = [None] * len(study_files)
+    studies, pending = {}, {}
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(path, stem_index)) as pool:
+        futures = []
+        for file_idx, study_file in enumerate(study_files):
+            study_df, skipped_df = load_study(study_file, encoding_column, field_label_column, study_sheet)
+            texts = study_df['Normalized Combined'].tolist()
+            has_match_col = partitioned and 'HEAL Core CRF Match' in study_df.columns
+            heal_matches = study_df['HEAL Core CRF Match'].astype(object).tolist() if has_match_col else None
+            stems = question_stems(study_df, field_label_column) if stem_index else None
+            shards = _shards(len(texts), shard_rows)
+            studies[file_idx] = (study_file, study_df, skipped_df)
+            pending[file_idx] = [None] * len(shards)
+            for shard_idx, (a, b) in enumerate(shards):
+                futures.append(pool.submit(_search_shard, file_idx, shard_idx, texts[a:b],
+                                           heal_matches[a:b] if heal_matches is not None else None,
+                                           fallback_threshold, stems[a:b] if stems else None))
+
+        for future in as_completed(futures):
+            file_idx, shard_idx, results = future.result()
+            pending[file_idx][shard_idx] = results
+            if any(part is None for part in pending[file_idx]):
+                continue
+            study_file, study_df, skipped_df = studies.pop(file_idx)
+            merged = [r for part in pending.pop(file_idx) for r in part]
+            scopes = apply_matches(study_df, merged)
+            print(f"Search scopes ({os.path.basename(study_file)}): {scopes}")
+            outputs[file_idx] = save_results(study_df, skipped_df, study_file, output_dir, cde_file)
+
+    print(f"[Encodings] {len(study_files)} files on {processes} processes in {time.perf_counter() - start:.1f}s")
+    return outputs
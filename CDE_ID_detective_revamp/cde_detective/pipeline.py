@@ -0,0 +1,337 @@
+"""
+The prestep -> harmonize -> HEAL match pipeline, driven by config_prestep.ini.
+
+Each stage takes and returns an EnhancedDD DataFrame, so the CLI can run the
+whole pipeline on a raw dictionary or re-run a single stage on a workbook.
+"""
+import asyncio
+import os
+import time
+from datetime import date
+
+import pandas as pd
+
+from .budget import DEGRADED_COLUMN, BudgetClient, budget_of, load_budget
+from .cascade import load_cascade
+from .heal_match import run_heal_match, run_heal_match_by_form, speculation_hits
+from .harmonize import harmonize_crf_names_step
+from .loader import load_table
+from .offload import in_thread, output, queued_output, watch_loop
+from .prestep import run_prestep
+from .signatures import load_signature_index, reuse_known_forms
+
+STAGES = ["prestep", "harmonize", "match"]
+
+
+def columns(config):
+    return (
+        config["Columns"]["crf_column"],
+        config["Columns"]["variable_column"],
+        config["Columns"]["description_column"],
+    )
+
+
+def make_client():
+    """AsyncOpenAI client with the key from .env / the environment."""
+    from dotenv import load_dotenv
+    from openai import AsyncOpenAI
+
+    load_dotenv()
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    if not openai_api_key:
+        raise RuntimeError("Missing OPENAI_API_KEY")
+    return AsyncOpenAI(api_key=openai_api_key)
+
+
+def output_layout(config):
+    """[Files] output_layout: "enhanced" (Metadata + EnhancedDD) or "normalized" (see results.py)."""
+    return config.get("Files", "output_layout", fallback="enhanced")
+
+
+def vlmd_formats(config):
+    """[Files] vlmd_formats: VLMD exports written next to the workbook ("json", "csv", both or none)."""
+    return [f.strip() for f in config.get("Files", "vlmd_formats", fallback="").split(",") if f.strip()]
+
+
+def default_output(input_file, output_dir="out"):
+    """out/{input stem}_{today}.xlsx, the naming used for existing outputs."""
+    stem = os.path.basename(input_file).rsplit(".", 1)[0]
+    return os.path.join(output_dir, f"{stem}_{date.today():%Y-%m-%d}.xlsx")
+
+
+async def prestep_stage(client, input_file, config, sheet_name=0, rows=None):
+    """
+    Prestep on the three configured columns, joined back onto the full sheet.
+    `rows` limits the run to those index labels (e.g. the rows no known form covered).
+    """
+    crf_column, variable_column, description_column = columns(config)
+
+    # Load just the columns we need for prestep
+    data_dict_df = await in_thread(load_table, input_file, sheet_name=sheet_name,
+                                   usecols=[crf_column, variable_column, description_column], categorical=[])
+    if rows is not None:
+        data_dict_df = data_dict_df.loc[rows].copy()
+
+    # Prestep: get Refined CRF Name, Rationale, Full Response
+    refined_df = await run_prestep(
+        client, data_dict_df, config["Instructions"]["crf_id_prestep"],
+        crf_column=crf_column,
+        variable_column=variable_column,
+        description_column=description_column,
+        chunk_size=50,
+        cascade=load_cascade(config),
+    )
+
+    # Merge prestep outputs back into the full DataFrame (all original columns)
+    full_input_df = await in_thread(load_table, input_file, sheet_name=sheet_name, categorical=[crf_column])
+    if rows is not None:
+        full_input_df = full_input_df.loc[rows]
+    added = [c for c in ["Refined CRF Name", "Rationale", "Full Response", DEGRADED_COLUMN] if c in refined_df.columns]
+    return await in_thread(full_input_df.join, refined_df[added])
+
+
+async def harmonize_stage(client, df, config, reduce="local"):
+    # Harmonize the refined names: batches go out concurrently (map), then the
+    # per-batch labels are reconciled locally (reduce); use reduce="llm" for one extra call
+    return await harmonize_crf_names_step(client, df, config["Instructions"]["form_harmonizer"],
+                                          batch_size=20, reduce=reduce)
+
+
+def heal_match_mode(config, backend=None):
+    """
+    [Matching] heal_match_mode. The local and hybrid backends only exist at form
+    level, so they switch a row-mode run to form mode rather than silently
+    calling the LLM for every row.
+    """
+    mode = config.get("Matching", "heal_match_mode", fallback="row")
+    backend = backend or config.get("Matching", "backend", fallback="llm")
+    if mode != "form" and backend in ("local", "hybrid"):
+        return "form"
+    return mode
+
+
+async def match_stage(client, df, config, backend=None, local_matcher=None, form_column="Canonical CRF Name",
+                      known=None):
+    """
+    HEAL-Core matching: adds three new columns. Returns (df, FormMatches report or None).
+    Pass an already-loaded `local_matcher` to skip reading [Matching] local_model.
+    `known` forms ({form: decision}, see speculation_hits) are not asked again.
+    """
+    crf_column, variable_column, description_column = columns(config)
+    matching_instruction = config["Instructions"]["matching_instruction"]
+    backend = backend or config.get("Matching", "backend", fallback="llm")
+
+    if heal_match_mode(config, backend) != "form":
+        if load_cascade(config) is not None:
+            output.info("[HEAL-Match] Row mode: [Cascade] applies to the prestep only "
+                        "(heal_match_mode = form cascades the HEAL match too)")
+        return await run_heal_match(client, df, matching_instruction, chunk_size=50), None
+    if config.get("Matching", "heal_match_mode", fallback="row") != "form":
+        output.info(f"[HEAL-Match] backend = {backend} runs per form; using form mode")
+
+    local_model = config.get("Matching", "local_model", fallback="models/heal_match_local.joblib")
+    fallback_matcher = None
+    if backend not in ("local", "hybrid"):
+        # under a budget the classifier still decides the forms the budget cuts off
+        if budget_of(client) is not None and (local_matcher is not None or os.path.exists(local_model)):
+            from .local_matcher import LocalCRFMatcher
+
+            fallback_matcher = local_matcher or await in_thread(LocalCRFMatcher.load, local_model)
+        local_matcher = None
+    elif local_matcher is None:
+        from .local_matcher import LocalCRFMatcher
+
+        local_matcher = await in_thread(LocalCRFMatcher.load, local_model)
+    escalate_below = config.getfloat("Matching", "escalate_below", fallback=0.8)
+    return await run_heal_match_by_form(
+        client, df, matching_instruction,
+        variable_column=variable_column,
+        description_column=description_column,
+        form_column=form_column,
+        crf_column=crf_column,
+        sample_size=config.getint("Matching", "form_sample_size", fallback=8),
+        local_matcher=local_matcher,
+        escalate_below=0 if backend == "local" else escalate_below,
+        cascade=load_cascade(config),
+        fallback_matcher=fallback_matcher,
+        known=known,
+    )
+
+
+def speculative(config, backend=None):
+    """[Matching] speculative: form-level HEAL match on the raw form names while the prestep runs."""
+    backend = backend or config.get("Matching", "backend", fallback="llm")
+    return (config.getboolean("Matching", "speculative", fallback=False)
+            and heal_match_mode(config, backend) == "form"
+            and backend != "local")
+
+
+async def speculative_match_stage(client, input_file, config, sheet_name=0, rows=None, backend=None,
+                                  local_matcher=None):
+    """
+    Form-level HEAL match keyed on the raw form names, meant to run alongside the
+    prestep and harmonizer. Returns ({raw form: (match, confidence, rationale)}, seconds).
+    """
+    crf_column = columns(config)[0]
+    started = time.perf_counter()
+    raw_df = await in_thread(load_table, input_file, sheet_name=sheet_name, categorical=[])
+    if rows is not None:
+        raw_df = raw_df.loc[rows].copy()
+    output.info(f"[HEAL-Match] Speculative pass on {raw_df[crf_column].nunique()} raw forms")
+    _, report = await match_stage(client, raw_df, config, backend, local_matcher, form_column=crf_column)
+    decisions = {
+        record[crf_column]: (record["HEAL Core CRF Match"], record["Confidence Level"], record["Match Rationale"])
+        for record in report.to_dict("records")
+    }
+    return decisions, time.perf_counter() - started
+
+
+def with_budget(client, config, budget_limits=None, shared_budget=None):
+    """
+    (client, budget): `client` wrapped in a BudgetClient when [Budget] is enabled,
+    `budget_limits` ({"max_cost": 2, "deadline_minutes": 30, ...}) sets a limit or
+    there is a `shared_budget` (the service's) to reserve against.
+    """
+    budget = load_budget(config, budget_limits, shared=shared_budget)
+    if budget is None:
+        return client, None
+    output.info(budget.describe())
+    return BudgetClient(client, budget), budget
+
+
+def print_speculation(df, known, refine_seconds, speculate_seconds, form_column="Canonical CRF Name"):
+    forms = df[form_column].astype(object).fillna("").astype(str)
+    total = forms.nunique()
+    hit_rows = int(forms.isin(known).sum())
+    output.info(f"[HEAL-Match] Speculation: {len(known)}/{total} canonical forms kept the raw-name match "
+                f"({len(known) / (total or 1):.0%} hit rate, {hit_rows}/{len(df)} rows), "
+                f"{total - len(known)} re-matched; speculative pass {speculate_seconds:.1f}s "
+                f"alongside prestep + harmonize {refine_seconds:.1f}s")
+
+
+async def run_pipeline(client, input_file, config, output_file, sheet_name=0, stop_after="match",
+                       backend=None, reduce="local", local_matcher=None, on_stage=None, budget_limits=None,
+                       shared_budget=None):
+    """
+    Run prestep through `stop_after` on a raw dictionary and write the EnhancedDD workbook.
+    `on_stage(name)` is called as each stage starts (and with "write" before saving).
+    Under a budget ([Budget], `budget_limits` or `shared_budget`, see cde_detective.budget)
+    rows whose calls the budget refuses are finished locally and marked Degraded.
+    With [Matching] speculative the raw forms are HEAL-matched while the prestep
+    and harmonizer run; only canonical forms that no longer line up with their
+    raw forms are matched again.
+    File I/O, joins and local clustering run off the event loop (see
+    cde_detective.offload) and the loop's lag is reported with the run stats.
+    """
+    with queued_output():
+        async with watch_loop() as loop_stats:
+            def stage_started(stage):
+                loop_stats.stage = stage
+                if on_stage is not None:
+                    on_stage(stage)
+
+            df = await _run_pipeline(client, input_file, config, output_file, sheet_name, stop_after,
+                                     backend, reduce, local_matcher, stage_started, budget_limits, shared_budget)
+        output.info(loop_stats.summary())
+    return df
+
+
+async def _run_pipeline(client, input_file, config, output_file, sheet_name, stop_after, backend, reduce,
+                        local_matcher, on_stage, budget_limits, shared_budget):
+    from .cascade import CASCADE_STATS
+    from .prompts import PROMPT_STATS
+    from .structured import PARSE_STATS
+    from .workbook import write_enhanced_workbook
+
+    crf_column = columns(config)[0]
+    client, budget = with_budget(client, config, budget_limits, shared_budget)
+
+    # Forms already reviewed in another study ([Matching] signature_index) skip every stage
+    reused_df, reuse_report, rows = None, [], None
+    signature_index = await in_thread(load_signature_index, config)
+    if signature_index is not None:
+        on_stage("signatures")
+        full_df = await in_thread(load_table, input_file, sheet_name=sheet_name, categorical=[])
+        reused_df, reuse_report = await in_thread(
+            reuse_known_forms, full_df, signature_index, *columns(config),
+            threshold=config.getfloat("Matching", "signature_threshold", fallback=0.9))
+        rows = full_df.index.difference(reused_df.index)
+
+    report_df = None
+    if rows is not None and len(rows) == 0:
+        df = reused_df
+    else:
+        speculation = None
+        if STAGES.index(stop_after) >= 2 and speculative(config, backend):
+            speculation = asyncio.create_task(speculative_match_stage(
+                client, input_file, config, sheet_name, rows, backend, local_matcher))
+        try:
+            started = time.perf_counter()
+            on_stage("prestep")
+            df = await prestep_stage(client, input_file, config, sheet_name, rows)
+            if STAGES.index(stop_after) >= 1:
+                on_stage("harmonize")
+                df = await harmonize_stage(client, df, config, reduce)
+            if STAGES.index(stop_after) >= 2:
+                known = None
+                if speculation is not None:
+                    refine_seconds = time.perf_counter() - started
+                    decisions, speculate_seconds = await speculation
+                    known = speculation_hits(df, decisions, crf_column)
+                    print_speculation(df, known, refine_seconds, speculate_seconds)
+                on_stage("match")
+                df, report_df = await match_stage(client, df, config, backend, local_matcher, known=known)
+        finally:
+            if speculation is not None and not speculation.done():
+                speculation.cancel()
+            if budget is not None:
+                await in_thread(budget.save_ledger)
+        if reused_df is not None and len(reused_df):
+            df = pd.concat([df, reused_df]).sort_index()
+    if reuse_report:
+        report_df = pd.concat([report_df, pd.DataFrame(reuse_report)], ignore_index=True)
+
+    on_stage("write")
+    await in_thread(write_enhanced_workbook, output_file, df, crf_column, report_df, layout=output_layout(config))
+    if vlmd_formats(config):
+        from .vlmd import export_vlmd, iter_frame_rows
+
+        await in_thread(export_vlmd, iter_frame_rows(df), os.path.splitext(output_file)[0], vlmd_formats(config),
+                        columns=columns(config))
+    output.info(PARSE_STATS.summary())
+    output.info(PROMPT_STATS.summary())
+    if CASCADE_STATS.items:
+        output.info(CASCADE_STATS.summary())
+    if budget is not None:
+        output.info(budget.summary(df))
+    return df
+
+
+async def run_stage_on_workbook(client, stage, workbook, config, output_file=None, backend=None,
+                                reduce="local", budget_limits=None):
+    """Re-run `harmonize` or `match` on an existing EnhancedDD workbook."""
+    from .results import load_enhanced
+    from .workbook import write_enhanced_workbook
+
+    crf_column = columns(config)[0]
+    with queued_output():
+        async with watch_loop() as loop_stats:
+            loop_stats.stage = stage
+            df = await in_thread(load_enhanced, workbook, categorical=[crf_column])
+            client, budget = with_budget(client, config, budget_limits)
+            report_df = None
+            try:
+                if stage == "harmonize":
+                    df = await harmonize_stage(client, df, config, reduce)
+                else:
+                    df, report_df = await match_stage(client, df, config, backend)
+            finally:
+                if budget is not None:
+                    await in_thread(budget.save_ledger)
+            loop_stats.stage = "write"
+            await in_thread(write_enhanced_workbook, output_file or workbook, df, crf_column, report_df,
+                            layout=output_layout(config))
+        if budget is not None:
+            output.info(budget.summary(df))
+        output.info(loop_stats.summary())
+    return df
@@ -0,0 +1,197 @@
+"""
+Prestep: refine each row's form name into a unique, concise CRF name.
+"""
+import asyncio
+from functools import partial
+
+import pandas as pd
+
+from .budget import BudgetExhausted, mark_degraded, or_degrade
+from .cascade import CASCADE_STATS, prestep_outliers
+from .normalize import normalize
+from .offload import output
+from .prompts import PROMPT_STATS, clean_text, compile_messages, dedupe_sentences
+from .structured import (
+    PARSE_STATS,
+    PRESTEP_ALIASES,
+    PRESTEP_SCHEMA,
+    PrestepResponse,
+    StructuredOutputError,
+    structured_completion,
+)
+
+PRESTEP_MODEL = "gpt-4.1-mini"
+PRESTEP_OUTPUT_NOTE = "Please respond in JSON with keys `crf_name` and `rationale` only. Do not wrap in markdown."
+DEGRADED_RATIONALE = "API budget exhausted; kept the original form name."
+
+
+def is_rate_limit(e):
+    msg = str(e).lower()
+    return ("rate limit" in msg) or ("429" in msg) \
+        or (hasattr(e, "code") and e.code == "rate_limit_exceeded")
+
+
+def prestep_descriptions(df, variable_column="Variable / Field Name", description_column="Field Label",
+                         stats=None):
+    """
+    The Descriptions text sent for each row of `df` (a list, in row order):
+    cleaned with the dictionary's own variable names counted as piping, and
+    without the boilerplate sentences an earlier row already sent (one `seen`
+    set for the whole run). The tokens removed are counted in `stats`.
+    """
+    stats = stats or PROMPT_STATS
+    field_names = set(df[variable_column].dropna().astype(str).str.lower())
+    descriptions = dedupe_sentences([clean_text(d, field_names) for d in df[description_column]], set())
+    stats.add_precleaned("prestep", df[description_column], descriptions)
+    return descriptions
+
+
+def prestep_messages(variable_names, crf_name, descriptions, instruction):
+    """Chat messages for one prestep request (shared by live and batch runs)."""
+    return compile_messages(
+        "prestep",
+        instruction,
+        {
+            "Variable names": variable_names,
+            "Original form name": crf_name,
+            "Descriptions": descriptions,
+        },
+        output_note=PRESTEP_OUTPUT_NOTE,
+    )
+
+
+# Helper set 1 API call
+async def refine_crf_name_with_variables(client, variable_names, crf_name, descriptions,
+                                         instruction, stats=None, model=PRESTEP_MODEL):
+    """
+    Calls OpenAI to refine/formulate a unique, concise CRF name
+    based on the original CRF name, variable names, and descriptions.
+    """
+    result, full = await structured_completion(
+        client,
+        model,
+        prestep_messages(variable_names, crf_name, descriptions, instruction),
+        "prestep_crf_name",
+        PRESTEP_SCHEMA,
+        PrestepResponse,
+        temperature=0.5,
+        aliases=PRESTEP_ALIASES,
+        stats=stats,
+    )
+    output.info(f"\n--- Full Prestep Response ---\n {full} \n--- End ---\n")
+
+    refined = result.crf_name.strip() or crf_name
+    # store the validated JSON, not the raw (possibly repaired) text
+    return refined, result.rationale.strip(), result.model_dump_json()
+
+
+def local_prestep(crf_name):
+    """Prestep result without the API, for rows the budget cut off: the original form name, tidied."""
+    refined = normalize(crf_name, "display") if isinstance(crf_name, str) else ""
+    return refined or crf_name, DEGRADED_RATIONALE, \
+        PrestepResponse(crf_name=refined, rationale=DEGRADED_RATIONALE).model_dump_json()
+
+
+async def refine_with_retry(client, var, crf, desc, instruction, tries=5, stats=None, model=PRESTEP_MODEL):
+    stats = stats or PARSE_STATS
+    backoff = 1
+    for attempt in range(1, tries + 1):
+        try:
+            return await refine_crf_name_with_variables(client, var, crf, desc, instruction, stats, model)
+        except BudgetExhausted:
+            raise
+        except StructuredOutputError as e:
+            output.info(f"[parse] prestep attempt {attempt} unrepairable: {e}")
+            if attempt == tries:
+                return crf, "", e.raw
+            stats.parse_retries += 1
+            continue
+        except Exception as e:
+            if is_rate_limit(e):
+                output.info(f"[rate limit] prestep attempt {attempt}, sleeping {backoff}s")
+            else:
+                output.info(f"[warning] prestep failed attempt {attempt}: {e}")
+
+            if attempt == tries:
+                return crf, "", ""
+
+            await asyncio.sleep(backoff)
+            backoff *= 2
+
+
+async def _prestep_rows(client, df, descriptions, instruction, crf_column, variable_column,
+                        chunk_size, stats, model):
+    """
+    [(refined, rationale, full response)] and, per row, whether the budget forced the local fallback.
+    `descriptions` are the rows' prestep_descriptions, in the same order.
+    """
+    results, degraded = [], []
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start+chunk_size]
+        tasks = [
+            or_degrade(
+                refine_with_retry(
+                    client,
+                    row[variable_column],
+                    row[crf_column],
+                    description,
+                    instruction,
+                    stats=stats,
+                    model=model,
+                ),
+                partial(local_prestep, row[crf_column]),
+            )
+            for (_, row), description in zip(chunk.iterrows(), descriptions[start:start+chunk_size])
+        ]
+        for result, cut in await asyncio.gather(*tasks):
+            results.append(result)
+            degraded.append(cut)
+        # slight pause between chunks to smooth out rate
+        if not all(degraded[start:]):
+            await asyncio.sleep(1)
+    return results, degraded
+
+
+#loop call row-by-row, run prestep
+async def run_prestep(client, df, instruction, crf_column="Form Name",
+                      variable_column="Variable / Field Name",
+                      description_column="Field Label", chunk_size=50, stats=None, cascade=None):
+    """
+    Adds Refined CRF Name, Rationale and Full Response to `df`.
+    With a `cascade` (cascade.load_cascade) every row goes to the fast model and
+    only the rows prestep_outliers flags are asked again with the strong model.
+    Rows the API budget (budget.BudgetClient) cut off keep their original form
+    name and are marked in the Degraded column. Boilerplate sentences repeated
+    across rows are sent with the first row only (prestep_descriptions).
+    """
+    columns = (crf_column, variable_column)
+    descriptions = prestep_descriptions(df, variable_column, description_column)
+    if cascade is None:
+        results, degraded = await _prestep_rows(client, df, descriptions, instruction, *columns, chunk_size,
+                                                stats, PRESTEP_MODEL)
+    else:
+        with CASCADE_STATS.tier("prestep", cascade.fast_model, len(df)):
+            results, degraded = await _prestep_rows(client, df, descriptions, instruction, *columns, chunk_size,
+                                                    stats, cascade.fast_model)
+        names, rats, _ = zip(*results) if results else ((), (), ())
+        escalate = [i for i in prestep_outliers(df[crf_column].astype(object).tolist(), names, rats)
+                    if not degraded[i]]
+        output.info(f"[Prestep] Cascade: {len(df) - len(escalate)} rows kept from {cascade.fast_model}, "
+                    f"{len(escalate)} escalated to {cascade.strong_model}")
+        if escalate:
+            CASCADE_STATS.escalate("prestep", len(escalate))
+            with CASCADE_STATS.tier("prestep", cascade.strong_model, len(escalate)):
+                strong, strong_cut = await _prestep_rows(client, df.iloc[escalate],
+                                                         [descriptions[i] for i in escalate], instruction,
+                                                         *columns, chunk_size, stats, cascade.strong_model)
+            # a strong call the budget cut off keeps the fast answer
+            for i, result, cut in zip(escalate, strong, strong_cut):
+                if not cut:
+                    results[i] = result
+
+    names, rats, fulls = zip(*results) if results else ((), (), ())
+    df["Refined CRF Name"], df["Rationale"], df["Full Response"] = list(names), list(rats), list(fulls)
+    if any(degraded):
+        output.info(f"[Prestep] Budget: {sum(degraded)} of {len(df)} rows kept their original form name")
+        mark_degraded(df, pd.Series(degraded, index=df.index), "prestep")
+    return df
@@ -0,0 +1,234 @@
+"""
+Prompt compiler shared by every LLM stage.
+
+Field text from REDCap/VLMD dictionaries is cleaned (HTML, embedded images,
+piping references, whitespace), repeated boilerplate sentences are dropped,
+and the user message is trimmed to a per-stage token budget. The static
+instruction always goes first, in the system message, so the provider's
+prompt-prefix cache can reuse it across calls.
+"""
+import html
+import json
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+# Token budget for the dynamic (user) part of each stage's prompt
+STAGE_BUDGETS = {
+    "prestep": 400,
+    "heal_match": 1200,
+    "harmonize": 6000,
+}
+
+_DROP_BLOCK_RE = re.compile(r"<(script|style)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_IMG_RE = re.compile(r"<img\b[^>]*>", re.IGNORECASE)
+_TAG_RE = re.compile(r"</?[a-zA-Z][^>]*>")
+# Bracketed references: [field], [field(1)], [field:label], [event-name][field]. Only
+# the ones _is_piping accepts are removed, so label text like [mm] or [optional] stays.
+_PIPING_RE = re.compile(r"(?:\[([a-z][a-z0-9_\-]*)(\(\w+\))?(:[a-z\-]+)?\])+", re.IGNORECASE)
+_SMART_VARIABLE_RE = re.compile(
+    r"(?:record|event|arm|instrument|form|user|survey|project|previous|next|first|last|current|new)-[a-z\-]+")
+_SPACE_RE = re.compile(r"\s+")
+_SENTENCE_RE = re.compile(r"(?<=[.!?:])\s+")
+_WORD_RE = re.compile(r"\w+|[^\w\s]")
+
+# Sentences shorter than this are kept even when repeated ("Yes.", "Other:")
+MIN_BOILERPLATE_CHARS = 40
+
+
+def _is_piping(match, field_names):
+    """
+    REDCap piping rather than label text: chained ([event][field]), with an
+    instance or :modifier suffix, shaped like a variable name (has _ or a digit),
+    a smart variable ([record-name]) or one of the dictionary's `field_names`.
+    """
+    name = match.group(1)
+    return (match.group(0).count("[") > 1 or bool(match.group(2) or match.group(3))
+            or any(ch == "_" or ch.isdigit() for ch in name)
+            or bool(_SMART_VARIABLE_RE.fullmatch(name.lower()))
+            or name.lower() in field_names)
+
+
+def clean_text(text, field_names=()):
+    """
+    Strip markup, piping references and redundant whitespace from a dictionary field.
+    `field_names` (lowercase) are the dictionary's variable names, so [age] is
+    recognised as piping too.
+    """
+    if text is None or (isinstance(text, float) and text != text):
+        return ""
+    text = html.unescape(str(text))
+    text = _DROP_BLOCK_RE.sub(" ", text)
+    text = _IMG_RE.sub(" ", text)
+    text = _TAG_RE.sub(" ", text)
+    text = _PIPING_RE.sub(lambda m: " " if _is_piping(m, field_names) else m.group(0), text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def dedupe_sentences(texts, seen=None):
+    """
+    Drop sentences (longer than MIN_BOILERPLATE_CHARS) that already appeared in
+    an earlier text or earlier in the same text. Pass one `seen` set for a whole
+    run to drop boilerplate repeated across rows. A text made only of repeated
+    sentences is kept whole: that is the field's own content, not boilerplate
+    around it. Returns the shortened texts.
+    """
+    seen = set() if seen is None else seen
+    out = []
+    for text in texts:
+        kept, dropped = [], False
+        for sentence in _SENTENCE_RE.split(text):
+            key = sentence.lower().strip()
+            if len(key) >= MIN_BOILERPLATE_CHARS:
+                if key in seen:
+                    dropped = True
+                    continue
+                seen.add(key)
+            kept.append(sentence)
+        out.append(" ".join(kept) if kept or not dropped else text)
+    return out
+
+
+# --- tokens ------------------------------------------------------------------
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """tiktoken's o200k_base when it is installed and its vocabulary is cached locally."""
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def count_tokens(text):
+    enc = _encoding()
+    if enc is not None:
+        return len(enc.encode(text))
+    # words and punctuation marks: close to BPE counts for English form text
+    return len(_WORD_RE.findall(text))
+
+
+ELLIPSIS = " …"
+
+
+def truncate_tokens(text, budget):
+    """Cut `text` to at most `budget` tokens, then mark the cut with an ellipsis (not counted)."""
+    if budget <= 0:
+        return ""
+    enc = _encoding()
+    if enc is not None:
+        tokens = enc.encode(text)
+        return text if len(tokens) <= budget else enc.decode(tokens[:budget]).rstrip() + ELLIPSIS
+    matches = list(_WORD_RE.finditer(text))
+    return text if len(matches) <= budget else text[:matches[budget - 1].end()].rstrip() + ELLIPSIS
+
+
+def fit_items(items, stage, render=None):
+    """
+    Longest prefix of `items` (at least one) whose render() fits STAGE_BUDGETS[stage].
+    JSON payloads are budgeted this way, before json.dumps, so the text sent stays
+    valid JSON; compile_messages(truncate=False) then leaves it alone.
+    """
+    items = list(items)
+    budget = STAGE_BUDGETS.get(stage)
+    render = render or (lambda kept: json.dumps(kept, ensure_ascii=False))
+    while budget and len(items) > 1 and count_tokens(render(items)) > budget:
+        items.pop()
+    return items
+
+
+# --- statistics ----------------------------------------------------------------
+
+@dataclass
+class PromptStats:
+    prompts: dict = field(default_factory=dict)      # stage -> prompts compiled
+    raw_tokens: dict = field(default_factory=dict)   # stage -> tokens before cleaning/budget
+    sent_tokens: dict = field(default_factory=dict)  # stage -> tokens actually sent (user part)
+    truncated: dict = field(default_factory=dict)    # stage -> prompts cut to the budget
+
+    def add(self, stage, raw, sent, truncated):
+        self.prompts[stage] = self.prompts.get(stage, 0) + 1
+        self.raw_tokens[stage] = self.raw_tokens.get(stage, 0) + raw
+        self.sent_tokens[stage] = self.sent_tokens.get(stage, 0) + sent
+        self.truncated[stage] = self.truncated.get(stage, 0) + int(truncated)
+
+    def add_precleaned(self, stage, raw_texts, texts):
+        """Tokens a stage removed before compile_messages saw the text (run-wide cleaning and dedupe)."""
+        removed = sum(count_tokens(str(t)) for t in raw_texts if isinstance(t, str)) \
+            - sum(count_tokens(t) for t in texts)
+        self.raw_tokens[stage] = self.raw_tokens.get(stage, 0) + max(removed, 0)
+
+    @property
+    def tokens_saved(self):
+        return sum(self.raw_tokens.values()) - sum(self.sent_tokens.values())
+
+    def summary(self):
+        parts = [
+            f"{stage}: {self.prompts[stage]} prompts, {self.raw_tokens[stage]}->{self.sent_tokens[stage]} "
+            f"tokens, {self.truncated[stage]} truncated"
+            for stage in self.prompts
+        ]
+        return f"[Prompts] tokens_saved={self.tokens_saved} " + "; ".join(parts)
+
+
+PROMPT_STATS = PromptStats()
+
+
+def configure_budgets(config):
+    """Override STAGE_BUDGETS from a [Prompts] section ({stage}_budget = N), if present."""
+    if config is not None and config.has_section("Prompts"):
+        for stage in STAGE_BUDGETS:
+            STAGE_BUDGETS[stage] = config.getint("Prompts", f"{stage}_budget", fallback=STAGE_BUDGETS[stage])
+
+
+# --- compiler --------------------------------------------------------------------
+
+def _render(fields):
+    return "\n".join(f"{label}: {text}" if label else text for label, text in fields.items())
+
+
+def compile_messages(stage, instruction, fields, output_note="", dedupe=True, clean=True, truncate=True,
+                     stats=None):
+    """
+    Build [system, user] messages for one call.
+
+    - instruction + output_note (both static) form the system message.
+    - fields ({label: text}, label "" for bare text) form the user message; each
+      is cleaned, repeated sentences across/within fields are dropped
+      (dedupe=False for JSON fields), and the longest fields are trimmed until
+      the user message fits STAGE_BUDGETS[stage]. JSON fields pass truncate=False
+      and are budgeted by the caller with fit_items().
+    """
+    stats = stats or PROMPT_STATS
+    raw = {label: "" if text is None else str(text) for label, text in fields.items()}
+    cleaned = {label: clean_text(text) for label, text in raw.items()} if clean else dict(raw)
+    if dedupe:
+        cleaned = dict(zip(cleaned, dedupe_sentences(cleaned.values())))
+
+    budget = STAGE_BUDGETS.get(stage) if truncate else None
+    truncated = False
+    if budget:
+        sizes = {label: count_tokens(text) for label, text in cleaned.items()}
+        excess = count_tokens(_render(cleaned)) - budget
+        while excess > 0:
+            longest = max(sizes, key=sizes.get)
+            # the ellipsis truncate_tokens appends comes out of the same budget
+            keep = max(sizes[longest] - excess - count_tokens(ELLIPSIS), 16)
+            if keep >= sizes[longest]:
+                break
+            cleaned[longest] = truncate_tokens(cleaned[longest], keep)
+            previous, sizes[longest] = sizes[longest], count_tokens(cleaned[longest])
+            truncated = True
+            if sizes[longest] >= previous:
+                break
+            excess = count_tokens(_render(cleaned)) - budget
+
+    user = _render(cleaned)
+    stats.add(stage, count_tokens(_render(raw)), count_tokens(user), truncated)
+    system = f"{instruction}\n\n{output_note}" if output_note else instruction
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
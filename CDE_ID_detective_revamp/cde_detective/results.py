@@ -0,0 +1,117 @@
+"""
+Normalized pipeline results: each LLM response and each form decision is
+stored once and referenced by id from the rows.
+
+    Rows       original dictionary columns + Response ID + Form ID
+    Responses  Response ID -> Refined CRF Name, Rationale, Full Response
+    Forms      Form ID -> Canonical CRF Name, HEAL Core CRF Match, Confidence Level, Match Rationale
+
+Ids are content hashes, so the same response gets the same id in every run and
+study. materialize() rebuilds the EnhancedDD frame the quizzes and exports
+use; load_enhanced() reads either layout.
+
+    cde-detective export out/study_2025-08-07.xlsx -o out/study_enhanced.xlsx
+"""
+import hashlib
+import os
+import re
+import zipfile
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from .loader import apply_categoricals, load_table
+
+ROWS_SHEET, RESPONSES_SHEET, FORMS_SHEET = "Rows", "Responses", "Forms"
+RESPONSE_ID, FORM_ID = "Response ID", "Form ID"
+RESPONSE_COLUMNS = ["Refined CRF Name", "Rationale", "Full Response"]
+FORM_COLUMNS = ["Canonical CRF Name", "HEAL Core CRF Match", "Confidence Level", "Match Rationale"]
+LAYOUTS = ("enhanced", "normalized")
+
+
+@dataclass
+class NormalizedResults:
+    rows: pd.DataFrame
+    responses: pd.DataFrame   # indexed by RESPONSE_ID
+    forms: pd.DataFrame       # indexed by FORM_ID
+
+    def dedup_summary(self):
+        return (f"{len(self.rows):,} rows -> {len(self.responses):,} responses, "
+                f"{len(self.forms):,} form decisions")
+
+
+def _content_id(prefix, values):
+    # the prefix keeps Excel from reading an all-digit hash as a number
+    text = "\x1f".join("\x00" if pd.isna(v) else str(v) for v in values)
+    return prefix + hashlib.blake2b(text.encode("utf-8"), digest_size=6).hexdigest()
+
+
+def _factorize(df, columns, id_column):
+    """(id per row, table of unique value tuples indexed by id)."""
+    codes, uniques = pd.MultiIndex.from_frame(df[columns].astype(object)).factorize()
+    table = uniques.to_frame(index=False)
+    table.columns = columns
+    prefix = id_column[0].lower()
+    ids = np.array([_content_id(prefix, values) for values in table.itertuples(index=False)], dtype=object)
+    table.index = pd.Index(ids, name=id_column)
+    return ids[codes], table
+
+
+def normalize_results(df):
+    """Split an EnhancedDD frame into rows, responses and forms."""
+    rows = df.copy()
+    tables = {}
+    for id_column, group in ((RESPONSE_ID, RESPONSE_COLUMNS), (FORM_ID, FORM_COLUMNS)):
+        present = [c for c in group if c in rows.columns]
+        if not present:
+            tables[id_column] = pd.DataFrame(index=pd.Index([], name=id_column))
+            continue
+        ids, tables[id_column] = _factorize(rows, present, id_column)
+        position = rows.columns.get_loc(present[0])
+        rows = rows.drop(columns=present)
+        rows.insert(min(position, rows.shape[1]), id_column, ids)
+    return NormalizedResults(rows.reset_index(drop=True), tables[RESPONSE_ID], tables[FORM_ID])
+
+
+def materialize(results, categorical=None):
+    """The denormalized EnhancedDD frame: each id column is replaced by its table's columns."""
+    df = results.rows
+    for id_column, table in ((RESPONSE_ID, results.responses), (FORM_ID, results.forms)):
+        if id_column not in df.columns:
+            continue
+        position = df.columns.get_loc(id_column)
+        looked_up = table.reindex(df[id_column].astype(object)).reset_index(drop=True)
+        looked_up.index = df.index
+        df = pd.concat([df.iloc[:, :position], looked_up, df.iloc[:, position + 1:]], axis=1)
+    return apply_categoricals(df, categorical)
+
+
+def sheet_names(path):
+    """Worksheet names of an .xlsx, read from the workbook part only."""
+    if not path.lower().endswith((".xlsx", ".xlsm")):
+        return []
+    with zipfile.ZipFile(path) as z:
+        return re.findall(r'<sheet [^>]*name="([^"]+)"', z.read("xl/workbook.xml").decode("utf-8"))
+
+
+def is_normalized(path):
+    return ROWS_SHEET in sheet_names(path)
+
+
+def read_results(path):
+    """NormalizedResults from a workbook written with layout="normalized"."""
+    rows = load_table(path, sheet_name=ROWS_SHEET, categorical=[])
+    responses = load_table(path, sheet_name=RESPONSES_SHEET, categorical=[]).set_index(RESPONSE_ID)
+    forms = load_table(path, sheet_name=FORMS_SHEET, categorical=[]).set_index(FORM_ID)
+    return NormalizedResults(rows, responses, forms)
+
+
+def load_enhanced(path, sheet_name="EnhancedDD", categorical=None):
+    """
+    The EnhancedDD frame of a pipeline workbook in either layout. Normalized
+    workbooks are materialized; anything else is load_table(path, sheet_name).
+    """
+    if sheet_name == "EnhancedDD" and os.path.exists(path) and is_normalized(path):
+        return materialize(read_results(path), categorical)
+    return load_table(path, sheet_name=sheet_name, categorical=categorical)
@@ -0,0 +1,518 @@
+"""
+Local service mode: one long-running process keeps the CDE knowledge base,
+the local HEAL matcher, the API client and a reply cache warm, and runs
+submitted dictionaries through a job queue served by a fixed worker pool.
+
+    cde-detective serve                      # http://127.0.0.1:8765
+
+    POST /jobs                        {"path": "in/Study.xlsx", "kind": "pipeline", ...}
+    POST /jobs?filename=Study.xlsx    upload the file as the request body (options as query parameters)
+    GET  /jobs                        every job
+    GET  /jobs/<id>                   status, progress events and artifact names
+    GET  /jobs/<id>/events            progress as newline-delimited JSON, streamed until the job ends
+    GET  /jobs/<id>/artifacts/<name>  workbook, EnhancedDD, Metadata, Report (pipeline) or cdesearch
+    GET  /status                      queue, workers, API budget and cache counters
+
+Job options: sheet, stop_after, backend, reduce, columns (CRF,VARIABLE,DESCRIPTION)
+and the budget limits max_requests, max_tokens, max_cost, deadline_minutes
+for "pipeline" jobs; sheet, encoding_column, label_column, fallback_threshold
+for "encodings" jobs.
+"""
+import asyncio
+import configparser
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from .encodings import DEFAULT_CDE_FILE
+from .budget import load_budget
+from .offload import configure_offload
+
+JOB_KINDS = ("pipeline", "encodings")
+BUDGET_OPTIONS = ("max_requests", "max_tokens", "max_cost", "deadline_minutes")
+FINISHED = ("done", "failed")
+CONTENT_TYPES = {
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".csv": "text/csv; charset=utf-8",
+}
+
+
+# --- shared API budget -----------------------------------------------------------
+
+class SharedBudgetClient:
+    """
+    The API client every job in the service goes through.
+
+    - At most `max_concurrency` chat completions are in flight across all jobs.
+    - Identical requests (same model, messages, response format) are sent once;
+      concurrent and later duplicates get the first reply. Replies that fail
+      structured parsing are dropped again (see structured_completion), so
+      retries still reach the API.
+
+    The daily limits are kept by JobService.budget, which every job's
+    BudgetClient reserves against; those clients skip requests `is_cached`.
+    """
+
+    def __init__(self, client, max_concurrency=8, max_cached=50000):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_cached = max_cached
+        self._replies = {}
+        self._keys = {}
+        self._in_flight = {}
+        self.requests = 0
+        self.api_calls = 0
+        self.cache_hits = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_completion))
+
+    @staticmethod
+    def request_key(body):
+        payload = json.dumps(body, sort_keys=True, default=str).encode("utf-8")
+        return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+    def is_cached(self, body):
+        """True when `body` would be answered by a cached or in-flight identical request."""
+        key = self.request_key(body)
+        return key in self._replies or key in self._in_flight
+
+    async def _create_completion(self, **body):
+        self.requests += 1
+        key = self.request_key(body)
+        if key in self._replies:
+            self.cache_hits += 1
+            return self._replies[key]
+        if key in self._in_flight:
+            self.cache_hits += 1
+            return await asyncio.shield(self._in_flight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            async with self.semaphore:
+                self.api_calls += 1
+                response = await self.client.chat.completions.create(**body)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # duplicates re-raise it; nobody else has to retrieve it
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+
+        future.set_result(response)
+        if len(self._replies) < self.max_cached:
+            self._replies[key] = response
+            self._keys[id(response)] = key
+        return response
+
+    def forget(self, response):
+        key = self._keys.pop(id(response), None)
+        if key is not None:
+            self._replies.pop(key, None)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "api_calls": self.api_calls,
+            "cache_hits": self.cache_hits,
+            "in_flight": len(self._in_flight),
+            "cached_replies": len(self._replies),
+            "max_concurrency": self.max_concurrency,
+        }
+
+
+# --- jobs ------------------------------------------------------------------------
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    input_file: str
+    options: dict
+    status: str = "queued"     # queued -> running -> done | failed
+    stage: str = ""
+    error: str = ""
+    artifacts: dict = field(default_factory=dict)   # name -> path
+    events: list = field(default_factory=list)
+    submitted: float = field(default_factory=time.time)
+    started: float = None
+    finished: float = None
+
+    def summary(self, events=False):
+        out = {
+            "id": self.id,
+            "kind": self.kind,
+            "input_file": self.input_file,
+            "options": self.options,
+            "status": self.status,
+            "stage": self.stage,
+            "error": self.error,
+            "artifacts": sorted(self.artifacts),
+            "queued_s": round((self.started or time.time()) - self.submitted, 2),
+            "run_s": round((self.finished or time.time()) - self.started, 2) if self.started else None,
+        }
+        if events:
+            out["events"] = list(self.events)
+        return out
+
+
+def _sheet(value, default):
+    if value is None or value == "":
+        return default
+    return int(value) if str(value).isdigit() else value
+
+
+class JobService:
+    """Job queue + worker pool on one event loop, sharing the warm KB and the API budget."""
+
+    def __init__(self, config, client, workers=2, max_api_concurrency=8, output_dir="out/service",
+                 cde_file=DEFAULT_CDE_FILE):
+        configure_offload(config)
+        self.config = config
+        self.client = client
+        self.workers = workers
+        self.max_api_concurrency = max_api_concurrency
+        self.output_dir = output_dir
+        self.cde_file = cde_file
+        self.partitions = None
+        self.stem_index = None
+        self.local_matcher = None
+        self.jobs = {}
+        self.api = None
+        self.loop = None
+        self.queue = None
+        self.budget = load_budget(config)  # daily limits shared by every job (None without [Budget])
+        self.started = time.time()
+        self._changed = threading.Condition()
+
+    def warm(self):
+        """Load what every job shares: the partitioned CDE KB and, for local/hybrid, the HEAL matcher."""
+        start = time.perf_counter()
+        if os.path.exists(self.cde_file):
+            from .encodings import build_stem_index, load_cde_kb, partition_cde_kb
+
+            cde_df = load_cde_kb(self.cde_file)
+            self.partitions = partition_cde_kb(cde_df)
+            self.stem_index = build_stem_index(cde_df)
+        else:
+            print(f"[Service] CDE file not found, encodings jobs disabled: {self.cde_file}")
+        if self.config.get("Matching", "backend", fallback="llm") in ("local", "hybrid"):
+            from .local_matcher import LocalCRFMatcher
+
+            self.local_matcher = LocalCRFMatcher.load(
+                self.config.get("Matching", "local_model", fallback="models/heal_match_local.joblib"))
+        cdes = len(self.partitions[None]) if self.partitions else 0
+        print(f"[Service] warm in {time.perf_counter() - start:.1f}s: {cdes} CDEs, "
+              f"local matcher {'loaded' if self.local_matcher else 'off'}")
+
+    def start(self):
+        """Run the event loop and the worker pool in a background thread."""
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.queue = asyncio.Queue()
+            self.api = SharedBudgetClient(self.client, self.max_api_concurrency)
+            for n in range(1, self.workers + 1):
+                self.loop.create_task(self._worker(n))
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, name="cde-service-loop", daemon=True).start()
+        ready.wait()
+
+    # -- submission (called from HTTP threads) --
+
+    def save_upload(self, filename, data):
+        upload_dir = os.path.join(self.output_dir, "uploads")
+        os.makedirs(upload_dir, exist_ok=True)
+        path = os.path.join(upload_dir, f"{uuid.uuid4().hex[:8]}_{os.path.basename(filename)}")
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def submit(self, kind, input_file, **options):
+        if kind not in JOB_KINDS:
+            raise ValueError(f"kind must be one of {', '.join(JOB_KINDS)}")
+        if kind == "encodings" and self.partitions is None:
+            raise ValueError("encodings jobs need the CDE file, which was not loaded")
+        if not os.path.isfile(input_file):
+            raise FileNotFoundError(f"file not found: {input_file}")
+        from .pipeline import STAGES
+
+        if options.get("stop_after", "match") not in STAGES:
+            raise ValueError(f"stop_after must be one of {', '.join(STAGES)}")
+        if options.get("backend") not in (None, "llm", "local", "hybrid"):
+            raise ValueError("backend must be llm, local or hybrid")
+        if isinstance(options.get("columns"), str):
+            options["columns"] = [c.strip() for c in options["columns"].split(",")]
+        if options.get("columns") is not None and len(options["columns"]) != 3:
+            raise ValueError("columns needs CRF, VARIABLE and DESCRIPTION column names")
+        for key in BUDGET_OPTIONS:
+            if options.get(key) is not None:
+                try:
+                    options[key] = (int if key in ("max_requests", "max_tokens") else float)(options[key])
+                except (TypeError, ValueError):
+                    raise ValueError(f"{key} must be a number")
+
+        job = Job(uuid.uuid4().hex[:12], kind, input_file, options)
+        with self._changed:
+            self.jobs[job.id] = job
+        self._event(job, "queued")
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, job)
+        return job
+
+    def _event(self, job, stage, status=None, **extra):
+        with self._changed:
+            if status:
+                job.status = status
+            job.stage = stage
+            job.events.append({"time": round(time.time(), 3), "stage": stage, **extra})
+            self._changed.notify_all()
+
+    def wait_events(self, job, start, timeout=15):
+        """Events after index `start`; blocks until there are new ones, the job ends, or timeout."""
+        with self._changed:
+            self._changed.wait_for(lambda: len(job.events) > start or job.status in FINISHED, timeout)
+            return job.events[start:]
+
+    def status(self):
+        counts = {}
+        for job in list(self.jobs.values()):
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "workers": self.workers,
+            "jobs": counts,
+            "kb_cdes": len(self.partitions[None]) if self.partitions else 0,
+            "local_matcher": self.local_matcher is not None,
+            "api": self.api.stats() if self.api else {},
+            "budget": self.budget.summary() if self.budget else None,
+        }
+
+    # -- workers (event loop thread) --
+
+    async def _worker(self, n):
+        while True:
+            job = await self.queue.get()
+            job.started = time.time()
+            self._event(job, "running", status="running", worker=n)
+            try:
+                if job.kind == "encodings":
+                    await asyncio.to_thread(self._run_encodings, job)
+                else:
+                    await self._run_pipeline(job)
+            except Exception as e:
+                job.error = f"{type(e).__name__}: {e}"
+                job.finished = time.time()
+                self._event(job, "failed", status="failed", error=job.error)
+                print(f"[Service] job {job.id} failed: {job.error}")
+            else:
+                job.finished = time.time()
+                self._event(job, "done", status="done", artifacts=sorted(job.artifacts))
+                print(f"[Service] job {job.id} done in {job.finished - job.started:.1f}s")
+            finally:
+                self.queue.task_done()
+
+    def _job_dir(self, job):
+        path = os.path.join(self.output_dir, job.id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _job_config(self, options):
+        config = configparser.ConfigParser()
+        config.read_dict({s: dict(self.config.items(s, raw=True)) for s in self.config.sections()})
+        if options.get("columns"):
+            for key, value in zip(("crf_column", "variable_column", "description_column"), options["columns"]):
+                config.set("Columns", key, value)
+        return config
+
+    async def _run_pipeline(self, job):
+        from .pipeline import columns, default_output, run_pipeline
+
+        options = job.options
+        config = self._job_config(options)
+        job_dir = self._job_dir(job)
+        output_file = default_output(job.input_file, job_dir)
+        df = await run_pipeline(
+            self.api, job.input_file, config, output_file,
+            sheet_name=_sheet(options.get("sheet"), 0),
+            stop_after=options.get("stop_after", "match"),
+            backend=options.get("backend"),
+            reduce=options.get("reduce", "local"),
+            local_matcher=self.local_matcher,
+            on_stage=lambda stage: self._event(job, stage),
+            budget_limits={key: options.get(key) for key in BUDGET_OPTIONS},
+            shared_budget=self.budget,
+        )
+        job.artifacts["workbook"] = output_file
+        # the CSV artifacts are written off the loop, which other jobs' requests share
+        await asyncio.to_thread(self._write_csv_artifacts, job, df, columns(config)[0], job_dir)
+
+    def _write_csv_artifacts(self, job, df, crf_column, job_dir):
+        from .workbook import MATCH_COL, build_metadata, build_report
+
+        sheets = {"EnhancedDD": df, "Metadata": build_metadata(df, crf_column)}
+        if MATCH_COL in df.columns:
+            sheets["Report"] = build_report(df, crf_column)
+        for name, sheet_df in sheets.items():
+            path = os.path.join(job_dir, f"{name}.csv")
+            sheet_df.to_csv(path, index=False)
+            job.artifacts[name] = path
+
+    def _run_encodings(self, job):
+        from .encodings import color_code_results, compare_encodings
+
+        options = job.options
+        self._event(job, "encodings")
+        output_file = compare_encodings(
+            job.input_file,
+            encoding_column=options.get("encoding_column", "enumLabels"),
+            field_label_column=options.get("label_column", "description"),
+            study_sheet=_sheet(options.get("sheet"), "EnhancedDD"),
+            fallback_threshold=int(options.get("fallback_threshold", 70)),
+            output_dir=self._job_dir(job),
+            cde_file=self.cde_file,
+            partitions=self.partitions,
+            stem_index=self.stem_index,
+        )
+        color_code_results(output_file)
+        job.artifacts["cdesearch"] = output_file
+
+
+# --- HTTP --------------------------------------------------------------------------
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    service = None  # set by make_server
+
+    def log_message(self, format, *args):
+        print(f"[Service] {self.address_string()} {format % args}")
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send_json(status, {"error": message})
+
+    def do_GET(self):
+        parts = [p for p in urlparse(self.path).path.split("/") if p]
+        if parts == ["status"]:
+            return self._send_json(200, self.service.status())
+        if parts == ["jobs"]:
+            return self._send_json(200, [job.summary() for job in list(self.service.jobs.values())])
+        if len(parts) >= 2 and parts[0] == "jobs":
+            job = self.service.jobs.get(parts[1])
+            if job is None:
+                return self._error(404, f"no job {parts[1]}")
+            if len(parts) == 2:
+                return self._send_json(200, job.summary(events=True))
+            if parts[2:] == ["events"]:
+                return self._stream_events(job)
+            if len(parts) == 4 and parts[2] == "artifacts":
+                return self._send_artifact(job, parts[3])
+        self._error(404, "not found")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/jobs":
+            return self._error(404, "not found")
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        options = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        if "filename" in options:
+            filename = os.path.basename(options.pop("filename"))
+            if not filename.lower().endswith((".xlsx", ".csv")):
+                return self._error(400, "upload an .xlsx or .csv file")
+            if not body:
+                return self._error(400, "empty upload")
+            path = self.service.save_upload(filename, body)
+        else:
+            try:
+                options.update(json.loads(body or b"{}"))
+            except json.JSONDecodeError as e:
+                return self._error(400, f"invalid JSON body: {e}")
+            path = options.pop("path", None)
+            if not path:
+                return self._error(400, "give a 'path' in the JSON body or upload with ?filename=")
+
+        try:
+            job = self.service.submit(options.pop("kind", "pipeline"), path, **options)
+        except (ValueError, FileNotFoundError) as e:
+            return self._error(400, str(e))
+        self._send_json(202, job.summary())
+
+    def _stream_events(self, job):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        sent = 0
+        try:
+            while True:
+                events = self.service.wait_events(job, sent)
+                for event in events:
+                    line = (json.dumps(event) + "\n").encode("utf-8")
+                    self.wfile.write(f"{len(line):X}\r\n".encode() + line + b"\r\n")
+                self.wfile.flush()
+                sent += len(events)
+                if job.status in FINISHED and sent == len(job.events):
+                    break
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _send_artifact(self, job, name):
+        path = job.artifacts.get(name)
+        if path is None or not os.path.exists(path):
+            return self._error(404, f"no artifact {name!r} (have: {', '.join(sorted(job.artifacts)) or 'none'})")
+        with open(path, "rb") as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES.get(os.path.splitext(path)[1], "application/octet-stream"))
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(path)}"')
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_server(service, host="127.0.0.1", port=8765):
+    handler = type("Handler", (ServiceHandler,), {"service": service})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def serve(config, client, host="127.0.0.1", port=8765, workers=2, max_api_concurrency=8,
+          output_dir="out/service", cde_file=DEFAULT_CDE_FILE):
+    """Warm up, start the worker pool, and serve HTTP until interrupted."""
+    service = JobService(config, client, workers=workers, max_api_concurrency=max_api_concurrency,
+                         output_dir=output_dir, cde_file=cde_file)
+    service.warm()
+    service.start()
+    server = make_server(service, host, port)
+    print(f"[Service] listening on http://{host}:{server.server_port} "
+          f"({workers} workers, {max_api_concurrency} API calls in flight)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("[Service] stopping")
+    finally:
+        server.server_close()
+        service.loop.call_soon_threadsafe(service.loop.stop)
+    return service
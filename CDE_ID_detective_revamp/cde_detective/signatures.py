@@ -0,0 +1,317 @@
+"""
+Form signature index: recognise instruments already reviewed in other studies.
+
+A form's signature is the set of its (variable, label, choices) items after
+normalization. The index stores an exact hash of that set and a MinHash
+sketch (LSH-banded for candidate lookup) for every form in the validated
+dictionaries and reviewer-confirmed outputs. A new form whose item set has
+Jaccard similarity >= threshold with a known form takes over the reviewed
+canonical name, HEAL Core CRF match and (where the source carried one) CDE
+name of every item the two forms share, with no LLM call or fuzzy search.
+Rows whose item is new still go through the pipeline.
+
+Build:
+    python -m cde_detective.signatures build
+    python -m cde_detective.signatures lookup in/Study.xlsx --columns section name description
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from .crf_catalog import NO_CRF_MATCH
+from .encodings import SIGNATURE_SCOPE
+from .normalize import normalize
+from .offload import output
+
+DEFAULT_INDEX_FILE = "models/form_signatures.joblib"
+DEFAULT_SOURCES = ["ValidatedCDEuse/*.xlsx", "out/*_matches_confirmed.xlsx"]
+
+# REDCap, VLMD and older enhanced sheets name the choices column differently
+CHOICE_COLUMNS = ["Choices, Calculations, OR Slider Labels", "enumLabels", "constraints.enum"]
+CDE_COLUMNS = ["CDE Name", "Best Match CDE Name"]
+
+NUM_PERM = 128
+BANDS = 32  # 4 rows per band: forms above ~0.5 Jaccard almost always share a bucket
+MIN_ITEMS = 3
+_MINHASH_SEED = 20250801
+
+
+# --- signatures --------------------------------------------------------------------
+
+def _hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+_rng = np.random.default_rng(_MINHASH_SEED)
+_PERM_A = _rng.integers(1, 2**63, size=NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_PERM_B = _rng.integers(0, 2**63, size=NUM_PERM, dtype=np.uint64)
+
+
+def item_key(variable, label, choices=""):
+    return "|".join(normalize(v, "encoding") for v in (variable, label, choices))
+
+
+def form_items(form_df, variable_column, description_column, choices_column=None):
+    """Item keys per row of one form (aligned with form_df.index)."""
+    choices = form_df[choices_column] if choices_column else [""] * len(form_df)
+    return pd.Series(
+        [item_key(v, d, c) for v, d, c in zip(form_df[variable_column], form_df[description_column], choices)],
+        index=form_df.index,
+    )
+
+
+def exact_signature(items):
+    return hashlib.blake2b("\n".join(sorted(set(items))).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def minhash(items):
+    """NUM_PERM-value MinHash of the item set (multiply-shift hashing on uint64)."""
+    hashes = np.array([_hash64(i) for i in set(items)], dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        permuted = (hashes[:, None] * _PERM_A[None, :] + _PERM_B[None, :]) >> np.uint64(32)
+    return permuted.min(axis=0)
+
+
+def choices_column(df):
+    return next((c for c in CHOICE_COLUMNS if c in df.columns), None)
+
+
+# --- index -------------------------------------------------------------------------
+
+class FormSignatureIndex:
+    """Known forms with their reviewed mappings, searchable by exact hash or MinHash/LSH."""
+
+    def __init__(self, entries=None):
+        self.entries = []
+        self._by_signature = {}
+        self._buckets = {}
+        for entry in entries or []:
+            self.add(entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _bands(self, sketch):
+        rows = NUM_PERM // BANDS
+        return [(b, sketch[b * rows:(b + 1) * rows].tobytes()) for b in range(BANDS)]
+
+    def add(self, entry):
+        """entry: source, form, items (set), match (form-level mode), by_item ({item: (canonical, match, CDE name)})."""
+        entry["signature"] = exact_signature(entry["items"])
+        entry["minhash"] = minhash(entry["items"])
+        n = len(self.entries)
+        self.entries.append(entry)
+        self._by_signature.setdefault(entry["signature"], n)
+        for band in self._bands(entry["minhash"]):
+            self._buckets.setdefault(band, []).append(n)
+
+    def match(self, items, threshold=0.9):
+        """Best known form for an item set: (entry, Jaccard similarity) or None."""
+        items = set(items)
+        if len(items) < MIN_ITEMS:
+            return None
+        exact = self._by_signature.get(exact_signature(items))
+        if exact is not None:
+            return self.entries[exact], 1.0
+        candidates = {n for band in self._bands(minhash(items)) for n in self._buckets.get(band, [])}
+        best = None
+        for n in candidates:
+            known = self.entries[n]["items"]
+            similarity = len(items & known) / len(items | known)
+            if similarity >= threshold and (best is None or similarity > best[1]):
+                best = (self.entries[n], similarity)
+        return best
+
+    def save(self, path=DEFAULT_INDEX_FILE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        fields = ("source", "form", "items", "match", "by_item")
+        joblib.dump({"entries": [{k: e[k] for k in fields} for e in self.entries]}, path)
+
+    @classmethod
+    def load(cls, path=DEFAULT_INDEX_FILE):
+        return cls(joblib.load(path)["entries"])
+
+
+_LOADED = {}
+
+
+def load_signature_index(config):
+    """
+    The index named by [Matching] signature_index, or None when unset or not built yet.
+    Kept in memory until the file changes (the service loads it once).
+    """
+    path = config.get("Matching", "signature_index", fallback="")
+    if not path or not os.path.exists(path):
+        return None
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in _LOADED:
+        _LOADED.clear()
+        _LOADED[key] = FormSignatureIndex.load(path)
+        output.info(f"[Signatures] {len(_LOADED[key])} known forms loaded from {path}")
+    return _LOADED[key]
+
+
+# --- building from reviewed workbooks ------------------------------------------------
+
+def entries_from_enhanced(df, source):
+    """One entry per form of a reviewed EnhancedDD sheet, with each item's reviewed row-level mapping."""
+    from .crf_catalog import loose_heal_crf
+    from .local_matcher import (
+        DESCRIPTION_COLUMNS,
+        FORM_COLUMNS,
+        LABEL_COLUMNS,
+        NAME_COLUMNS,
+        VARIABLE_COLUMNS,
+        _first_column,
+    )
+
+    form_col = _first_column(df, FORM_COLUMNS)
+    var_col = _first_column(df, VARIABLE_COLUMNS)
+    desc_col = _first_column(df, DESCRIPTION_COLUMNS)
+    label_col = _first_column(df, LABEL_COLUMNS)
+    if not all([form_col, var_col, desc_col, label_col]):
+        return []
+    name_col = _first_column(df, NAME_COLUMNS) or form_col
+    cde_col = _first_column(df, CDE_COLUMNS)
+    choice_col = choices_column(df)
+
+    entries = []
+    for form, group in df.groupby(df[form_col].astype(object).fillna(""), sort=False):
+        items = form_items(group, var_col, desc_col, choice_col)
+        labels = group[label_col].map(loose_heal_crf).fillna(NO_CRF_MATCH)
+        names = group[name_col].astype(object).where(group[name_col].notna(), str(form)).astype(str)
+        cdes = group[cde_col].astype(object) if cde_col is not None else [None] * len(group)
+        by_item = {
+            item: (name, label, str(cde).strip() if pd.notna(cde) and str(cde).strip() else None)
+            for item, name, label, cde in zip(items, names, labels, cdes)
+        }
+        entries.append({
+            "source": source,
+            "form": str(form),
+            "items": set(items),
+            "match": labels.mode().iloc[0],
+            "by_item": by_item,
+        })
+    return entries
+
+
+def build_index(patterns=DEFAULT_SOURCES):
+    index = FormSignatureIndex()
+    seen = set()
+    for path in sorted({p for pattern in patterns for p in glob.glob(pattern)}):
+        try:
+            sheets = pd.read_excel(path, sheet_name=None)
+        except Exception as e:
+            print(f"⚠️ Skipping {path!r}: {e}")
+            continue
+        for name, df in sheets.items():
+            if name in ("Metadata", "Report", "FormMatches", "CRF Results"):
+                continue
+            for entry in entries_from_enhanced(df, os.path.basename(path)):
+                if len(entry["items"]) < MIN_ITEMS:
+                    continue
+                # the same instrument confirmed twice adds nothing
+                key = (exact_signature(entry["items"]), entry["match"])
+                if key not in seen:
+                    seen.add(key)
+                    index.add(entry)
+    return index
+
+
+# --- reuse in the pipeline -----------------------------------------------------------
+
+def reuse_known_forms(df, index, crf_column="Form Name", variable_column="Variable / Field Name",
+                      description_column="Field Label", threshold=0.9):
+    """
+    Fill the pipeline's output columns for the rows of `df` whose form matches a
+    known signature and whose item was part of it. Returns (reused rows
+    DataFrame, FormMatches-style report rows); the remaining rows still need the pipeline.
+    """
+    choice_col = choices_column(df)
+    forms = df[crf_column].astype(object).fillna("").astype(str)
+    reused, report = [], []
+    for form, idx in df.groupby(forms, sort=False).groups.items():
+        form_df = df.loc[idx]
+        items = form_items(form_df, variable_column, description_column, choice_col)
+        hit = index.match(items, threshold)
+        if hit is None:
+            continue
+        entry, similarity = hit
+        known = items.map(entry["by_item"]).dropna()
+        if known.empty:
+            continue
+        rationale = f"Signature match: '{entry['form']}' in {entry['source']} (Jaccard {similarity:.2f})"
+        form_df = form_df.loc[known.index].copy()
+        canonical, match, cde = (known.map(lambda m, i=i: m[i]) for i in range(3))
+        form_df["Refined CRF Name"] = canonical
+        form_df["Rationale"] = rationale
+        form_df["Full Response"] = json.dumps({
+            "source": entry["source"], "form": entry["form"], "similarity": round(similarity, 3),
+        })
+        form_df["Canonical CRF Name"] = canonical
+        form_df["HEAL Core CRF Match"] = match
+        form_df["Confidence Level"] = "High" if similarity == 1.0 else "Medium"
+        form_df["Match Rationale"] = rationale
+        if cde.notna().any():
+            form_df["Best Match CDE Name"] = cde
+            form_df["Search Scope"] = cde.notna().map({True: SIGNATURE_SCOPE, False: None})
+        reused.append(form_df)
+        for name, rows in form_df.groupby("Canonical CRF Name", sort=False):
+            report.append({
+                "Canonical CRF Name": name,
+                "Rows": len(rows),
+                "Source Forms": form,
+                "HEAL Core CRF Match": rows["HEAL Core CRF Match"].mode().iloc[0],
+                "Confidence Level": rows["Confidence Level"].iloc[0],
+                "Match Rationale": rationale,
+                "Decided By": "Signature",
+            })
+    reused_df = pd.concat(reused) if reused else df.iloc[0:0]
+    output.info(f"[Signatures] {len(reused)} of {forms.nunique()} forms matched known instruments; "
+                f"{len(reused_df)} of {len(df)} rows reused")
+    return reused_df, report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the form signature index.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="Index the forms of validated/confirmed workbooks")
+    build.add_argument("sources", nargs="*", default=DEFAULT_SOURCES, help="Workbook globs")
+    build.add_argument("-o", "--out", default=DEFAULT_INDEX_FILE)
+
+    lookup = sub.add_parser("lookup", help="Show which forms of a dictionary are already known")
+    lookup.add_argument("input_file")
+    lookup.add_argument("--sheet", default=0)
+    lookup.add_argument("--columns", nargs=3, default=["Form Name", "Variable / Field Name", "Field Label"],
+                        metavar=("CRF", "VARIABLE", "DESCRIPTION"))
+    lookup.add_argument("--threshold", type=float, default=0.9)
+    lookup.add_argument("-i", "--index", default=DEFAULT_INDEX_FILE)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        index = build_index(args.sources)
+        index.save(args.out)
+        print(f"✅ Saved {len(index)} form signatures from "
+              f"{len({e['source'] for e in index.entries})} workbooks to {args.out}")
+    else:
+        from .loader import load_table
+
+        sheet = int(args.sheet) if str(args.sheet).isdigit() else args.sheet
+        df = load_table(args.input_file, sheet_name=sheet, categorical=[])
+        _, report = reuse_known_forms(df, FormSignatureIndex.load(args.index), *args.columns,
+                                      threshold=args.threshold)
+        for row in report:
+            print(f"{row['Source Forms']}\t{row['Canonical CRF Name']}\t{row['HEAL Core CRF Match']}\t"
+                  f"{row['Rows']} rows\t{row['Match Rationale']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+Schema-constrained LLM output for every pipeline stage.
+
+Each stage asks the API for a strict JSON schema (`response_format`), validates
+the reply against a typed model, and runs a local repair parser on near-valid
+replies (markdown fences, trailing commas, single quotes, `Key: value` lines)
+before giving up. Only replies that cannot be repaired cost another API call.
+"""
+import ast
+import json
+import re
+from dataclasses import dataclass
+
+from pydantic import BaseModel, ValidationError, field_validator
+
+from .crf_catalog import CONFIDENCE_LEVELS, HEAL_CORE_CRFS, NO_CRF_MATCH, canonical_heal_crf
+
+
+class StructuredOutputError(ValueError):
+    """Raised when a reply can be neither parsed nor repaired into the expected model."""
+
+    def __init__(self, message, raw=""):
+        super().__init__(message)
+        self.raw = raw
+
+
+# --- typed models ----------------------------------------------------------
+
+class PrestepResponse(BaseModel):
+    crf_name: str
+    rationale: str = ""
+
+
+class HarmonizeEntry(BaseModel):
+    original: str
+    label: str
+
+
+class HarmonizeResponse(BaseModel):
+    mappings: list[HarmonizeEntry]
+
+    def as_dict(self):
+        return {m.original: m.label for m in self.mappings}
+
+
+class HealMatchResponse(BaseModel):
+    heal_core_crf: str
+    confidence: str = "Low"
+    rationale: str = ""
+
+    @field_validator("heal_core_crf")
+    @classmethod
+    def _known_crf(cls, v):
+        crf = canonical_heal_crf(v)
+        if crf is None:
+            raise ValueError(f"{v!r} is not a HEAL Core CRF")
+        return crf
+
+    @field_validator("confidence")
+    @classmethod
+    def _known_confidence(cls, v):
+        # "High Confidence", "high" -> "High"
+        word = str(v).strip().split(" ")[0].capitalize()
+        return word if word in CONFIDENCE_LEVELS else "Low"
+
+
+# --- JSON schemas sent as response_format ----------------------------------
+
+PRESTEP_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "crf_name": {"type": "string", "description": "A unique, concise label for this CRF"},
+        "rationale": {"type": "string", "description": "One brief sentence explaining the choice"},
+    },
+    "required": ["crf_name", "rationale"],
+    "additionalProperties": False,
+}
+
+HARMONIZE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "mappings": {
+            "type": "array",
+            "description": "One entry per original form name",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "original": {"type": "string"},
+                    "label": {"type": "string"},
+                },
+                "required": ["original", "label"],
+                "additionalProperties": False,
+            },
+        }
+    },
+    "required": ["mappings"],
+    "additionalProperties": False,
+}
+
+HEAL_MATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "heal_core_crf": {"type": "string", "enum": HEAL_CORE_CRFS + [NO_CRF_MATCH]},
+        "confidence": {"type": "string", "enum": CONFIDENCE_LEVELS},
+        "rationale": {"type": "string"},
+    },
+    "required": ["heal_core_crf", "confidence", "rationale"],
+    "additionalProperties": False,
+}
+
+# Keys the models have historically answered with instead of the schema keys
+# (compared after lowercasing and dropping non-alphanumerics).
+PRESTEP_ALIASES = {"crf": "crf_name", "crfname": "crf_name", "refinedcrfname": "crf_name"}
+HEAL_MATCH_ALIASES = {
+    "healcorecrfmatch": "heal_core_crf",
+    "healcorecrf": "heal_core_crf",
+    "match": "heal_core_crf",
+    "confidencelevel": "confidence",
+}
+
+
+def response_format(name, schema):
+    """Wrap a JSON schema in the chat-completions `response_format` envelope."""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "strict": True, "schema": schema},
+    }
+
+
+# --- parse statistics ------------------------------------------------------
+
+@dataclass
+class ParseStats:
+    valid: int = 0          # parsed and validated as returned
+    repaired: int = 0       # fixed locally; each one is a retry we did not send
+    failed: int = 0         # could not be repaired
+    parse_retries: int = 0  # API calls re-issued because of a parse failure
+
+    @property
+    def retries_avoided(self):
+        return self.repaired
+
+    def summary(self):
+        return (
+            f"[Structured] valid={self.valid} repaired={self.repaired} "
+            f"failed={self.failed} parse_retries={self.parse_retries} "
+            f"retries_avoided={self.retries_avoided}"
+        )
+
+
+PARSE_STATS = ParseStats()
+
+
+# --- local repair ----------------------------------------------------------
+
+_FENCE_RE = re.compile(r"^```[a-zA-Z]*\s*|\s*```$")
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_KV_LINE_RE = re.compile(r"^\s*[-*]?\s*\"?([A-Za-z][\w \-]*?)\"?\s*:\s*(.+?)\s*,?\s*$")
+_SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+
+
+def _outer_span(text):
+    """Return the outermost {...} or [...] span, or the text unchanged."""
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        return text
+    start = min(starts)
+    end = text.rfind("}" if text[start] == "{" else "]")
+    return text[start:end + 1] if end > start else text[start:]
+
+
+def _key_value_lines(text):
+    """Parse 'Key: value' lines, the format the older instructions asked for."""
+    data = {}
+    for line in text.splitlines():
+        m = _KV_LINE_RE.match(line)
+        if m:
+            data[m.group(1).strip()] = m.group(2).strip().strip('"').strip()
+    return data
+
+
+def repair_json(text):
+    """
+    Best-effort local repair of a near-valid JSON reply.
+    Raises StructuredOutputError if nothing usable can be recovered.
+    """
+    if not isinstance(text, str) or not text.strip():
+        raise StructuredOutputError("empty response", raw=text or "")
+
+    cleaned = _FENCE_RE.sub("", text.strip()).translate(_SMART_QUOTES)
+    span = _outer_span(cleaned)
+    for candidate in (span, _TRAILING_COMMA_RE.sub(r"\1", span)):
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            pass
+    try:
+        # single-quoted keys, True/False/None
+        value = ast.literal_eval(_TRAILING_COMMA_RE.sub(r"\1", span))
+        if isinstance(value, (dict, list)):
+            return value
+    except (ValueError, SyntaxError):
+        pass
+
+    data = _key_value_lines(cleaned)
+    if data:
+        return data
+    raise StructuredOutputError("could not repair response", raw=text)
+
+
+def _apply_aliases(data, aliases):
+    if not aliases or not isinstance(data, dict):
+        return data, False
+    out, changed = {}, False
+    for key, value in data.items():
+        lower = str(key).lower()
+        snake = re.sub(r"[^a-z0-9]+", "_", lower).strip("_")
+        target = aliases.get(re.sub(r"[^a-z0-9]", "", lower), snake)
+        changed = changed or target != key
+        out[target] = value
+    return out, changed
+
+
+def parse_structured(text, model, aliases=None, stats=None):
+    """
+    Parse `text` into `model`, repairing locally when needed.
+    Raises StructuredOutputError on failure so callers can decide to retry.
+    """
+    stats = stats or PARSE_STATS
+    repaired = False
+    try:
+        data = json.loads(text)
+    except (json.JSONDecodeError, TypeError):
+        try:
+            data = repair_json(text)
+        except StructuredOutputError:
+            stats.failed += 1
+            raise
+        repaired = True
+
+    try:
+        result = model.model_validate(data)
+    except ValidationError:
+        # Only fall back to key aliases when the schema keys are missing.
+        data, renamed = _apply_aliases(data, aliases)
+        try:
+            result = model.model_validate(data)
+        except ValidationError as e:
+            stats.failed += 1
+            raise StructuredOutputError(f"{model.__name__} validation failed: {e}", raw=text)
+        repaired = repaired or renamed
+
+    if repaired:
+        stats.repaired += 1
+    else:
+        stats.valid += 1
+    return result
+
+
+async def structured_completion(client, model, messages, schema_name, schema, response_model,
+                                temperature=0, aliases=None, stats=None):
+    """
+    One schema-constrained chat completion.
+    Returns (validated model instance, raw message content).
+    """
+    response = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        response_format=response_format(schema_name, schema),
+        temperature=temperature,
+    )
+    message = response.choices[0].message
+    if getattr(message, "refusal", None):
+        raise StructuredOutputError(f"model refused: {message.refusal}")
+    full = (message.content or "").strip()
+    try:
+        return parse_structured(full, response_model, aliases=aliases, stats=stats), full
+    except StructuredOutputError:
+        # a caching client (service mode) must not hand this reply to the retry
+        forget = getattr(client, "forget", None)
+        if forget is not None:
+            forget(response)
+        raise
@@ -0,0 +1,384 @@
+"""
+VLMD export: enhanced rows -> HEAL Variable-Level Metadata (JSON and/or CSV)
+for platform submission, with standardsMappings filled from the HEAL Core CRF
+match and, on CDE search outputs, the best CDE match.
+
+Rows are streamed end to end. Workbooks are read row by row (openpyxl
+read-only; the Forms table of a normalized workbook is the only thing held in
+memory), and each field is converted, validated and written before the next
+one is read, so neither a sheet nor a JSON tree is ever built. JSON is
+serialized with orjson when it is installed; --schema validates every field
+against the VLMD JSON schema with jsonschema as it goes.
+
+    cde-detective vlmd out/Study_vlmd_cdesearch.xlsx --format json csv
+    cde-detective vlmd out/Study_2025-08-07_matches_confirmed.xlsx --min-cde-score 90
+"""
+import csv
+import importlib.util
+import json
+import os
+import re
+import time
+
+from .crf_catalog import NO_CRF_MATCH, canonical_heal_crf
+from .offload import output
+
+HAS_ORJSON = importlib.util.find_spec("orjson") is not None
+HAS_JSONSCHEMA = importlib.util.find_spec("jsonschema") is not None
+
+SCHEMA_VERSION = "0.3.2"
+HEAL_CDE_SOURCE = "heal-cde"
+FORMATS = ("json", "csv")
+
+INSTRUMENT = "standardsMappings[0].instrument"
+ITEM = "standardsMappings[0].item"
+# Flat (CSV) VLMD columns, in the order the platform templates use
+VLMD_COLUMNS = [
+    "schemaVersion", "section", "name", "title", "description", "type", "format",
+    "constraints.required", "constraints.maxLength", "constraints.enum", "constraints.pattern",
+    "constraints.maximum", "constraints.minimum", "enumLabels", "enumOrdered", "missingValues",
+    "trueValues", "falseValues", "custom",
+    f"{INSTRUMENT}.url", f"{INSTRUMENT}.source", f"{INSTRUMENT}.title", f"{INSTRUMENT}.id",
+    f"{ITEM}.url", f"{ITEM}.source", f"{ITEM}.id",
+    "relatedConcepts[0].url", "relatedConcepts[0].title", "relatedConcepts[0].source", "relatedConcepts[0].id",
+]
+FIELD_TYPES = {"string", "integer", "number", "boolean", "date", "datetime", "time", "year", "yearmonth",
+               "duration", "geopoint", "any"}
+
+# Pipe-delimited lists and "code=label" maps in the flat form
+_LIST_COLUMNS = {"constraints.enum", "missingValues", "trueValues", "falseValues"}
+_BOOL_COLUMNS = {"constraints.required", "enumOrdered"}
+_INT_COLUMNS = {"constraints.maxLength"}
+_NUMBER_COLUMNS = {"constraints.maximum", "constraints.minimum"}
+_PATH_RE = re.compile(r"([^.\[\]]+)(?:\[(\d+)\])?")
+_VERSION_RE = re.compile(r"\d+\.\d+\.\d+")
+
+
+def _blank(value):
+    if isinstance(value, str):
+        return not value.strip()
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def _text(value):
+    """Cell value as VLMD text: whole floats lose their '.0'."""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+# --- rows -------------------------------------------------------------------------
+
+def _iter_sheet(path, sheet_name):
+    from openpyxl import load_workbook
+
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet_name] if sheet_name is not None else wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, ())
+        # keep the first of duplicated headers (the CDE search adds a second 'Confidence Level')
+        positions = {}
+        for i, name in enumerate(header):
+            if name is not None and str(name) not in positions:
+                positions[str(name)] = i
+        for values in rows:
+            if any(v is not None for v in values):
+                yield {name: values[i] if i < len(values) else None for name, i in positions.items()}
+    finally:
+        wb.close()
+
+
+def iter_workbook_rows(path, sheet_name=None):
+    """
+    Rows of a dictionary, pipeline or CDE search output as dicts, one at a time.
+    Normalized workbooks (see results.py) get their Forms columns joined back in.
+    """
+    if path.lower().endswith(".csv"):
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            yield from csv.DictReader(f)
+        return
+
+    from .results import FORM_ID, FORMS_SHEET, ROWS_SHEET, sheet_names
+
+    sheets = sheet_names(path)
+    if sheet_name is None and ROWS_SHEET in sheets:
+        forms = {row.pop(FORM_ID): row for row in _iter_sheet(path, FORMS_SHEET)}
+        for row in _iter_sheet(path, ROWS_SHEET):
+            row.update(forms.get(row.pop(FORM_ID, None), {}))
+            yield row
+        return
+    if sheet_name is None and "EnhancedDD" in sheets:
+        sheet_name = "EnhancedDD"
+    yield from _iter_sheet(path, sheet_name)
+
+
+def iter_frame_rows(df):
+    """Rows of an in-memory frame as dicts (the pipeline's EnhancedDD); missing values become None."""
+    import pandas as pd
+
+    columns = [str(c) for c in df.columns]
+    for values in df.itertuples(index=False, name=None):
+        yield {c: None if v is pd.NA or v is pd.NaT else v for c, v in zip(columns, values)}
+
+
+# --- fields -----------------------------------------------------------------------
+
+def flat_field(row, min_cde_score=80, columns=None):
+    """
+    One row as a flat VLMD record ({VLMD column: text}). Dictionaries that are
+    not VLMD already take section/name/description from `columns` (the
+    [Columns] crf, variable and description names). Empty standardsMappings
+    cells are filled from the row's HEAL Core CRF Match and, when its Best
+    Match Score reaches `min_cde_score`, its Best Match CDE Name; values the
+    study supplied are never overwritten.
+    """
+    flat = {col: _text(row[col]) for col in VLMD_COLUMNS if col in row and not _blank(row[col])}
+    if columns is not None:
+        for target, source in zip(("section", "name", "description"), columns):
+            if target not in flat and not _blank(row.get(source)):
+                flat[target] = _text(row[source])
+    flat.setdefault("schemaVersion", SCHEMA_VERSION)
+
+    mapped = {}
+    crf = canonical_heal_crf(row.get("HEAL Core CRF Match"))
+    if crf and crf != NO_CRF_MATCH:
+        mapped[f"{INSTRUMENT}.title"] = crf
+        mapped[f"{INSTRUMENT}.source"] = HEAL_CDE_SOURCE
+
+    cde, score = row.get("Best Match CDE Name"), row.get("Best Match Score")
+    try:
+        score = float(score)
+    except (TypeError, ValueError):
+        score = None
+    if not _blank(cde) and score is not None and score >= min_cde_score:
+        mapped[f"{ITEM}.id"] = _text(cde)
+        mapped[f"{ITEM}.source"] = HEAL_CDE_SOURCE
+        if crf is None or crf == NO_CRF_MATCH:
+            # the CDE's own CRF names the instrument when the form-level match found none
+            if not _blank(row.get("Best Match CRF Name")):
+                mapped[f"{INSTRUMENT}.title"] = _text(row["Best Match CRF Name"])
+                mapped[f"{INSTRUMENT}.source"] = HEAL_CDE_SOURCE
+
+    for col, value in mapped.items():
+        flat.setdefault(col, value)
+    return flat
+
+
+def _typed(column, text):
+    if column in _LIST_COLUMNS:
+        return [v.strip() for v in text.split("|")]
+    if column == "enumLabels":
+        labels = {}
+        for pair in text.split("|"):
+            code, _, label = pair.partition("=")
+            labels[code.strip()] = label.strip()
+        return labels
+    if column in _BOOL_COLUMNS:
+        return text.lower() in ("true", "1", "yes", "y")
+    if column in _INT_COLUMNS:
+        try:
+            return int(float(text))
+        except ValueError:
+            return text
+    if column in _NUMBER_COLUMNS:
+        try:
+            number = float(text)
+            return int(number) if number.is_integer() else number
+        except ValueError:
+            return text
+    if column == "custom" and text.startswith("{"):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return text
+    return text
+
+
+def nested_field(flat):
+    """The VLMD JSON object for a flat record ('constraints.enum' -> {"constraints": {"enum": [...]}})."""
+    field = {}
+    for column, text in flat.items():
+        node = field
+        parts = _PATH_RE.findall(column)
+        for i, (key, index) in enumerate(parts):
+            last = i == len(parts) - 1
+            if index:
+                items = node.setdefault(key, [])
+                while len(items) <= int(index):
+                    items.append({})
+                if last:
+                    items[int(index)] = _typed(column, text)
+                else:
+                    node = items[int(index)]
+            elif last:
+                node[key] = _typed(column, text)
+            else:
+                node = node.setdefault(key, {})
+    return field
+
+
+# --- validation -------------------------------------------------------------------
+
+def field_errors(field, seen_names):
+    """Problems that would fail platform validation for one JSON field ([] when none)."""
+    errors = []
+    name = field.get("name")
+    if not name:
+        errors.append("missing name")
+    elif name in seen_names:
+        errors.append(f"duplicate name {name!r}")
+    else:
+        seen_names.add(name)
+    if not field.get("description"):
+        errors.append("missing description")
+    if "type" in field and field["type"] not in FIELD_TYPES:
+        errors.append(f"type {field['type']!r} is not one of {sorted(FIELD_TYPES)}")
+    if not _VERSION_RE.fullmatch(str(field.get("schemaVersion", ""))):
+        errors.append(f"schemaVersion {field.get('schemaVersion')!r} is not MAJOR.MINOR.PATCH")
+
+    constraints = field.get("constraints", {})
+    for key in ("maximum", "minimum", "maxLength"):
+        if key in constraints and not isinstance(constraints[key], (int, float)):
+            errors.append(f"constraints.{key} {constraints[key]!r} is not a number")
+    bounds = [constraints.get(key) for key in ("minimum", "maximum")]
+    if all(isinstance(b, (int, float)) for b in bounds) and bounds[0] > bounds[1]:
+        errors.append("constraints.minimum is greater than constraints.maximum")
+    enum = constraints.get("enum")
+    labels = field.get("enumLabels")
+    if enum and labels:
+        unknown = [code for code in labels if code not in enum]
+        if unknown:
+            errors.append(f"enumLabels codes not in constraints.enum: {unknown}")
+
+    for i, mapping in enumerate(field.get("standardsMappings", [])):
+        if not any(isinstance(mapping.get(part), dict) and mapping[part] for part in ("instrument", "item")):
+            errors.append(f"standardsMappings[{i}] has neither an instrument nor an item")
+    return errors
+
+
+def _schema_validator(schema_file):
+    """jsonschema validator for one field of the VLMD schema in `schema_file` (data dictionary or field schema)."""
+    if not HAS_JSONSCHEMA:
+        raise RuntimeError("--schema needs jsonschema (pip install 'cde-detective[vlmd]')")
+    from jsonschema.validators import validator_for
+
+    with open(schema_file, encoding="utf-8") as f:
+        schema = json.load(f)
+    field_schema = schema.get("properties", {}).get("fields", {}).get("items", schema)
+    if "$defs" in schema or "definitions" in schema:
+        field_schema = {**field_schema, **{k: schema[k] for k in ("$defs", "definitions") if k in schema}}
+    return validator_for(field_schema)(field_schema)
+
+
+# --- writers ----------------------------------------------------------------------
+
+def _dumps(obj):
+    if HAS_ORJSON:
+        import orjson
+
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class VLMDWriter:
+    """Incremental writer for the selected formats; fields go straight to disk."""
+
+    def __init__(self, output_stem, formats=("json",), title=None):
+        unknown = set(formats) - set(FORMATS)
+        if unknown:
+            raise ValueError(f"unknown VLMD formats {sorted(unknown)}; expected {FORMATS}")
+        self.paths = {}
+        self._json = self._csv = None
+        self._first = True
+        if "json" in formats:
+            self.paths["json"] = f"{output_stem}.vlmd.json"
+            self._json = open(self.paths["json"], "wb")
+            header = _dumps({"schemaVersion": SCHEMA_VERSION, "title": title or os.path.basename(output_stem)})
+            self._json.write(header[:-1] + b',"fields":[\n')
+        if "csv" in formats:
+            self.paths["csv"] = f"{output_stem}.vlmd.csv"
+            self._csv_file = open(self.paths["csv"], "w", newline="", encoding="utf-8")
+            self._csv = csv.DictWriter(self._csv_file, fieldnames=VLMD_COLUMNS, extrasaction="ignore")
+            self._csv.writeheader()
+
+    def write(self, flat, field):
+        if self._json is not None:
+            if not self._first:
+                self._json.write(b",\n")
+            self._json.write(_dumps(field))
+            self._first = False
+        if self._csv is not None:
+            self._csv.writerow(flat)
+
+    def close(self):
+        if self._json is not None:
+            self._json.write(b"\n]}\n")
+            self._json.close()
+        if self._csv is not None:
+            self._csv_file.close()
+
+
+def export_vlmd(rows, output_stem, formats=("json",), title=None, min_cde_score=80, columns=None,
+                schema_file=None, strict=False):
+    """
+    Stream `rows` (dicts, e.g. iter_workbook_rows / iter_frame_rows) into
+    {output_stem}.vlmd.json / .vlmd.csv, validating each field as it is written.
+    Problems go to {output_stem}.vlmd_errors.csv; `strict` raises ValueError on the
+    first one instead. Returns {format: path}.
+    """
+    started = time.perf_counter()
+    validator = _schema_validator(schema_file) if schema_file else None
+    writer = VLMDWriter(output_stem, formats, title)
+    errors_path = f"{output_stem}.vlmd_errors.csv"
+    errors_file = errors = None
+    seen_names = set()
+    fields = crf_mappings = cde_mappings = invalid = 0
+    try:
+        for number, row in enumerate(rows, start=1):
+            flat = flat_field(row, min_cde_score, columns)
+            field = nested_field(flat)
+            problems = field_errors(field, seen_names)
+            if validator is not None:
+                problems += [f"schema: {e.message}" for e in validator.iter_errors(field)]
+            if problems:
+                invalid += 1
+                if strict:
+                    raise ValueError(f"VLMD field {number} ({field.get('name')!r}): {'; '.join(problems)}")
+                if errors is None:
+                    errors_file = open(errors_path, "w", newline="", encoding="utf-8")
+                    errors = csv.writer(errors_file)
+                    errors.writerow(["Field", "name", "Problem"])
+                for problem in problems:
+                    errors.writerow([number, field.get("name", ""), problem])
+            writer.write(flat, field)
+            fields += 1
+            crf_mappings += f"{INSTRUMENT}.title" in flat
+            cde_mappings += f"{ITEM}.id" in flat
+    finally:
+        writer.close()
+        if errors_file is not None:
+            errors_file.close()
+    output.info(f"[VLMD] {fields:,} fields ({crf_mappings:,} CRF mappings, {cde_mappings:,} CDE mappings, "
+                f"{invalid:,} with problems) -> {', '.join(writer.paths.values())} "
+                f"in {time.perf_counter() - started:.1f}s")
+    if invalid:
+        output.info(f"[VLMD] Problems listed in {errors_path}")
+    elif os.path.exists(errors_path):
+        os.remove(errors_path)
+    return writer.paths
+
+
+def _output_stem(path, output_dir):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    for suffix in ("_vlmd_cdesearch", ".vlmd", "_vlmd"):
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+    return os.path.join(output_dir or os.path.dirname(path) or ".", stem)
+
+
+def export_vlmd_file(path, output_dir=None, sheet_name=None, **kwargs):
+    """export_vlmd over one workbook or CSV, written next to it (or to `output_dir`)."""
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    return export_vlmd(iter_workbook_rows(path, sheet_name), _output_stem(path, output_dir), **kwargs)
@@ -0,0 +1,135 @@
+"""
+Output workbooks shared by the pipeline, the batch runner and the review quizzes.
+"""
+import pandas as pd
+
+from .crf_catalog import NO_CRF_MATCH
+from .offload import output
+
+MATCH_COL = "HEAL Core CRF Match"
+CANONICAL_COL = "Canonical CRF Name"
+RATIONALE_COL = "Rationale"
+FULL_RESPONSE_COL = "Full Response"
+
+
+def text_width(series):
+    """Longest cell of `series` as text (missing cells count as empty)."""
+    if series.empty:
+        return 0
+    return int(series.astype(object).fillna("").map(lambda v: len(str(v))).max())
+
+
+def build_metadata(df, crf_col="Form Name"):
+    """Metadata sheet: one row per (original form, canonical CRF) combo."""
+    name_col = CANONICAL_COL if CANONICAL_COL in df.columns else "Refined CRF Name"
+    cols = [c for c in [crf_col, name_col, RATIONALE_COL, FULL_RESPONSE_COL] if c in df.columns]
+    return (
+        df[cols]
+        .drop_duplicates(subset=[c for c in [crf_col, name_col] if c in df.columns])
+        .reset_index(drop=True)
+    )
+
+
+def build_report(df, crf_col="Form Name", match_col=MATCH_COL):
+    """
+    Build a wide report: columns are HEAL Core CRF Match,
+    rows list all original form values that match.
+    """
+    grouped = (
+        df[df[match_col].astype(object).fillna(NO_CRF_MATCH) != NO_CRF_MATCH]
+        .groupby(match_col, observed=True)[crf_col]
+        .apply(lambda s: sorted(s.astype(str).unique()))
+        .to_dict()
+    )
+
+    # pad lists for uniform length
+    max_len = max((len(v) for v in grouped.values()), default=0)
+    report_data = {
+        match: vals + [""] * (max_len - len(vals))
+        for match, vals in grouped.items()
+    }
+    return pd.DataFrame(report_data)
+
+
+def write_enhanced_workbook(output_file, final_df, crf_col="Form Name", form_report_df=None, layout="enhanced"):
+    """
+    Metadata + EnhancedDD (+ FormMatches) workbook written by the matching pipeline.
+    layout="normalized" writes Rows/Responses/Forms instead (see cde_detective.results);
+    `cde-detective export` turns that back into Metadata + EnhancedDD.
+    """
+    from .results import FORMS_SHEET, LAYOUTS, RESPONSES_SHEET, ROWS_SHEET, normalize_results
+
+    if layout not in LAYOUTS:
+        raise ValueError(f"layout must be one of {LAYOUTS}, got {layout!r}")
+    if MATCH_COL in final_df.columns and "Confidence Level" in final_df.columns:
+        # Replace any 'Confidence Level' with 'No CRF match' where 'HEAL Core CRF Match' is 'No CRF match'
+        final_df["Confidence Level"] = final_df["Confidence Level"].astype(object)
+        final_df.loc[final_df[MATCH_COL] == NO_CRF_MATCH, "Confidence Level"] = NO_CRF_MATCH
+
+    with pd.ExcelWriter(output_file, engine="xlsxwriter") as writer:
+        if layout == "normalized":
+            results = normalize_results(final_df)
+            results.rows.to_excel(writer, sheet_name=ROWS_SHEET, index=False)
+            results.responses.to_excel(writer, sheet_name=RESPONSES_SHEET)
+            results.forms.to_excel(writer, sheet_name=FORMS_SHEET)
+            sheets = f"'{ROWS_SHEET}', '{RESPONSES_SHEET}' and '{FORMS_SHEET}' ({results.dedup_summary()})"
+        else:
+            # Metadata sheet: one row per (section, refined CRF) combo
+            build_metadata(final_df, crf_col).to_excel(writer, sheet_name="Metadata", index=False)
+            # EnhancedDD sheet: the full original + all new columns
+            final_df.to_excel(writer, sheet_name="EnhancedDD", index=False)
+            sheets = "'Metadata' and 'EnhancedDD'"
+        # Form-level consistency report (form mode only)
+        if form_report_df is not None:
+            form_report_df.to_excel(writer, sheet_name="FormMatches", index=False)
+    output.info(f"Results saved to {output_file} with sheets {sheets}")
+
+
+def export_enhanced_workbook(input_file, output_file, crf_col="Form Name"):
+    """Materialize a normalized results workbook into the Metadata + EnhancedDD layout."""
+    from .loader import load_table
+    from .results import is_normalized, materialize, read_results, sheet_names
+
+    if not is_normalized(input_file):
+        raise ValueError(f"{input_file} is not a normalized results workbook")
+    form_report_df = None
+    if "FormMatches" in sheet_names(input_file):
+        form_report_df = load_table(input_file, sheet_name="FormMatches", categorical=[])
+    write_enhanced_workbook(output_file, materialize(read_results(input_file), categorical=[]),
+                            crf_col, form_report_df)
+    return output_file
+
+
+def write_review_workbook(output_file, df, metadata_df, report_df, sheet_name="EnhancedDD"):
+    """
+    Write EnhancedDD, Metadata, and (optionally) Report sheets into one workbook,
+    applying freeze panes, autofilter, and autofit.
+    """
+    with pd.ExcelWriter(output_file, engine="xlsxwriter") as writer:
+        # 1) Dump the two always-present sheets
+        df.to_excel(writer,      sheet_name=sheet_name, index=False)
+        metadata_df.to_excel(writer, sheet_name="Metadata", index=False)
+
+        ws_dd   = writer.sheets[sheet_name]
+        ws_meta = writer.sheets["Metadata"]
+
+        # formatting helper
+        def fmt_sheet(ws, data):
+            ws.freeze_panes(1, 0)
+            ws.autofilter(0, 0, data.shape[0], data.shape[1] - 1)
+            for col_idx, col in enumerate(data.columns):
+                width = max(text_width(data[col]), len(col)) + 2
+                ws.set_column(col_idx, col_idx, width)
+
+        # 2) Format EnhancedDD & Metadata
+        fmt_sheet(ws_dd, df)
+        fmt_sheet(ws_meta, metadata_df)
+
+        # 3) Only write & format Report if it has at least one column
+        if report_df.shape[1] > 0:
+            report_df.to_excel(writer, sheet_name="Report", index=False)
+            fmt_sheet(writer.sheets["Report"], report_df)
+        else:
+            output.info("→ Report sheet is empty; skipping it.")
+
+    output.info(f"\n🎉 All done! Workbook saved as {output_file}")
@@ -0,0 +1,47 @@
+"""Field cleaning and boilerplate removal (cde_detective.prompts, prestep_descriptions)."""
+import pandas as pd
+import pytest
+
+from cde_detective.prestep import prestep_descriptions
+from cde_detective.prompts import clean_text, dedupe_sentences
+
+INTRO = "Please answer the following questions about your pain over the past week."
+
+
+@pytest.mark.parametrize("text, cleaned", [
+    ("Hello [first_name], how are you?", "Hello , how are you?"),
+    ("[baseline_arm_1][pain_score] at baseline", "at baseline"),
+    ("Score [pain:label]", "Score"),
+    ("Repeat [q2(1)]", "Repeat"),
+    ("Visit [event-label] for [record-name]", "Visit for"),
+    ("<b>Weight</b> [kg]", "Weight [kg]"),
+    ("Height [mm] [optional]", "Height [mm] [optional]"),
+    ("Specify [Other]", "Specify [Other]"),
+])
+def test_clean_text_removes_only_piping(text, cleaned):
+    assert clean_text(text) == cleaned
+
+
+def test_clean_text_uses_the_dictionary_field_names():
+    assert clean_text("[age] years old") == "[age] years old"
+    assert clean_text("[age] years old", {"age"}) == "years old"
+
+
+def test_dedupe_sentences_shares_seen_across_calls():
+    seen = set()
+    first = dedupe_sentences([f"{INTRO} How bad is it?"], seen)
+    second = dedupe_sentences([f"{INTRO} Where is it?"], seen)
+    assert first == [f"{INTRO} How bad is it?"]
+    assert second == ["Where is it?"]
+
+
+def test_dedupe_sentences_keeps_a_text_made_only_of_repeats():
+    assert dedupe_sentences([f"{INTRO} How bad is it?", INTRO]) == [f"{INTRO} How bad is it?", INTRO]
+
+
+def test_prestep_descriptions_drop_boilerplate_across_rows():
+    df = pd.DataFrame({
+        "Variable / Field Name": ["pain_bad", "pain_where", "age"],
+        "Field Label": [f"{INTRO} How bad is it?", f"{INTRO} Where is it?", "Age in years, see [age]"],
+    })
+    assert prestep_descriptions(df) == [f"{INTRO} How bad is it?", "Where is it?", "Age in years, see"]
@@ -0,0 +1,141 @@
+"""Local JSON repair and schema validation (cde_detective.structured)."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from cde_detective.crf_catalog import NO_CRF_MATCH
+from cde_detective.heal_match import match_with_retry
+from cde_detective.structured import (
+    HEAL_MATCH_ALIASES,
+    PRESTEP_ALIASES,
+    HarmonizeResponse,
+    HealMatchResponse,
+    ParseStats,
+    PrestepResponse,
+    StructuredOutputError,
+    parse_structured,
+    repair_json,
+)
+
+
+# --- repair_json -------------------------------------------------------------
+
+@pytest.mark.parametrize("text", [
+    '```json\n{"crf_name": "PHQ-9", "rationale": "depression screener"}\n```',
+    'Here you go: {"crf_name": "PHQ-9", "rationale": "depression screener"} Hope that helps.',
+    '{"crf_name": "PHQ-9", "rationale": "depression screener",}',
+    "{'crf_name': 'PHQ-9', 'rationale': 'depression screener'}",
+    '{“crf_name”: “PHQ-9”, “rationale”: “depression screener”}',
+])
+def test_repair_json_recovers_near_valid_objects(text):
+    assert repair_json(text) == {"crf_name": "PHQ-9", "rationale": "depression screener"}
+
+
+def test_repair_json_reads_key_value_lines():
+    text = "HEAL Core CRF Match: PHQ9\nConfidence Level: Medium\n- Rationale: \"item wording\""
+    assert repair_json(text) == {
+        "HEAL Core CRF Match": "PHQ9",
+        "Confidence Level": "Medium",
+        "Rationale": "item wording",
+    }
+
+
+def test_repair_json_keeps_python_literals():
+    assert repair_json("{'crf_name': 'PHQ-9', 'rationale': None, 'ok': True,}") == \
+        {"crf_name": "PHQ-9", "rationale": None, "ok": True}
+
+
+def test_repair_json_array():
+    assert repair_json('[{"original": "a", "label": "A"},]') == [{"original": "a", "label": "A"}]
+
+
+@pytest.mark.parametrize("text", ["", "   ", None])
+def test_repair_json_rejects_empty(text):
+    with pytest.raises(StructuredOutputError, match="empty response"):
+        repair_json(text)
+
+
+def test_repair_json_keeps_raw_text_when_unrepairable():
+    with pytest.raises(StructuredOutputError) as excinfo:
+        repair_json("I could not find a matching form.")
+    assert excinfo.value.raw == "I could not find a matching form."
+
+
+# --- parse_structured --------------------------------------------------------
+
+def test_parse_structured_counts_valid_replies():
+    stats = ParseStats()
+    result = parse_structured('{"crf_name": "PHQ-9", "rationale": "r"}', PrestepResponse, stats=stats)
+    assert result == PrestepResponse(crf_name="PHQ-9", rationale="r")
+    assert (stats.valid, stats.repaired, stats.failed) == (1, 0, 0)
+
+
+def test_parse_structured_counts_repairs():
+    stats = ParseStats()
+    result = parse_structured('```\n{"mappings": [{"original": "phq 9", "label": "PHQ-9"},]}\n```',
+                              HarmonizeResponse, stats=stats)
+    assert result.as_dict() == {"phq 9": "PHQ-9"}
+    assert (stats.valid, stats.repaired, stats.retries_avoided) == (0, 1, 1)
+
+
+def test_parse_structured_renames_aliased_keys():
+    stats = ParseStats()
+    result = parse_structured('{"HEAL Core CRF Match": "PHQ-9", "Confidence Level": "High Confidence", '
+                              '"rationale": "item wording"}',
+                              HealMatchResponse, aliases=HEAL_MATCH_ALIASES, stats=stats)
+    assert (result.heal_core_crf, result.confidence) == ("PHQ9", "High")
+    assert stats.repaired == 1
+
+
+def test_parse_structured_prestep_aliases():
+    result = parse_structured('{"Refined CRF Name": "PHQ-9"}', PrestepResponse, aliases=PRESTEP_ALIASES,
+                              stats=ParseStats())
+    assert result.crf_name == "PHQ-9"
+
+
+@pytest.mark.parametrize("confidence, level", [
+    ("high", "High"), ("Medium Confidence", "Medium"), ("Low Confidence", "Low"), ("unsure", "Low"),
+])
+def test_parse_structured_normalizes_confidence(confidence, level):
+    text = f'{{"heal_core_crf": "No CRF match", "confidence": "{confidence}", "rationale": ""}}'
+    assert parse_structured(text, HealMatchResponse, stats=ParseStats()).confidence == level
+
+
+def test_parse_structured_rejects_unknown_crf():
+    stats = ParseStats()
+    text = '{"heal_core_crf": "Made-up Inventory", "confidence": "High", "rationale": ""}'
+    with pytest.raises(StructuredOutputError) as excinfo:
+        parse_structured(text, HealMatchResponse, stats=stats)
+    assert excinfo.value.raw == text
+    assert stats.failed == 1
+
+
+def test_parse_structured_counts_unrepairable_replies():
+    stats = ParseStats()
+    with pytest.raises(StructuredOutputError):
+        parse_structured("no JSON here", PrestepResponse, stats=stats)
+    assert (stats.valid, stats.repaired, stats.failed) == (0, 0, 1)
+
+
+# --- fallback confidence -------------------------------------------------------
+
+class _Replies:
+    """Chat client stand-in that answers every request with `content`."""
+
+    def __init__(self, content):
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self.content = content
+
+    async def _create(self, **body):
+        self.calls += 1
+        message = SimpleNamespace(content=self.content, refusal=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def test_match_fallback_uses_the_normalized_low_level():
+    client = _Replies("no JSON here")
+    result = asyncio.run(match_with_retry(client, "prestep output", "instruction", tries=2, stats=ParseStats()))
+    assert result == (NO_CRF_MATCH, "Low", "")
+    assert client.calls == 2